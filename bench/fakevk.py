@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# ------------------------------------------------------------------------------
+#  vkimexp [VK dialogs exporter]
+#  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
+# ------------------------------------------------------------------------------
+"""
+Local stand-in for VK: "al_im.php" endpoint serving synthetic history pages in
+the same format as the real one, and a CDN serving photos, images (stickers)
+and audio messages referenced from them.
+
+    python bench/fakevk.py [--port PORT] [--messages N] [...]
+    VKIMEXP_URL=http://127.0.0.1:PORT/al_im.php vkimexp --cookies-ttl 60 PEER
+
+(the application needs some cookies to start, which can be put into the cookie
+cache, see `auth.CookieProvider`; `bench/run.py` does all of this by itself).
+"""
+
+import argparse
+import http.cookies
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+from dataclasses import dataclass, asdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PAGE_SIZE = 100
+FIRST_MSG_ID = 100000
+FIRST_TS = 1600000000
+STICKERS_NUM = 50
+
+
+@dataclass(frozen=True)
+class FakeVkConfig:
+    messages: int = 10000  # per peer
+    photo_density: float = 0.1  # share of messages with an attachment of the type
+    image_density: float = 0.05
+    audio_density: float = 0.02
+    attachment_size: int = 32 * 1024
+    api_latency: float = 0.0  # seconds
+    cdn_latency: float = 0.0
+
+
+class FakeVkServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, config: FakeVkConfig, port: int = 0):
+        super().__init__(("127.0.0.1", port), _FakeVkRequestHandler)
+        self.config = config
+        self.failing_offsets: set[int] = set()  # respond to the requests of these pages with HTTP 503
+        self.session_cookie: str | None = None  # if set, requests without it are treated as logged out
+        self.missing_paths: set[str] = set()  # respond to the requests of these CDN files with HTTP 404
+        self.ranges = True  # whether CDN supports range requests
+        self.drop_after: int | None = None  # if set, CDN breaks the connection after sending this many bytes
+        self.base_url = f"http://127.0.0.1:{self.server_port}"
+
+    @property
+    def api_url(self) -> str:
+        return self.base_url + "/al_im.php"
+
+    def start(self) -> "FakeVkServer":
+        threading.Thread(target=self.serve_forever, name="fakevk", daemon=True).start()
+        return self
+
+    def make_page(self, peer_id: int, offset: int) -> tuple[str, dict]:
+        """
+        Same as VK, return `PAGE_SIZE` messages preceding the `offset`-th one
+        counting from the end, from the oldest to the newest.
+        """
+        last_idx = self.config.messages - offset
+        idxs = range(max(1, last_idx - PAGE_SIZE + 1), last_idx + 1)
+        html = "".join(self._make_msg_html(peer_id, idx) for idx in idxs)
+        data = {str(FIRST_MSG_ID + idx): self._make_msg_data(peer_id, idx) for idx in idxs}
+        return html, data
+
+    def make_attachment(self, path: str) -> bytes:
+        chunk = path.encode() + b"\n"
+        return (chunk * (self.config.attachment_size // len(chunk) + 1))[: self.config.attachment_size]
+
+    def _make_msg_html(self, peer_id: int, idx: int) -> str:
+        from_id = self._get_from_id(peer_id, idx)
+        rnd = random.Random(idx)
+        attachments = ""
+        if rnd.random() < self.config.photo_density:
+            temp = {
+                "x": [f"{self.base_url}/cdn/photo/x{idx}.jpg", 604, 453],
+                "y": [f"{self.base_url}/cdn/photo/y{idx}.jpg", 1280, 960],
+            }
+            attachments += (
+                f'<a aria-label="фотография" '
+                f"onclick='return showPhoto(\"{from_id}_{idx}\", \"\", {json.dumps({'temp': temp})}, event)' "
+                f'style="width: 302px; background-image: url({self.base_url}/cdn/photo/thumb{idx}.jpg);"></a>'
+            )
+        if rnd.random() < self.config.image_density:
+            attachments += f'<img src="{self.base_url}/cdn/image/sticker{idx % STICKERS_NUM}.png">'
+        if rnd.random() < self.config.audio_density:
+            attachments += (
+                f'<div class="audio-msg-track" data-mp3="{self.base_url}/cdn/audiomsg/voice{idx}.mp3" '
+                f'data-ogg="{self.base_url}/cdn/audiomsg/voice{idx}.ogg"></div>'
+            )
+        return (
+            f'<div class="im-mess-stack" data-peer="{from_id}"><div class="im-mess-stack--content">'
+            f'<div class="im-mess-stack--pname"><a href="/id{from_id}">User {from_id}</a></div>'
+            f'<ul><li class="im-mess" data-msgid="{FIRST_MSG_ID + idx}">'
+            f'<span class="blind_label">Message:</span>'
+            f'<div class="im-mess--text">Message number {idx}</div>{attachments}</li></ul></div></div>'
+        )
+
+    def _make_msg_data(self, peer_id: int, idx: int) -> list:
+        attach = {}
+        if peer_id >= 2000000000:
+            attach["from"] = str(self._get_from_id(peer_id, idx))
+        flags = 2 if idx % 2 else 0
+        return [FIRST_MSG_ID + idx, flags, 0, FIRST_TS + idx * 60, f"Message number {idx}", attach, 0, 0, idx]
+
+    def _get_from_id(self, peer_id: int, idx: int) -> int:
+        if peer_id >= 2000000000:
+            return 100 + idx % 5
+        return peer_id if idx % 2 else 1
+
+
+class _FakeVkRequestHandler(BaseHTTPRequestHandler):
+    server: FakeVkServer
+    protocol_version = "HTTP/1.1"  # keep-alive
+    disable_nagle_algorithm = True  # headers and body are sent separately
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == "/al_im.php":
+            time.sleep(self.server.config.api_latency)
+            query = urllib.parse.parse_qs(url.query)
+            if int(query["offset"][0]) in self.server.failing_offsets:
+                self._respond(503, b"", "text/plain")
+                return
+            if self.server.session_cookie and not self._has_session_cookie():
+                body = json.dumps({"payload": [3, ["", "login"]]}).encode()
+                self._respond(200, body, "application/json")
+                return
+            html, data = self.server.make_page(int(query["peer"][0]), int(query["offset"][0]))
+            body = json.dumps({"payload": [0, [html, data]]}, ensure_ascii=False).encode()
+            self._respond(200, body, "application/json")
+        elif url.path.startswith("/cdn/"):
+            time.sleep(self.server.config.cdn_latency)
+            if url.path in self.server.missing_paths:
+                self._respond(404, b"", "text/plain")
+                return
+            self._respond_attachment(self.server.make_attachment(url.path))
+        else:
+            self._respond(404, b"", "text/plain")
+
+    def _has_session_cookie(self) -> bool:
+        cookies = http.cookies.SimpleCookie(self.headers.get("cookie", ""))
+        return "remixsid" in cookies and cookies["remixsid"].value == self.server.session_cookie
+
+    def _respond_attachment(self, content: bytes):
+        """
+        Serve either the whole file, or its tail requested with "range: bytes=N-".
+        """
+        range_match = re.fullmatch(r"bytes=(\d+)-", self.headers.get("range", ""))
+        if not self.server.ranges or not range_match:
+            self._respond(200, content, "application/octet-stream", self.server.drop_after)
+            return
+
+        start = int(range_match.group(1))
+        if start >= len(content):
+            self._respond(416, b"", "text/plain", headers={"content-range": f"bytes */{len(content)}"})
+            return
+        content_range = f"bytes {start}-{len(content) - 1}/{len(content)}"
+        self._respond(206, content[start:], "application/octet-stream", headers={"content-range": content_range})
+
+    def _respond(self, status: int, body: bytes, content_type: str, drop_after: int = None, headers: dict = None):
+        self.send_response(status)
+        self.send_header("content-type", content_type)
+        self.send_header("content-length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if drop_after is not None and drop_after < len(body):
+            self.wfile.write(body[:drop_after])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+def add_config_args(argparser: argparse.ArgumentParser):
+    defaults = FakeVkConfig()
+    argparser.add_argument("--photo-density", type=float, default=defaults.photo_density)
+    argparser.add_argument("--image-density", type=float, default=defaults.image_density)
+    argparser.add_argument("--audio-density", type=float, default=defaults.audio_density)
+    argparser.add_argument("--attachment-kb", type=int, default=defaults.attachment_size // 1024)
+    argparser.add_argument("--api-latency-ms", type=float, default=defaults.api_latency * 1000)
+    argparser.add_argument("--cdn-latency-ms", type=float, default=defaults.cdn_latency * 1000)
+
+
+def make_config(args: argparse.Namespace, messages: int) -> FakeVkConfig:
+    return FakeVkConfig(
+        messages=messages,
+        photo_density=args.photo_density,
+        image_density=args.image_density,
+        audio_density=args.audio_density,
+        attachment_size=args.attachment_kb * 1024,
+        api_latency=args.api_latency_ms / 1000,
+        cdn_latency=args.cdn_latency_ms / 1000,
+    )
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    argparser.add_argument("--port", type=int, default=0)
+    argparser.add_argument("--messages", type=int, default=FakeVkConfig.messages)
+    add_config_args(argparser)
+    args = argparser.parse_args()
+
+    server = FakeVkServer(make_config(args, args.messages), args.port)
+    print(f"Serving at {server.api_url}: {asdict(server.config)}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
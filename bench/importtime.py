@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# ------------------------------------------------------------------------------
+#  vkimexp [VK dialogs exporter]
+#  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
+# ------------------------------------------------------------------------------
+"""
+Import time regression check: runs `python -X importtime -m vkimexp --help`
+several times and fails if the best of the cumulative import times of the CLI
+module exceeds the budget, or if any of the heavy modules, which are supposed
+to be imported on demand, gets imported.
+
+    python bench/importtime.py [--budget-ms MS] [--runs N]
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).parent.parent
+TARGET_MODULE = "vkimexp.cli"
+DEFAULT_BUDGET_MS = 100.0
+DEFAULT_RUNS = 5
+
+# heavy modules which are not needed to display the help
+DEFERRED_MODULES = ["asyncio", "aiohttp", "requests", "urllib3", "pytermor", "bs4", "lxml", "yt_dlp", "browser_cookie3"]
+
+_LINE_REGEX = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)$")
+
+
+def measure() -> dict[str, int]:
+    """
+    :return: cumulative import time in microseconds for each imported module.
+    """
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [str(ROOT_DIR), os.environ.get("PYTHONPATH")]))}
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", "vkimexp", "--help"],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        check=True,
+    )
+    result = dict()
+    for line in proc.stderr.splitlines():
+        if m := _LINE_REGEX.match(line):
+            result[m.group(4)] = int(m.group(2))
+    return result
+
+
+def main() -> int:
+    argparser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    argparser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS)
+    argparser.add_argument("--runs", type=int, default=DEFAULT_RUNS)
+    args = argparser.parse_args()
+
+    timings = [measure() for _ in range(args.runs)]
+    best_ms = min(t.get(TARGET_MODULE, 0) for t in timings) / 1000
+    print(f"{TARGET_MODULE}: {best_ms:.1f} ms (best of {args.runs}), budget: {args.budget_ms:.1f} ms")
+
+    failed = False
+    if best_ms > args.budget_ms:
+        print(f"FAIL: import time budget exceeded by {best_ms - args.budget_ms:.1f} ms")
+        failed = True
+    for module in DEFERRED_MODULES:
+        if module in timings[0]:
+            print(f"FAIL: {module!r} is imported eagerly")
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
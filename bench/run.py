@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# ------------------------------------------------------------------------------
+#  vkimexp [VK dialogs exporter]
+#  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
+# ------------------------------------------------------------------------------
+"""
+End-to-end benchmark: exports synthetic histories of the given sizes from a
+local stand-in for VK (see `fakevk.py`) and reports pages/s, attachments/s,
+peak RSS and time spent at each stage of the processing (see `vkimexp.metrics`,
+stage timings are summed up over all the threads and processes, so they can
+exceed wall time). Results are written into a JSON file, which can be passed
+as a baseline to the next run to catch regressions.
+
+    python bench/run.py [--messages N [N ...]] [--replay] [--output FILE]
+                        [--baseline FILE] [--args "EXPORTER OPTIONS"] [...]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shlex
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from dataclasses import asdict
+from pathlib import Path
+
+from fakevk import FakeVkConfig, FakeVkServer, add_config_args, make_config
+
+ROOT_DIR = Path(__file__).parent.parent
+PEER_ID = 2000000001
+BROWSER = "chrome"
+
+
+def _seed_cookie_cache(cache_dir: str):
+    cache_path = Path(cache_dir) / "vkimexp" / f"cookies.{BROWSER}.json"
+    cache_path.parent.mkdir(parents=True)
+    cache_path.write_text(json.dumps({"ts": time.time(), "cookies": {"remixsid": "bench"}}))
+
+
+def _get_replay_args(export_args: list[str]) -> list[str]:
+    """
+    :return: export options which are accepted by 'vkimexp replay' as well.
+    """
+    import click
+    from vkimexp.cli import entrypoint, replay_entrypoint
+
+    accepted = {opt for param in replay_entrypoint.params for opt in param.opts}
+    with_value = {
+        opt
+        for param in entrypoint.params
+        if isinstance(param, click.Option) and not param.is_flag and not param.count
+        for opt in param.opts
+    }
+    replay_args, tokens = [], iter(export_args)
+    for token in tokens:
+        name = token.split("=", 1)[0]
+        values = [next(tokens)] if name in with_value and "=" not in token else []
+        if name in accepted:
+            replay_args += [token, *values]
+    return replay_args
+
+
+def _run_exporter(
+    url: str, work_dir: str, command: str, argv: list[str], api_rate: float | None, verbose: bool
+) -> dict:
+    """
+    Runs in a separate process, so that peak RSS is measured for the exporter
+    only, and so that all the module-level state starts from scratch.
+    """
+    os.environ["VKIMEXP_URL"] = url
+    os.environ["XDG_CACHE_HOME"] = os.path.join(work_dir, "cache")
+    if not verbose:
+        sys.stdout = open(os.devnull, "wt")
+
+    from vkimexp.cli import entrypoint, replay_entrypoint
+    from vkimexp.common import Context
+    from vkimexp.metrics import Metrics
+    from vkimexp.ratelimit import RateLimiter
+
+    Context._OUT_DIR = Path(work_dir) / "out"
+    if api_rate:
+        RateLimiter.INITIAL_RATE = RateLimiter.MAX_RATE = api_rate
+
+    start = time.perf_counter()
+    if command == "replay":
+        replay_entrypoint([*argv, str(PEER_ID)], standalone_mode=False)
+    else:
+        entrypoint([*argv, "--browser", BROWSER, "--cookies-ttl", "60", str(PEER_ID)], standalone_mode=False)
+    wall_sec = time.perf_counter() - start
+
+    metrics = Metrics.get_instance()
+    pages = metrics.get("pages", status="completed")
+    attachments = metrics.get("attachments", status="success")
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    rss_unit = 1 if sys.platform == "darwin" else 1024  # bytes / KiB
+    return {
+        "wall_sec": round(wall_sec, 3),
+        "pages": pages,
+        "pages_failed": metrics.get("pages", status="failed"),
+        "attachments": attachments,
+        "attachments_failed": metrics.get("attachments", status="failed"),
+        "pages_per_sec": round(pages / wall_sec, 2),
+        "attachments_per_sec": round(attachments / wall_sec, 2),
+        "fetched_mb": round(metrics.get("fetched_bytes") / 2**20, 2),
+        "downloaded_mb": round(metrics.get("downloaded_bytes") / 2**20, 2),
+        "peak_rss_mb": round(usage.ru_maxrss * rss_unit / 2**20, 1),
+        "peak_rss_children_mb": round(usage_children.ru_maxrss * rss_unit / 2**20, 1),
+        "stages": metrics.to_dict()["stages"],
+    }
+
+
+def _run_in_process(mp_context, fn: callable, *args) -> dict:
+    # not in a pool, as its processes are not allowed to have children (replay needs them)
+    conn, child_conn = mp_context.Pipe()
+    proc = mp_context.Process(target=_call, args=(child_conn, fn, *args))
+    proc.start()
+    result = conn.recv()
+    proc.join()
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def _call(conn, fn: callable, *args):
+    try:
+        conn.send(fn(*args))
+    except Exception as e:
+        conn.send(e)
+
+
+def _serve(config: FakeVkConfig, conn):
+    server = FakeVkServer(config)
+    conn.send(server.api_url)
+    server.serve_forever()
+
+
+def run_scenario(mp_context, config: FakeVkConfig, args: argparse.Namespace) -> dict:
+    conn, child_conn = mp_context.Pipe()
+    server_proc = mp_context.Process(target=_serve, args=(config, child_conn), daemon=True)
+    server_proc.start()
+    url = conn.recv()
+
+    result = {"config": asdict(config), "args": args.args}
+    try:
+        with tempfile.TemporaryDirectory(prefix="vkimexp-bench-") as work_dir:
+            _seed_cookie_cache(os.path.join(work_dir, "cache"))
+            runs = {"export": shlex.split(args.args)}
+            if args.replay:
+                runs["replay"] = _get_replay_args(runs["export"])
+            for name, argv in runs.items():
+                run_args = (url, work_dir, name, argv, args.api_rate, args.verbose)
+                result[name] = _run_in_process(mp_context, _run_exporter, *run_args)
+                print(f"{config.messages} messages, {name}: " + _format(result[name]), flush=True)
+    finally:
+        server_proc.terminate()
+        server_proc.join()
+    return result
+
+
+def compare(results: list[dict], baseline: dict, tolerance: float) -> bool:
+    """
+    :return: True if some of the scenarios became slower than the baseline
+             by more than `tolerance` percent.
+    """
+    regressed = False
+    baseline_results = {_get_key(r): r for r in baseline["results"]}
+    for result in results:
+        if not (baseline_result := baseline_results.get(_get_key(result))):
+            continue
+        for name in ("export", "replay"):
+            if name not in result or name not in baseline_result:
+                continue
+            cur, prev = result[name]["pages_per_sec"], baseline_result[name]["pages_per_sec"]
+            delta = (cur - prev) / prev * 100 if prev else 0.0
+            status = "OK"
+            if delta < -tolerance:
+                status = "REGRESSION"
+                regressed = True
+            print(f"{result['config']['messages']} messages, {name}: {prev} -> {cur} pages/s ({delta:+.1f}%) {status}")
+    return regressed
+
+
+def _get_key(result: dict) -> str:
+    return json.dumps([result["config"], result["args"]], sort_keys=True)
+
+
+def _format(run: dict) -> str:
+    stages = ", ".join(f"{stage} {s['sec']:.2f}s" for stage, s in run["stages"].items())
+    return (
+        f"{run['wall_sec']:.2f}s, {run['pages_per_sec']:.1f} pages/s, {run['attachments_per_sec']:.1f} attachments/s, "
+        f"peak RSS {run['peak_rss_mb']:.0f} MB ({stages})"
+    )
+
+
+def main() -> int:
+    argparser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    argparser.add_argument("--messages", type=int, nargs="+", default=[1000, 10000], help="history sizes to test")
+    add_config_args(argparser)
+    argparser.add_argument("--api-rate", type=float, help="fixed rate limit of API requests per second")
+    argparser.add_argument("--args", default="", help="extra options to run the exporter with")
+    argparser.add_argument("--replay", action="store_true", help="also measure 'vkimexp replay' of each export")
+    argparser.add_argument("--output", default="bench-results.json")
+    argparser.add_argument("--baseline", help="results of the previous run to compare with")
+    argparser.add_argument("--tolerance", type=float, default=10.0, help="allowed slowdown, in percent")
+    argparser.add_argument("--verbose", action="store_true", help="show exporter output")
+    args = argparser.parse_args()
+
+    # exporter must not inherit any state from this process
+    mp_context = multiprocessing.get_context("spawn")
+    sys.path.insert(0, str(ROOT_DIR))
+    results = [run_scenario(mp_context, make_config(args, messages), args) for messages in args.messages]
+
+    output = {
+        "ts": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "results": results,
+    }
+    with open(args.output, "wt") as f:
+        json.dump(output, f, indent=4)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, "rt") as f:
+            if compare(results, json.load(f), args.tolerance):
+                return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
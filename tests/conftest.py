@@ -0,0 +1,105 @@
+# ------------------------------------------------------------------------------
+#  vkimexp [VK dialogs exporter]
+#  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
+# ------------------------------------------------------------------------------
+
+import json
+import os
+import re
+import sys
+import time
+import typing as t
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "bench"))
+from fakevk import FakeVkConfig, FakeVkServer
+
+PEER_ID = 2000000001
+BROWSER = "chrome"
+
+# API URL is read on import, so the server is started before any `vkimexp` module is imported
+_server = FakeVkServer(FakeVkConfig()).start()
+os.environ["VKIMEXP_URL"] = _server.api_url
+
+
+@pytest.fixture
+def fakevk() -> t.Iterator[FakeVkServer]:
+    """
+    Local stand-in for VK serving 350 messages without attachments by default
+    (i.e. 5 pages at offsets 330, 230, 130, 30 and 0).
+    """
+    _server.config = FakeVkConfig(messages=350, photo_density=0, image_density=0, audio_density=0)
+    yield _server
+    _server.failing_offsets = set()
+    _server.session_cookie = None
+    _server.missing_paths = set()
+    _server.ranges = True
+    _server.drop_after = None
+
+
+@pytest.fixture
+def export(fakevk, tmp_path, monkeypatch) -> t.Iterator[t.Callable[..., Path]]:
+    """
+    Run the exporter in this process, with a clean shared state and the
+    output directed into a temporary dir. Returns output dir of the peer.
+    """
+    from vkimexp.auth import CookieProvider
+    from vkimexp.cli import entrypoint
+    from vkimexp.common import Context, get_logger
+    from vkimexp.metrics import Metrics
+    from vkimexp.ratelimit import RateLimiter
+
+    cache_path = tmp_path / "cache" / "vkimexp" / f"cookies.{BROWSER}.json"
+    cache_path.parent.mkdir(parents=True)
+    cache_path.write_text(json.dumps({"ts": time.time(), "cookies": {"remixsid": "test"}}))
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.setattr(Context, "_OUT_DIR", tmp_path / "out")
+    monkeypatch.setattr(CookieProvider, "_instances", dict())
+    monkeypatch.setattr(Metrics, "_instance", None)
+    monkeypatch.setattr(RateLimiter, "_instance", None)
+    monkeypatch.setattr(RateLimiter, "MAX_RETRIES", 0)
+    log_handlers = [*get_logger().handlers]
+    runs = 0
+
+    def run(*args: str) -> Path:
+        nonlocal runs
+        runs += 1
+        # log files are named after the current second, and the runs are faster than that
+        monkeypatch.setattr(Context, "get_logs_dir", staticmethod(lambda: tmp_path / "logs" / str(runs)))
+        argv = ["-p", "0", "-d", "0", *args, "--browser", BROWSER, "--cookies-ttl", "60", str(PEER_ID)]
+        entrypoint(argv, standalone_mode=False)
+        return Context.get_out_dir(PEER_ID)
+
+    yield run
+
+    for handler in [*get_logger().handlers]:
+        if handler not in log_handlers:
+            get_logger().removeHandler(handler)
+            handler.close()
+
+
+@pytest.fixture
+def replay(export, tmp_path, monkeypatch) -> t.Callable[..., Path]:
+    """
+    Same as `export`, but for 'vkimexp replay' command.
+    """
+    from vkimexp.cli import replay_entrypoint
+    from vkimexp.common import Context
+
+    runs = 0
+
+    def run(*args: str) -> Path:
+        nonlocal runs
+        runs += 1
+        monkeypatch.setattr(Context, "get_logs_dir", staticmethod(lambda: tmp_path / "logs" / f"replay.{runs}"))
+        replay_entrypoint([*args, str(PEER_ID)], standalone_mode=False)
+        return Context.get_out_dir(PEER_ID)
+
+    return run
+
+
+def read_index_msg_idxs(out_dir: Path) -> list[int]:
+    with open(out_dir / "index.txt", "rt") as f:
+        return [int(m.group(1)) for line in f if (m := re.match(r"\s*\((\d+)\)", line))]
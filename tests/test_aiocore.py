@@ -0,0 +1,52 @@
+# ------------------------------------------------------------------------------
+#  vkimexp [VK dialogs exporter]
+#  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
+# ------------------------------------------------------------------------------
+
+import shutil
+from pathlib import Path
+
+import pytest
+
+from fakevk import FakeVkConfig
+
+pytest.importorskip("aiohttp")
+
+SKIPPED_FILES = ["checkpoint.json", "attachments.sqlite"]  # timestamps
+
+
+def read_output(out_dir: Path) -> dict[str, bytes]:
+    output = {
+        str(path.relative_to(out_dir)): path.read_bytes()
+        for path in out_dir.rglob("*")
+        if path.is_file() and path.name not in SKIPPED_FILES
+    }
+    output["index.txt"] = output["index.txt"].split(b"\n", 1)[1]  # header with the current time
+    return output
+
+
+@pytest.mark.parametrize("fetch_args", [[], ["--fetch-jobs", "3"]])
+def test_engines_output_parity(export, fakevk, fetch_args: list[str]):
+    fakevk.config = FakeVkConfig(messages=350, photo_density=0.05, image_density=0.05, audio_density=0.05)
+    out_dir = export("--engine", "threads", "-d", "4", *fetch_args)
+    expected = read_output(out_dir)
+    shutil.rmtree(out_dir)
+
+    output = read_output(export("--engine", "asyncio", "-d", "4", *fetch_args))
+    assert output.keys() == expected.keys()
+    for rel_path, content in expected.items():
+        assert output[rel_path] == content, rel_path
+
+
+def test_no_threaded_stack(export, fakevk, monkeypatch):
+    from vkimexp import core, fetcher, handler
+
+    created = []
+    monkeypatch.setattr(core, "Transport", lambda *args: created.append("transport"))
+    monkeypatch.setattr(handler.DownloadQueue, "__init__", lambda *args: created.append("download queue"))
+    for fetcher_cls in [fetcher.PageFetcher, fetcher.PrefetchingPageFetcher, fetcher.ConcurrentPageFetcher]:
+        monkeypatch.setattr(fetcher_cls, "iter_pages", lambda *args: created.append("page fetcher"))
+
+    out_dir = export("--engine", "asyncio", "-d", "4", "--fetch-jobs", "3")
+    assert created == []
+    assert (out_dir / "rendered1.html").exists()
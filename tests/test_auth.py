@@ -0,0 +1,69 @@
+# ------------------------------------------------------------------------------
+#  vkimexp [VK dialogs exporter]
+#  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
+# ------------------------------------------------------------------------------
+
+import pytest
+
+from conftest import read_index_msg_idxs
+from vkimexp.auth import CookieProvider
+from vkimexp.core import Task
+from vkimexp.metrics import Metrics
+
+ALL_MSG_IDXS = list(range(1, 351))
+
+
+@pytest.fixture
+def extracted(monkeypatch) -> list[str]:
+    """
+    Values of the session cookie to be extracted from the browser one by one.
+    """
+    values = []
+
+    def _extract(self, ctx):
+        return {"remixsid": values.pop(0)}
+
+    monkeypatch.setattr(CookieProvider, "_extract", _extract)
+    return values
+
+
+def expire_session_at(monkeypatch: pytest.MonkeyPatch, fakevk, expire_offset: int, new_value: str):
+    consume_page = Task._consume_page
+
+    def _consume_page(self, page: int, offset: int, im_data):
+        if offset == expire_offset:
+            fakevk.session_cookie = new_value
+        consume_page(self, page, offset, im_data)
+
+    monkeypatch.setattr(Task, "_consume_page", _consume_page)
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+@pytest.mark.parametrize("fetch_args", [[], ["-j", "2", "-p", "2"]])
+def test_session_expired(export, fakevk, extracted, monkeypatch, engine: str, fetch_args: list[str]):
+    if engine == "asyncio":
+        pytest.importorskip("aiohttp")
+    fakevk.session_cookie = "test"  # the cached one, see `export` fixture
+    extracted.append("fresh")
+    expire_session_at(monkeypatch, fakevk, 230, "fresh")
+
+    out_dir = export("--engine", engine, *fetch_args)
+    assert read_index_msg_idxs(out_dir) == ALL_MSG_IDXS
+    assert not extracted
+    assert Metrics.get_instance().get("pages", status="failed") == 0
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_session_not_refreshed(export, fakevk, extracted, monkeypatch, engine: str):
+    if engine == "asyncio":
+        pytest.importorskip("aiohttp")
+    monkeypatch.setattr("vkimexp.cli.MAX_INIT_ATTEMPTS", 1)
+    fakevk.session_cookie = "test"
+    extracted.append("stale")
+    expire_session_at(monkeypatch, fakevk, 230, "fresh")
+
+    export("--engine", engine)
+    assert not extracted
+    # the task is stopped instead of failing the rest of the pages one by one
+    assert Metrics.get_instance().get("pages", status="completed") == 2
+    assert Metrics.get_instance().get("pages", status="failed") == 1
@@ -0,0 +1,91 @@
+# ------------------------------------------------------------------------------
+#  vkimexp [VK dialogs exporter]
+#  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
+# ------------------------------------------------------------------------------
+
+import sqlite3
+import time
+from pathlib import Path
+
+import pytest
+
+from vkimexp.cache import AttachmentCache, CacheStatusEnum
+
+
+def count_rows(out_dir: Path) -> int:
+    with sqlite3.connect(out_dir / AttachmentCache.FILENAME) as conn:
+        return conn.execute("SELECT COUNT(*) FROM attachments").fetchone()[0]
+
+
+def test_round_trip(tmp_path):
+    cache = AttachmentCache(tmp_path)
+    assert cache.get("https://vk.test/1.jpg") is None
+    cache.put("https://vk.test/1.jpg", Path("photo/1.jpg"), 1234)
+    cache.put_failed("https://vk.test/2.jpg", RuntimeError("Not found"))
+    cache.close()
+
+    cache = AttachmentCache(tmp_path)
+    entry = cache.get("https://vk.test/1.jpg")
+    assert (entry.status, entry.path, entry.size, entry.error) == (CacheStatusEnum.OK, "photo/1.jpg", 1234, None)
+    entry = cache.get("https://vk.test/2.jpg")
+    assert (entry.status, entry.path, entry.error) == (CacheStatusEnum.FAILED, None, "Not found")
+    cache.close()
+
+
+def test_put_before_first_lookup(tmp_path):
+    cache = AttachmentCache(tmp_path)
+    cache.put("https://vk.test/1.jpg", Path("photo/1.jpg"), 1)
+    cache.close()
+
+    cache = AttachmentCache(tmp_path)
+    cache.put("https://vk.test/2.jpg", Path("photo/2.jpg"), 2)  # not flushed yet
+    assert cache.get("https://vk.test/1.jpg").path == "photo/1.jpg"
+    assert cache.get("https://vk.test/2.jpg").path == "photo/2.jpg"
+    cache.close()
+
+
+def test_success_replaces_failure(tmp_path):
+    cache = AttachmentCache(tmp_path)
+    cache.put_failed("https://vk.test/1.jpg", RuntimeError("Timeout"))
+    cache.put("https://vk.test/1.jpg", Path("photo/1.jpg"), 1)
+    cache.close()
+
+    cache = AttachmentCache(tmp_path)
+    assert cache.get("https://vk.test/1.jpg").status == CacheStatusEnum.OK
+    cache.close()
+    assert count_rows(tmp_path) == 1
+
+
+def test_failure_expires(tmp_path, monkeypatch):
+    cache = AttachmentCache(tmp_path)
+    cache.put_failed("https://vk.test/1.jpg", RuntimeError("Not found"))
+    cache.put("https://vk.test/2.jpg", Path("photo/2.jpg"), 2)
+    assert cache.get("https://vk.test/1.jpg") is not None
+
+    now = time.time() + AttachmentCache.FAILURE_TTL_SEC
+    monkeypatch.setattr("vkimexp.cache.time.time", lambda: now)
+    assert cache.get("https://vk.test/1.jpg") is None  # to be requested again
+    assert cache.get("https://vk.test/2.jpg") is not None
+    cache.close()
+
+
+def test_batched_writes(tmp_path, monkeypatch):
+    monkeypatch.setattr(AttachmentCache, "BATCH_SIZE", 10)
+    cache = AttachmentCache(tmp_path)
+    for n in range(25):
+        cache.put(f"https://vk.test/{n}.jpg", Path(f"photo/{n}.jpg"), n)
+    assert count_rows(tmp_path) == 20
+    cache.flush()
+    assert count_rows(tmp_path) == 25
+    cache.close()
+
+
+@pytest.mark.parametrize("flush", [False, True])
+def test_close_is_idempotent(tmp_path, flush: bool):
+    cache = AttachmentCache(tmp_path)
+    cache.put("https://vk.test/1.jpg", Path("photo/1.jpg"), 1)
+    if flush:
+        cache.flush()
+    cache.close()
+    cache.close()
+    assert count_rows(tmp_path) == 1
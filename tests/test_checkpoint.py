@@ -0,0 +1,91 @@
+# ------------------------------------------------------------------------------
+#  vkimexp [VK dialogs exporter]
+#  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
+# ------------------------------------------------------------------------------
+
+import json
+from pathlib import Path
+
+import click
+import pytest
+
+from conftest import PEER_ID, read_index_msg_idxs
+from vkimexp.checkpoint import Checkpoint
+from vkimexp.common import Context
+from vkimexp.core import Task
+
+ALL_MSG_IDXS = list(range(1, 351))
+ALL_OFFSETS = [0, 30, 130, 230, 330]
+
+
+def load_checkpoint(out_dir: Path) -> dict:
+    with open(out_dir / Checkpoint.FILENAME, "rt") as f:
+        return json.load(f)
+
+
+def interrupt_at(monkeypatch: pytest.MonkeyPatch, interrupt_offset: int):
+    consume_page = Task._consume_page
+
+    def _consume_page(self, page: int, offset: int, im_data):
+        if offset == interrupt_offset:
+            raise KeyboardInterrupt
+        consume_page(self, page, offset, im_data)
+
+    monkeypatch.setattr(Task, "_consume_page", _consume_page)
+
+
+def test_export_is_complete(export):
+    out_dir = export()
+    assert read_index_msg_idxs(out_dir) == ALL_MSG_IDXS
+    checkpoint = load_checkpoint(out_dir)
+    assert checkpoint["complete"]
+    assert sorted(checkpoint["completed"]) == ALL_OFFSETS
+
+
+def test_resume_interrupted(export, monkeypatch):
+    with monkeypatch.context() as m:
+        interrupt_at(m, 130)
+        with pytest.raises(click.Abort):  # click converts KeyboardInterrupt
+            export()
+
+    out_dir = export("--resume")
+    assert read_index_msg_idxs(out_dir) == ALL_MSG_IDXS
+    assert load_checkpoint(out_dir)["complete"]
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_resume_failed_page(export, fakevk, engine: str):
+    if engine == "asyncio":
+        pytest.importorskip("aiohttp")
+    fakevk.failing_offsets = {130}
+    out_dir = export("--engine", engine)
+    checkpoint = load_checkpoint(out_dir)
+    assert not checkpoint["complete"]
+    assert sorted(checkpoint["completed"]) == [230, 330]
+
+    fakevk.failing_offsets = set()
+    out_dir = export("--engine", engine, "--resume")
+    assert read_index_msg_idxs(out_dir) == ALL_MSG_IDXS
+    checkpoint = load_checkpoint(out_dir)
+    assert checkpoint["complete"]
+    assert sorted(checkpoint["completed"]) == ALL_OFFSETS
+
+
+def test_resume_failed_page_after_interruption(export, fakevk, monkeypatch):
+    fakevk.failing_offsets = {130}
+    with monkeypatch.context() as m:
+        interrupt_at(m, 0)
+        with pytest.raises(click.Abort):  # click converts KeyboardInterrupt
+            export()
+    assert not load_checkpoint(Context.get_out_dir(PEER_ID))["complete"]
+
+    fakevk.failing_offsets = set()
+    out_dir = export("--resume")
+    assert read_index_msg_idxs(out_dir) == ALL_MSG_IDXS
+    assert load_checkpoint(out_dir)["complete"]
+
+
+def test_resume_complete_starts_over(export):
+    export()
+    out_dir = export("--resume")
+    assert read_index_msg_idxs(out_dir) == ALL_MSG_IDXS
@@ -0,0 +1,76 @@
+# ------------------------------------------------------------------------------
+#  vkimexp [VK dialogs exporter]
+#  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
+# ------------------------------------------------------------------------------
+
+import click
+import pytest
+
+from conftest import PEER_ID, read_index_msg_idxs
+from vkimexp.common import AuthError, Context
+from vkimexp.core import Task
+
+ALL_MSG_IDXS = list(range(1, 351))
+OTHER_PEER_ID = 2000000002
+
+
+@pytest.fixture
+def init_errors(monkeypatch) -> list[Exception]:
+    """
+    Errors to be raised by `Task` constructor one by one, before it succeeds.
+    """
+    errors = []
+    init = Task.__init__
+
+    def __init__(self, *args, **kwargs):
+        if errors:
+            raise errors.pop(0)
+        init(self, *args, **kwargs)
+
+    monkeypatch.setattr(Task, "__init__", __init__)
+    monkeypatch.setattr("vkimexp.cli._get_delay", lambda attempt: 0)
+    return errors
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_init_error_retried(export, init_errors, engine: str):
+    if engine == "asyncio":
+        pytest.importorskip("aiohttp")
+    init_errors.extend([OSError("database is locked"), RuntimeError("temporary")])
+    out_dir = export("--engine", engine)
+    assert not init_errors
+    assert read_index_msg_idxs(out_dir) == ALL_MSG_IDXS
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+@pytest.mark.parametrize("error", [AuthError("no cookies"), click.UsageError("damaged output")])
+def test_init_error_not_retried(export, init_errors, engine: str, error: Exception):
+    if engine == "asyncio":
+        pytest.importorskip("aiohttp")
+    init_errors.extend([error, OSError("should not get here")])
+    out_dir = export("--engine", engine)
+    assert len(init_errors) == 1
+    assert not (out_dir / "index.txt").exists()
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_several_peers(export, fakevk, capsys, engine: str):
+    if engine == "asyncio":
+        pytest.importorskip("aiohttp")
+    export("--engine", engine, "--jobs", "2", str(OTHER_PEER_ID))
+
+    for peer_id in (PEER_ID, OTHER_PEER_ID):
+        assert read_index_msg_idxs(Context.get_out_dir(peer_id)) == ALL_MSG_IDXS
+    summary = capsys.readouterr().out
+    assert "Peers (exported/failed):  2/0" in summary
+    assert "Messages (indexed/rendered):  700/700" in summary
+
+
+def test_several_peers_one_failed(export, init_errors, capsys):
+    init_errors.append(AuthError("no cookies"))
+    export("--jobs", "2", str(OTHER_PEER_ID))
+
+    summary = capsys.readouterr().out
+    assert "Peers (exported/failed):  1/1" in summary
+    assert "Messages (indexed/rendered):  350/350" in summary
+    assert "Failed peers:" in summary
@@ -0,0 +1,132 @@
+# ------------------------------------------------------------------------------
+#  vkimexp [VK dialogs exporter]
+#  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
+# ------------------------------------------------------------------------------
+
+import json
+import random
+
+import pytest
+
+from vkimexp.dedup import Bitmap, DedupIndex, SparseSet
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_bitmap_same_as_set(seed: int):
+    rnd = random.Random(seed)
+    bitmap, expected = Bitmap(), set()
+    start = rnd.randrange(-1000, 1_000_000)
+    for _ in range(2000):
+        value = start + rnd.randrange(-5000, 5000)
+        assert bitmap.add(value) == (value not in expected)
+        expected.add(value)
+
+    assert len(bitmap) == len(expected)
+    for value in range(start - 6000, start + 6000):
+        assert (value in bitmap) == (value in expected)
+
+
+def test_bitmap_grows_both_ways():
+    bitmap = Bitmap()
+    bitmap.update([100, 5, 1000, -3])
+    assert [v for v in range(-10, 1010) if v in bitmap] == [-3, 5, 100, 1000]
+    assert not bitmap.add(5)
+    assert len(bitmap) == 4
+
+
+def test_bitmap_state():
+    bitmap = Bitmap()
+    bitmap.update(range(0, 10000, 3))
+    state = json.loads(json.dumps(bitmap.get_state()))  # as saved into a checkpoint
+    restored = Bitmap(state)
+
+    assert len(restored) == len(bitmap)
+    assert all(v in restored for v in range(0, 10000, 3))
+    assert not any(v in restored for v in range(1, 10000, 3))
+    assert not restored.add(9)
+    assert restored.add(10)
+
+
+def test_bitmap_clear():
+    bitmap = Bitmap()
+    bitmap.update([10, 20])
+    bitmap.clear()
+    assert len(bitmap) == 0
+    assert 10 not in bitmap
+    assert bitmap.add(-50)
+    assert -50 in bitmap and 10 not in bitmap
+
+
+def test_dedup_index_planes():
+    index = DedupIndex()
+    assert index.get_plane(DedupIndex.INDEX).add(1)
+    assert index.get_plane(DedupIndex.JSON).add(1)  # planes are independent
+    assert not index.get_plane(DedupIndex.INDEX).add(1)
+
+    restored = DedupIndex()
+    restored.restore(json.loads(json.dumps(index.get_state())))
+    assert 1 in restored.get_plane(DedupIndex.INDEX)
+    assert 1 in restored.get_plane(DedupIndex.JSON)
+    assert len(restored.get_plane(DedupIndex.MSG_ID)) == 0
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_sparse_set_same_as_set(seed: int):
+    rnd = random.Random(seed)
+    sparse, expected = SparseSet(), set()
+    dense_start = rnd.randrange(0, 1_000_000)
+    for _ in range(3000):
+        if rnd.random() < 0.5:
+            value = rnd.randrange(-(10**9), 10**9)
+        else:
+            value = dense_start + rnd.randrange(0, 6000)  # turns some blocks into bitmaps
+        assert sparse.add(value) == (value not in expected)
+        expected.add(value)
+
+    assert len(sparse) == len(expected)
+    assert all(v in sparse for v in expected)
+    assert not any(v in sparse for v in range(dense_start - 100_000, dense_start + 100_000) if v not in expected)
+
+    restored = SparseSet(json.loads(json.dumps(sparse.get_state())))
+    assert len(restored) == len(expected)
+    assert all(v in restored for v in expected)
+    assert not any(v in restored for v in range(dense_start - 100_000, dense_start) if v not in expected)
+
+
+def test_sparse_set_size_independent_of_range():
+    sparse, bitmap = SparseSet(), Bitmap()
+    values = range(0, 200_000_000, 100_003)
+    sparse.update(values)
+    bitmap.update(values)
+    assert len(sparse) == len(values)
+    assert len(json.dumps(sparse.get_state())) < len(values) * 6  # base64 of 2 bytes per value + block keys
+    assert len(json.dumps(sparse.get_state())) < len(json.dumps(bitmap.get_state())) / 4
+
+
+def test_sparse_set_clear():
+    sparse = SparseSet()
+    sparse.update(range(5000))
+    sparse.clear()
+    assert len(sparse) == 0
+    assert 10 not in sparse
+    assert sparse.add(10)
+
+
+def test_sparse_set_from_bitmap_state():
+    bitmap = Bitmap()
+    bitmap.update([-3, 5, 100, 70000])
+    sparse = SparseSet(json.loads(json.dumps(bitmap.get_state())))
+    assert len(sparse) == 4
+    assert [v for v in range(-10, 70010) if v in sparse] == [-3, 5, 100, 70000]
+
+
+def test_dedup_index_msg_id_plane():
+    index = DedupIndex()
+    assert isinstance(index.get_plane(DedupIndex.MSG_ID), SparseSet)
+    assert isinstance(index.get_plane(DedupIndex.INDEX), Bitmap)
+    index.get_plane(DedupIndex.MSG_ID).update([1, 10**9])
+
+    restored = DedupIndex()
+    restored.restore(json.loads(json.dumps(index.get_state())))
+    assert isinstance(restored.get_plane(DedupIndex.MSG_ID), SparseSet)
+    assert 10**9 in restored.get_plane(DedupIndex.MSG_ID)
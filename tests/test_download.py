@@ -0,0 +1,188 @@
+# ------------------------------------------------------------------------------
+#  vkimexp [VK dialogs exporter]
+#  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
+# ------------------------------------------------------------------------------
+
+import html
+import re
+import shutil
+from pathlib import Path
+
+import pytest
+
+from fakevk import FakeVkConfig, FakeVkServer
+from vkimexp.common import DownloadError
+from vkimexp.handler import PartialDownload
+from vkimexp.metrics import Metrics
+
+ATTACHMENT_DIRS = ["photo", "image", "audiomsg"]
+
+
+def get_url(fakevk: FakeVkServer, content: bytes) -> str:
+    return fakevk.base_url + content.split(b"\n", 1)[0].decode()  # see `FakeVkServer.make_attachment()`
+
+
+def read_attachments(out_dir: Path) -> dict[str, bytes]:
+    return {
+        str(path.relative_to(out_dir)): path.read_bytes()
+        for subdir in ATTACHMENT_DIRS
+        for path in (out_dir / subdir).rglob("*")
+        if path.is_file()
+    }
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+@pytest.mark.parametrize("attachment_size", [1000, 2_500_000])  # less than one chunk / several writes
+def test_download(export, fakevk, engine: str, attachment_size: int):
+    if engine == "asyncio":
+        pytest.importorskip("aiohttp")
+    fakevk.config = FakeVkConfig(
+        messages=120, photo_density=0.05, image_density=0.05, audio_density=0.05, attachment_size=attachment_size
+    )
+    attachments = read_attachments(export("--engine", engine, "-d", "4"))
+
+    assert {Path(rel_path).parts[0] for rel_path in attachments} == set(ATTACHMENT_DIRS)
+    for rel_path, content in attachments.items():
+        assert not rel_path.endswith(".part")
+        assert content == fakevk.make_attachment(get_url(fakevk, content).removeprefix(fakevk.base_url))
+
+
+def test_download_engines_parity(export, fakevk):
+    pytest.importorskip("aiohttp")
+    fakevk.config = FakeVkConfig(messages=120, photo_density=0.1, image_density=0.1, audio_density=0.1)
+    out_dir = export("--engine", "threads", "-d", "4")
+    expected = read_attachments(out_dir)
+    shutil.rmtree(out_dir)
+    assert read_attachments(export("--engine", "asyncio", "-d", "4")) == expected
+
+
+def find_links(out_dir: Path) -> set[str]:
+    """
+    :return: links from the HTML pages, either to local files or to fake CDN.
+    """
+    links = set()
+    for path in out_dir.glob("rendered*.html"):
+        content = path.read_text()
+        links.update(html.unescape(link) for link in re.findall(r'(?:href|src|data-original)="([^"]+)"', content))
+        links.update(re.findall(r"url\(([^)]+)\)", content))
+    return links
+
+
+def replace_with_parts(fakevk: FakeVkServer, out_dir: Path, attachments: dict[str, bytes], make_part: callable):
+    """
+    Remove the output and put partial files of the attachments in its place.
+    """
+    shutil.rmtree(out_dir)
+    for rel_path, content in attachments.items():
+        part_path = PartialDownload(get_url(fakevk, content), out_dir / rel_path).path
+        part_path.parent.mkdir(parents=True, exist_ok=True)
+        part_path.write_bytes(make_part(content))
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_resume_download(export, fakevk, engine: str):
+    if engine == "asyncio":
+        pytest.importorskip("aiohttp")
+    fakevk.config = FakeVkConfig(
+        messages=120, photo_density=0.05, image_density=0.05, audio_density=0.05, attachment_size=200_000
+    )
+    out_dir = export("--engine", engine, "-d", "4")
+    expected = read_attachments(out_dir)
+    replace_with_parts(fakevk, out_dir, expected, lambda content: content[:150_000])
+
+    downloaded_bytes = Metrics.get_instance().get("downloaded_bytes")
+    assert read_attachments(export("--engine", engine, "-d", "4")) == expected
+    # only the missing tails were requested
+    assert Metrics.get_instance().get("downloaded_bytes") - downloaded_bytes == len(expected) * 50_000
+
+
+@pytest.mark.parametrize("ranges", [True, False])
+def test_stale_partial_download_discarded(export, fakevk, ranges: bool):
+    fakevk.config = FakeVkConfig(messages=120, photo_density=0.05, image_density=0.05, audio_density=0.05)
+    out_dir = export("-d", "4")
+    expected = read_attachments(out_dir)
+    if ranges:  # longer than the file, server responds with HTTP 416
+        replace_with_parts(fakevk, out_dir, expected, lambda content: content + b"garbage")
+    else:  # server responds with the whole file
+        replace_with_parts(fakevk, out_dir, expected, lambda content: b"garbage")
+        fakevk.ranges = False
+
+    downloaded_bytes = Metrics.get_instance().get("downloaded_bytes")
+    assert read_attachments(export("-d", "4")) == expected
+    assert Metrics.get_instance().get("downloaded_bytes") - downloaded_bytes == sum(map(len, expected.values()))
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_interrupted_download(export, fakevk, engine: str):
+    if engine == "asyncio":
+        pytest.importorskip("aiohttp")
+    fakevk.config = FakeVkConfig(
+        messages=120, photo_density=0.05, image_density=0.05, audio_density=0.05, attachment_size=300_000
+    )
+    out_dir = export("--engine", engine, "-d", "4")
+    expected = read_attachments(out_dir)
+    shutil.rmtree(out_dir)
+
+    fakevk.drop_after = 200_000
+    export("--engine", engine, "-d", "4")
+    parts = read_attachments(out_dir)
+    assert parts and all(rel_path.endswith(".part") for rel_path in parts)
+    assert all(len(content) <= 200_000 for content in parts.values())
+    assert any(parts.values())  # aiohttp can discard the last received data, but not all of it
+
+    fakevk.drop_after = None
+    downloaded_bytes = Metrics.get_instance().get("downloaded_bytes")
+    assert read_attachments(export("--engine", engine, "-d", "4")) == expected
+    assert Metrics.get_instance().get("downloaded_bytes") - downloaded_bytes < len(expected) * 300_000
+
+
+def test_partial_download_size_mismatch(tmp_path):
+    url, local_abs_path = "https://vk.test/photo/a.jpg", tmp_path / "a.jpg"
+    part = PartialDownload(url, local_abs_path)
+    part.begin(200, {"content-length": "10"})
+    part.write(b"01234")
+    with pytest.raises(DownloadError):
+        part.finish()
+    assert part.path.read_bytes() == b"01234"  # to be continued
+
+    part = PartialDownload(url, local_abs_path)
+    assert part.get_request_headers()["range"] == "bytes=5-"
+    part.begin(206, {"content-range": "bytes 5-9/10"})
+    part.write(b"56789extra")
+    with pytest.raises(DownloadError):
+        part.finish()
+    assert not part.path.exists()
+
+
+def test_partial_download_unexpected_range(tmp_path):
+    url, local_abs_path = "https://vk.test/photo/a.jpg", tmp_path / "a.jpg"
+    part = PartialDownload(url, local_abs_path)
+    part.path.write_bytes(b"01234")
+    part = PartialDownload(url, local_abs_path)
+    with pytest.raises(DownloadError):
+        part.begin(206, {"content-range": "bytes 0-9/10"})
+    assert not part.path.exists()
+    assert "range" not in PartialDownload(url, local_abs_path).get_request_headers()
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+@pytest.mark.parametrize("download_jobs", ["0", "4"])
+def test_failed_download_links(export, fakevk, engine: str, download_jobs: str):
+    if engine == "asyncio":
+        pytest.importorskip("aiohttp")
+    fakevk.config = FakeVkConfig(messages=350, photo_density=0.05, image_density=0.05, audio_density=0.05)
+    out_dir = export("--engine", engine, "-d", download_jobs)
+    urls = sorted(get_url(fakevk, content) for content in read_attachments(out_dir).values())
+    shutil.rmtree(out_dir)
+
+    missing_urls = urls[::3]
+    fakevk.missing_paths = {url.removeprefix(fakevk.base_url) for url in missing_urls}
+    fakevk.missing_paths |= {path.replace(".mp3", ".ogg") for path in fakevk.missing_paths}
+    for run in range(2):
+        out_dir = export("--engine", engine, "-d", download_jobs)
+        links = find_links(out_dir)
+        local_links = {link for link in links if Path(link).parts[0] in ATTACHMENT_DIRS}
+        assert local_links and all((out_dir / link).exists() for link in local_links)
+        if not run:  # pages are written before the downloads fail
+            assert set(missing_urls) <= links
+        # failures are cached after the first run, and the elements are left as is
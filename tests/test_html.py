@@ -0,0 +1,88 @@
+# ------------------------------------------------------------------------------
+#  vkimexp [VK dialogs exporter]
+#  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
+# ------------------------------------------------------------------------------
+
+import re
+import typing as t
+from pathlib import Path
+
+import pytest
+
+from fakevk import FakeVkConfig
+from vkimexp.writer import HtmlWriter
+
+LINK_REGEX = re.compile(r'<a href="rendered(\d+)\.html">[^<]*(Prev|Next)[^<]*</a>')
+
+
+@pytest.fixture
+def open_pages(monkeypatch) -> list[tuple[t.TextIO, int]]:
+    """
+    Pages opened by `HtmlWriter`s along with amount of the pages which were
+    still open at that moment (not asserted right away, as the writer runs
+    in another thread).
+    """
+    pages = []
+
+    def open_page(path, mode="r", *args, **kwargs):
+        f = open(path, mode, *args, **kwargs)
+        if Path(path).name.startswith("rendered") and mode in ("wt", "at"):
+            pages.append((f, sum(not page.closed for page, _ in pages)))
+        return f
+
+    monkeypatch.setattr(HtmlWriter, "_MSG_PAGE_LIMIT", 100)
+    monkeypatch.setattr("vkimexp.writer.open", open_page, raising=False)
+    return pages
+
+
+def read_links(out_dir: Path) -> dict[int, list[tuple[int, str]]]:
+    return {
+        page_num: [(int(m.group(1)), m.group(2)) for m in LINK_REGEX.finditer(path.read_text())]
+        for page_num in range(1, 100)
+        if (path := out_dir / f"rendered{page_num}.html").exists()
+    }
+
+
+def expected_links(page_count: int) -> dict[int, list[tuple[int, str]]]:
+    return {
+        page_num: [
+            *([(page_num - 1, "Prev")] if page_num > 1 else []),
+            *([(page_num + 1, "Next")] if page_num < page_count else []),
+        ]
+        for page_num in range(1, page_count + 1)
+    }
+
+
+def read_msg_idxs(out_dir: Path, page_num: int) -> list[int]:
+    return sorted(map(int, re.findall(r"Message number (\d+)<", (out_dir / f"rendered{page_num}.html").read_text())))
+
+
+def test_pages(export, open_pages):
+    out_dir = export()
+    # 20 messages at offset 330, 100 at the next three, 30 at offset 0
+    assert read_links(out_dir) == expected_links(5)
+    assert [len(read_msg_idxs(out_dir, n)) for n in range(1, 6)] == [20, 100, 100, 100, 30]
+    assert [already_open for _, already_open in open_pages] == [0] * 5
+    assert all(page.closed for page, _ in open_pages)
+    assert all((out_dir / f"rendered{n}.html").read_text().endswith(HtmlWriter.HTML_TAIL) for n in range(1, 6))
+
+
+def test_pages_on_resume(export, fakevk, open_pages):
+    fakevk.failing_offsets = {130}
+    out_dir = export()
+    assert read_links(out_dir) == expected_links(4)  # the export goes on past the failed page
+
+    fakevk.failing_offsets = set()
+    export("--resume")
+    assert read_links(out_dir) == expected_links(5)
+    assert sorted(idx for n in range(1, 6) for idx in read_msg_idxs(out_dir, n)) == list(range(1, 351))
+    assert all(not already_open and page.closed for page, already_open in open_pages)
+
+
+def test_pages_on_sync(export, fakevk, open_pages):
+    out_dir = export()
+    fakevk.config = FakeVkConfig(messages=420, photo_density=0, image_density=0, audio_density=0)
+    export("--sync")
+    assert read_links(out_dir) == expected_links(6)  # the last page of previous export links the new one
+    assert read_msg_idxs(out_dir, 6) == list(range(351, 421))
+    assert all(not already_open and page.closed for page, already_open in open_pages)
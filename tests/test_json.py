@@ -0,0 +1,57 @@
+# ------------------------------------------------------------------------------
+#  vkimexp [VK dialogs exporter]
+#  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
+# ------------------------------------------------------------------------------
+
+import json
+from pathlib import Path
+
+import click
+import pytest
+
+from fakevk import FakeVkConfig
+from test_checkpoint import interrupt_at
+from vkimexp.writer import JsonWriter
+
+
+def assert_dumped(path: Path, msg_idxs: list[int]):
+    content = path.read_text()
+    msgs = json.loads(content)
+    assert [msg["msg_idx"] for msg in msgs] == msg_idxs
+    assert all(msg["attach"]["from"] for msg in msgs)  # nested objects are indented as well
+    assert content == json.dumps(msgs, ensure_ascii=False, indent=4)
+
+
+def test_same_as_dump(export):
+    assert_dumped(export() / JsonWriter.FILENAME, list(range(1, 351)))
+    assert not (export() / (JsonWriter.FILENAME + ".part")).exists()
+
+
+def test_same_as_dump_empty(export, fakevk):
+    fakevk.config = FakeVkConfig(messages=0)
+    assert_dumped(export() / JsonWriter.FILENAME, [])
+
+
+@pytest.mark.parametrize("interrupt_offset", [330, 130, 0])
+def test_same_as_dump_on_resume(export, monkeypatch, interrupt_offset: int):
+    with monkeypatch.context() as m:
+        interrupt_at(m, interrupt_offset)
+        with pytest.raises(click.Abort):
+            export()
+    assert_dumped(export("--resume") / JsonWriter.FILENAME, list(range(1, 351)))
+
+
+def test_same_as_dump_on_resume_failed_page(export, fakevk):
+    fakevk.failing_offsets = {130}
+    out_dir = export()
+    assert_dumped(out_dir / JsonWriter.FILENAME, [*range(1, 121), *range(221, 351)])
+    fakevk.failing_offsets = set()
+    export("--resume")
+    assert_dumped(out_dir / JsonWriter.FILENAME, list(range(1, 351)))
+
+
+def test_same_as_dump_on_sync(export, fakevk):
+    out_dir = export()
+    fakevk.config = FakeVkConfig(messages=420, photo_density=0, image_density=0, audio_density=0)
+    export("--sync")
+    assert_dumped(out_dir / JsonWriter.FILENAME, list(range(1, 421)))
@@ -0,0 +1,142 @@
+# ------------------------------------------------------------------------------
+#  vkimexp [VK dialogs exporter]
+#  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
+# ------------------------------------------------------------------------------
+
+import json
+import re
+import time
+from pathlib import Path
+
+import pytest
+
+from fakevk import FakeVkConfig
+from vkimexp.metrics import COUNTERS, PROMETHEUS_PREFIX, Metrics, MetricsExporter, RateMeter
+from vkimexp.ratelimit import RateLimiter
+
+SAMPLE_REGEX = re.compile(r"(?P<name>\w+)(?:\{(?P<labels>[^}]*)\})? (?P<value>[\d.e+-]+)")
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+def parse_prometheus(content: str) -> dict[str, dict[tuple[tuple[str, str], ...], float]]:
+    """
+    :return: {metric name: {sorted labels: value}}, checking that every
+             metric is preceded by its HELP and TYPE.
+    """
+    metrics, declared = {}, set()
+    for line in content.splitlines():
+        if m := re.fullmatch(r"# (HELP|TYPE) (\w+) .+", line):
+            declared.add((m.group(1), m.group(2)))
+            metrics.setdefault(m.group(2), dict())  # counters without samples are declared as well
+            continue
+        m = SAMPLE_REGEX.fullmatch(line)
+        assert m, f"Malformed line: {line!r}"
+        assert {("HELP", m["name"]), ("TYPE", m["name"])} <= declared
+        labels = tuple(sorted(re.findall(r'(\w+)="([^"]*)"', m["labels"] or "")))
+        metrics.setdefault(m["name"], dict())[labels] = float(m["value"])
+    return metrics
+
+
+def read_summary(logs_dir: Path) -> dict:
+    [path] = logs_dir.glob("*.metrics.json")
+    return json.loads(path.read_text())
+
+
+def get_counter(summary: dict, name: str, **labels: str) -> int:
+    return sum(c["value"] for c in summary["counters"][name] if labels.items() <= c.items())
+
+
+def test_export_metrics(export, fakevk, tmp_path, monkeypatch):
+    fakevk.config = FakeVkConfig(messages=350, photo_density=0.05, image_density=0.05, audio_density=0.05)
+    fakevk.failing_offsets = {130}
+    monkeypatch.setattr(RateLimiter, "MAX_RETRIES", 2)
+    monkeypatch.setattr(RateLimiter, "BACKOFF_BASE_SEC", 0.001)
+    metrics_path = tmp_path / "metrics.prom"
+    export("-d", "4", "--metrics-file", str(metrics_path))
+
+    summary = read_summary(tmp_path / "logs" / "1")
+    assert set(summary["counters"]) == set(COUNTERS)
+    assert summary["elapsed_sec"] > 0
+    assert summary["stages"]["write.json"]["calls"] == 4
+    assert get_counter(summary, "retries", kind="api") == 2
+    assert get_counter(summary, "pages", status="failed") == 1
+    assert get_counter(summary, "pages", status="completed") == 4
+    assert get_counter(summary, "cache_hits") == 0
+    downloaded = {t: get_counter(summary, "attachments", type=t, status="success") for t in ("photo", "image")}
+    assert all(downloaded.values())
+    downloaded_bytes = get_counter(summary, "downloaded_bytes")
+
+    prometheus = parse_prometheus(metrics_path.read_text())
+    for name in COUNTERS:
+        assert PROMETHEUS_PREFIX + name + "_total" in prometheus
+    assert prometheus["vkimexp_retries_total"] == {(("kind", "api"),): 2}
+    assert prometheus["vkimexp_pages_total"] == {(("status", "completed"),): 4, (("status", "failed"),): 1}
+    assert prometheus["vkimexp_stage_calls_total"][(("stage", "write.json"),)] == 4
+    assert prometheus["vkimexp_elapsed_seconds"][()] > 0
+
+    # attachments are in place already
+    fakevk.failing_offsets = set()
+    monkeypatch.setattr(Metrics, "_instance", None)
+    export("-d", "4", "--metrics-file", str(metrics_path))
+
+    summary = read_summary(tmp_path / "logs" / "2")
+    assert get_counter(summary, "retries") == 0
+    assert get_counter(summary, "pages", status="completed") == 5
+    for type_, count in downloaded.items():
+        assert get_counter(summary, "cache_hits", type=type_) == count
+    # only the attachments from the page which failed before
+    assert 0 < get_counter(summary, "downloaded_bytes") < downloaded_bytes
+    prometheus = parse_prometheus(metrics_path.read_text())
+    assert "vkimexp_retries_total" in prometheus and not prometheus["vkimexp_retries_total"]
+    assert prometheus["vkimexp_cache_hits_total"] == {
+        (("type", c["type"]),): c["value"] for c in summary["counters"]["cache_hits"]
+    }
+
+
+def test_exporter_updates_file(tmp_path):
+    metrics = Metrics()
+    path = tmp_path / "metrics.prom"
+    exporter = MetricsExporter(metrics, path, interval_sec=0.01)
+    exporter.start()
+    assert parse_prometheus(path.read_text())["vkimexp_pages_total"] == {}
+
+    metrics.count("pages", status="completed")
+    deadline = time.monotonic() + 5
+    while not parse_prometheus(path.read_text())["vkimexp_pages_total"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert parse_prometheus(path.read_text())["vkimexp_pages_total"] == {(("status", "completed"),): 1}
+
+    metrics.count("pages", status="completed")
+    exporter.stop()  # writes the final values
+    assert parse_prometheus(path.read_text())["vkimexp_pages_total"] == {(("status", "completed"),): 2}
+    assert [p.name for p in tmp_path.iterdir()] == [path.name]  # no temporary files left
+
+
+def test_rate_meter(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr("vkimexp.metrics.time", clock)
+    meter = RateMeter()
+    assert meter.rate == 0
+
+    clock.now += 2
+    meter.add(3)
+    assert meter.rate == pytest.approx(1.5)  # not a full window yet
+
+    for _ in range(8):
+        clock.now += 1
+        meter.add()
+    assert meter.rate == pytest.approx(1.1)
+
+    clock.now += 5  # the samples older than the window are dropped
+    meter.add(2)
+    assert meter.rate == pytest.approx(0.8)
+
+    clock.now += RateMeter.WINDOW_SEC + 1
+    assert meter.rate == 0
@@ -0,0 +1,52 @@
+# ------------------------------------------------------------------------------
+#  vkimexp [VK dialogs exporter]
+#  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
+# ------------------------------------------------------------------------------
+
+from pathlib import Path
+
+import pytest
+
+from conftest import PEER_ID
+from fakevk import FakeVkConfig
+from vkimexp.parser import HtmlParserBackend, LxmlParserBackend, get_parser_backend
+
+pytest.importorskip("lxml")
+
+
+def read_outputs(out_dir: Path) -> dict[str, str]:
+    outputs = dict()
+    for path in sorted([out_dir / "index.txt", *out_dir.glob("rendered*.html")]):
+        text = path.read_text()
+        if path.name == "index.txt":
+            text = text.split("\n", 1)[1]  # header contains the current time
+        outputs[path.name] = text
+    return outputs
+
+
+def test_default_backend():
+    assert isinstance(get_parser_backend(), HtmlParserBackend)
+    assert isinstance(get_parser_backend("lxml"), LxmlParserBackend)
+    with pytest.raises(RuntimeError):
+        get_parser_backend("auto")
+
+
+@pytest.mark.parametrize("offset", [0, 100, 900])
+def test_backends_parity_on_pages(fakevk, offset: int):
+    fakevk.config = FakeVkConfig(messages=1000, photo_density=0.5, image_density=0.5, audio_density=0.5)
+    html, _ = fakevk.make_page(PEER_ID, offset)
+    html_parser, lxml = HtmlParserBackend(), LxmlParserBackend()
+    assert lxml.serialize(lxml.parse(html)) == html_parser.serialize(html_parser.parse(html))
+
+
+def test_backends_parity_on_export(export, fakevk):
+    fakevk.config = FakeVkConfig(messages=350, photo_density=0.1, image_density=0.1, audio_density=0.05)
+    expected = read_outputs(export("--parser", "html.parser"))
+    assert read_outputs(export("--parser", "lxml")) == expected
+    assert len(expected) > 1
+
+
+@pytest.mark.parametrize("html", ["a &amp; b<br/>c", "<div>&lt;script&gt;</div>x &lt; y"])
+def test_lxml_escapes_text(html: str):
+    lxml = LxmlParserBackend()
+    assert lxml.serialize(lxml.parse(html)) == html
@@ -0,0 +1,123 @@
+# ------------------------------------------------------------------------------
+#  vkimexp [VK dialogs exporter]
+#  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
+# ------------------------------------------------------------------------------
+
+import json
+import re
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from fakevk import FakeVkConfig
+from vkimexp.core import CSS_FILENAME
+from vkimexp.metrics import Metrics
+from vkimexp.preview import PreviewQueue
+
+Image = pytest.importorskip("PIL.Image")
+
+
+@pytest.fixture
+def ctx(tmp_path: Path) -> SimpleNamespace:
+    return SimpleNamespace(out_dir=tmp_path, previews="jpeg", jobs=1, metrics=Metrics())
+
+
+def make_photo(ctx: SimpleNamespace, name: str, size: tuple[int, int] = (1200, 900)) -> Path:
+    path = ctx.out_dir / "photo" / name
+    path.parent.mkdir(exist_ok=True)
+    Image.new("RGB", size, "red").save(path, format="JPEG")
+    return path
+
+
+def test_previews_above_capacity(ctx, monkeypatch):
+    monkeypatch.setattr(PreviewQueue, "_PENDING_PER_WORKER", 1)
+    paths = [make_photo(ctx, f"{n}.jpg") for n in range(12)]
+
+    queue = PreviewQueue(ctx)
+    for path in paths:
+        queue.submit("photo", path)  # doesn't wait for the pool
+    queue.close()
+
+    for path in paths:
+        with Image.open(PreviewQueue.get_preview_path(ctx, path)) as preview:
+            assert max(preview.size) == PreviewQueue.MAX_SIDE["photo"]
+    assert ctx.metrics.get("previews", type="photo", status="success") == len(paths)
+    with open(ctx.out_dir / PreviewQueue.DIRNAME / PreviewQueue.MANIFEST_FILENAME) as f:
+        assert len(json.load(f)) == len(paths)
+
+
+def test_previews_skipped(ctx):
+    path = make_photo(ctx, "1.jpg")
+    for _ in range(2):
+        queue = PreviewQueue(ctx)
+        queue.submit("photo", path)
+        queue.close()
+    assert ctx.metrics.get("previews", type="photo", status="success") == 1
+    assert ctx.metrics.get("previews", type="photo", status="skipped") == 1
+
+
+def test_preview_of_rotated_photo(ctx):
+    path = ctx.out_dir / "photo" / "rotated.jpg"
+    path.parent.mkdir()
+    image = Image.new("RGB", (1200, 900), "blue")
+    image.paste("red", (0, 0, 600, 900))
+    exif = Image.Exif()
+    exif[0x0112] = 6  # orientation: rotated 90° CW when displayed, i.e. left half is at the top
+    image.save(path, format="JPEG", exif=exif)
+
+    queue = PreviewQueue(ctx)
+    queue.submit("photo", path)
+    queue.close()
+
+    with Image.open(PreviewQueue.get_preview_path(ctx, path)) as preview:
+        assert preview.size == (453, 604)
+        assert preview.getexif().get(0x0112) is None
+        red, _, blue = preview.getpixel((226, 10))
+        assert red > 200 and blue < 50
+        red, _, blue = preview.getpixel((226, 590))
+        assert red < 50 and blue > 200
+
+
+def test_preview_failure(ctx, caplog):
+    path = ctx.out_dir / "photo" / "corrupt.jpg"
+    path.parent.mkdir()
+    path.write_bytes(b"not an image")
+
+    queue = PreviewQueue(ctx)
+    queue.submit("photo", path)
+    queue.close()
+
+    assert not PreviewQueue.get_preview_path(ctx, path).exists()
+    assert ctx.metrics.get("previews", type="photo", status="failed") == 1
+    assert any(r.levelname == "WARNING" and "corrupt.jpg" in r.getMessage() for r in caplog.records)
+
+
+@pytest.mark.parametrize("export_args", [[], ["--previews", "jpeg"]])
+def test_lazy_loading_with_previews_only(export, fakevk, export_args: list[str]):
+    fakevk.config = FakeVkConfig(messages=120, photo_density=0, image_density=0.1, audio_density=0)
+    html = (export("-d", "4", *export_args) / "rendered1.html").read_text()
+    images = re.findall(r'<img [^>]*src="\./(?:preview/)?image/[^>]*>', html)
+    assert images
+    assert all(('loading="lazy"' in img) == bool(export_args) for img in images)
+
+
+def test_outdated_css_replaced(export):
+    out_dir = export()
+    expected = (out_dir / CSS_FILENAME).read_text()
+    outdated = re.sub(r"/\* version: \d+ \*/\n", "", expected).replace("img.preview", "img.other")
+    (out_dir / CSS_FILENAME).write_text(outdated)
+
+    export("--resume")
+    assert (out_dir / CSS_FILENAME).read_text() == expected
+    assert (out_dir / (CSS_FILENAME + ".bak")).read_text() == outdated
+
+
+def test_current_css_kept(export):
+    out_dir = export()
+    custom = (out_dir / CSS_FILENAME).read_text() + "body { color: red; }\n"
+    (out_dir / CSS_FILENAME).write_text(custom)
+
+    export("--resume")
+    assert (out_dir / CSS_FILENAME).read_text() == custom
+    assert not (out_dir / (CSS_FILENAME + ".bak")).exists()
@@ -0,0 +1,94 @@
+# ------------------------------------------------------------------------------
+#  vkimexp [VK dialogs exporter]
+#  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
+# ------------------------------------------------------------------------------
+
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import pytest
+
+from vkimexp.ratelimit import RateLimiter
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr("vkimexp.ratelimit.time", clock)
+    return clock
+
+
+@pytest.fixture
+def limiter(clock) -> RateLimiter:
+    return RateLimiter()
+
+
+def test_reserve_paces_requests(limiter, clock):
+    rate = limiter.rate
+    assert limiter.reserve() == 0
+    assert limiter.reserve() == pytest.approx(1 / rate)
+    assert limiter.reserve() == pytest.approx(2 / rate)
+
+    clock.now += 10  # bucket holds one token at most
+    assert limiter.reserve() == 0
+    assert limiter.reserve() == pytest.approx(1 / rate)
+
+
+def test_success_speeds_up(limiter):
+    for _ in range(10000):
+        assert limiter.on_response(0, 200, 0.1) is None
+    assert limiter.rate == RateLimiter.MAX_RATE
+
+
+def test_slow_response_slows_down(limiter):
+    assert limiter.on_response(0, 200, RateLimiter.SLOW_LATENCY_SEC + 1) is None
+    assert limiter.rate == RateLimiter.INITIAL_RATE / 2
+
+    for _ in range(100):
+        limiter.on_response(0, 200, RateLimiter.SLOW_LATENCY_SEC + 1)
+    assert limiter.rate == RateLimiter.MIN_RATE
+
+
+@pytest.mark.parametrize("status", [400, 403, 404])
+def test_no_retry_on_client_errors(limiter, status: int):
+    assert limiter.on_response(0, status, 0.1) is None
+    assert limiter.rate == RateLimiter.INITIAL_RATE
+
+
+@pytest.mark.parametrize("status", [None, 500, 502, 504])
+def test_retry_with_backoff(limiter, status: int | None):
+    for attempt in range(RateLimiter.MAX_RETRIES):
+        delay = limiter.on_response(attempt, status, 0.1)
+        assert 0 <= delay <= RateLimiter.BACKOFF_BASE_SEC * 2**attempt
+    assert limiter.on_response(RateLimiter.MAX_RETRIES, status, 0.1) is None
+    assert limiter.rate == RateLimiter.INITIAL_RATE
+
+
+@pytest.mark.parametrize("status", [429, 503])
+def test_throttling(limiter, status: int):
+    assert limiter.on_response(0, status, 0.1) is not None
+    assert limiter.rate == RateLimiter.INITIAL_RATE / 2
+
+
+@pytest.mark.parametrize("http_date", [False, True])
+def test_retry_after_pauses_bucket(limiter, http_date: bool):
+    retry_after = "30"
+    if http_date:
+        retry_after = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=31), usegmt=True)
+    delay = limiter.on_response(0, 429, 0.1, retry_after)
+    assert delay == pytest.approx(30, abs=1.5)
+    assert limiter.reserve() >= delay  # for every request, not just the retried one
+
+
+def test_invalid_retry_after(limiter):
+    delay = limiter.on_response(0, 429, 0.1, "soon")
+    assert delay <= RateLimiter.BACKOFF_BASE_SEC
+    assert limiter.reserve() == 0
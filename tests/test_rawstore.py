@@ -0,0 +1,120 @@
+# ------------------------------------------------------------------------------
+#  vkimexp [VK dialogs exporter]
+#  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
+# ------------------------------------------------------------------------------
+
+import os
+import pickle
+import random
+from pathlib import Path
+
+import pytest
+
+from vkimexp.rawstore import RawBlob, SegmentStore
+
+
+def make_content(seed: int, size: int = 5000) -> str:
+    rnd = random.Random(seed)
+    return "".join(rnd.choice("абвгд abcde\n{}\"") for _ in range(size))
+
+
+def reopen(store: SegmentStore, path: Path) -> SegmentStore:
+    store.close()
+    return SegmentStore(path)
+
+
+def test_round_trip(tmp_path):
+    store = SegmentStore(tmp_path)
+    assert not SegmentStore.exists(tmp_path)
+    for n in range(10):
+        assert store.put(f"blob{n}", make_content(n))
+    assert SegmentStore.exists(tmp_path)
+
+    store = reopen(store, tmp_path)
+    assert [*store] == [f"blob{n}" for n in range(10)]
+    for n in range(10):
+        blob = store.get(f"blob{n}")
+        assert blob.read() == make_content(n)
+        assert blob.size == len(make_content(n).encode())
+    assert "blob10" not in store
+    assert store.get("blob10") is None
+    store.close()
+
+
+def test_blobs_are_not_overwritten(tmp_path):
+    store = SegmentStore(tmp_path)
+    assert store.put("blob", "first")
+    assert not store.put("blob", "second")
+    store = reopen(store, tmp_path)
+    assert not store.put("blob", "third")
+    assert store.get("blob").read() == "first"
+    store.close()
+
+
+def test_append_after_reopen(tmp_path):
+    store = SegmentStore(tmp_path)
+    store.put("blob0", make_content(0))
+    store = reopen(store, tmp_path)
+    store.put("blob1", make_content(1))
+    store = reopen(store, tmp_path)
+    assert store.get("blob0").read() == make_content(0)
+    assert store.get("blob1").read() == make_content(1)
+    store.close()
+
+
+def test_segment_rollover(tmp_path, monkeypatch):
+    monkeypatch.setattr(SegmentStore, "SEGMENT_MAX_SIZE", 10000)
+    store = SegmentStore(tmp_path)
+    for n in range(20):
+        store.put(f"blob{n}", make_content(n))
+    store = reopen(store, tmp_path)
+    store.put("blob20", make_content(20))
+    store.close()
+
+    segments = sorted(tmp_path.glob("segment.*.z"))
+    assert len(segments) > 2
+    assert all(os.path.getsize(path) <= SegmentStore.SEGMENT_MAX_SIZE for path in segments)
+    store = SegmentStore(tmp_path)
+    for n in range(21):
+        assert store.get(f"blob{n}").read() == make_content(n)
+    assert store.get("blob20").path == segments[-1]
+    store.close()
+
+
+def test_interrupted_index_write(tmp_path):
+    store = SegmentStore(tmp_path)
+    store.put("blob0", make_content(0))
+    store.put("blob1", make_content(1))
+    store.close()
+    index_path = tmp_path / SegmentStore.INDEX_FILENAME
+    index = index_path.read_text()
+    index_path.write_text(index[: index.rindex("\t")])  # torn last line
+
+    store = SegmentStore(tmp_path)
+    assert [*store] == ["blob0"]
+    assert store.put("blob1", "again")
+    assert store.put("blob2", make_content(2))
+    store = reopen(store, tmp_path)
+    assert store.get("blob0").read() == make_content(0)
+    assert store.get("blob1").read() == "again"
+    assert store.get("blob2").read() == make_content(2)
+    store.close()
+
+
+def test_damaged_record(tmp_path):
+    store = SegmentStore(tmp_path)
+    store.put("blob", make_content(0))
+    store.close()
+    blob = SegmentStore(tmp_path).get("blob")
+    with open(blob.path, "r+b") as f:
+        f.seek(blob.pos + 10)
+        f.write(b"\xff" * 20)
+    with pytest.raises(ValueError):
+        blob.read()
+
+
+def test_regular_file_blob(tmp_path):
+    path = tmp_path / "response.json"
+    path.write_text(make_content(0))
+    blob = RawBlob(path, os.path.getsize(path))
+    assert pickle.loads(pickle.dumps(blob)).read() == make_content(0)  # passed to replay processes
@@ -0,0 +1,50 @@
+# ------------------------------------------------------------------------------
+#  vkimexp [VK dialogs exporter]
+#  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
+# ------------------------------------------------------------------------------
+
+from pathlib import Path
+
+import pytest
+
+from conftest import read_index_msg_idxs
+from fakevk import FakeVkConfig
+from vkimexp.checkpoint import Checkpoint
+
+ALL_MSG_IDXS = list(range(1, 351))
+
+
+def read_output(out_dir: Path) -> dict[str, bytes]:
+    return {
+        str(path.relative_to(out_dir)): path.read_bytes()
+        for path in out_dir.rglob("*")
+        if path.is_file() and path.parts[len(out_dir.parts)] != "raw"
+    }
+
+
+@pytest.mark.parametrize("export_args", [[], ["--json-lines", "--raw-format", "segments"]])
+def test_replay_same_output(export, replay, fakevk, export_args: list[str]):
+    fakevk.config = FakeVkConfig(messages=350, photo_density=0.05, image_density=0.05, audio_density=0.05)
+    out_dir = export("-d", "4", *export_args)
+    expected = read_output(out_dir)
+
+    replay(*(arg for arg in export_args if arg == "--json-lines"))
+    output = read_output(out_dir)
+    assert output.keys() == expected.keys()
+    for rel_path, content in expected.items():
+        assert output[rel_path] == content, rel_path
+
+
+def test_replay_keeps_checkpoint(export, replay, fakevk):
+    fakevk.failing_offsets = {130}
+    out_dir = export()
+    checkpoint = (out_dir / Checkpoint.FILENAME).read_bytes()
+    index = (out_dir / "index.txt").read_bytes()
+
+    replay()
+    assert (out_dir / Checkpoint.FILENAME).read_bytes() == checkpoint
+    assert (out_dir / "index.txt").read_bytes() == index
+
+    fakevk.failing_offsets = set()
+    export("--resume")
+    assert read_index_msg_idxs(out_dir) == ALL_MSG_IDXS
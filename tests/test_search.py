@@ -0,0 +1,94 @@
+# ------------------------------------------------------------------------------
+#  vkimexp [VK dialogs exporter]
+#  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
+# ------------------------------------------------------------------------------
+
+import json
+import sqlite3
+
+import pytest
+
+from conftest import PEER_ID
+from fakevk import FIRST_MSG_ID, FIRST_TS, FakeVkConfig
+from vkimexp.cli import search_entrypoint
+from vkimexp.common import Context
+from vkimexp.search import search
+
+
+def read_rows(db_path) -> list[tuple]:
+    with sqlite3.connect(db_path) as conn:
+        return conn.execute("SELECT peer_id, msg_idx, msg_id, text FROM messages ORDER BY msg_idx").fetchall()
+
+
+def search_idxs(query: str, **kwargs) -> list[int]:
+    return [result.msg_idx for result in search(Context.get_db_path(), query, **kwargs)]
+
+
+def expected_rows(count: int) -> list[tuple]:
+    return [(PEER_ID, idx, FIRST_MSG_ID + idx, f"Message number {idx}") for idx in range(1, count + 1)]
+
+
+def test_upsert_on_resume_and_sync(export, fakevk):
+    fakevk.failing_offsets = {130}
+    export("--sqlite")
+    assert 0 < len(read_rows(Context.get_db_path())) < 350
+
+    fakevk.failing_offsets = set()
+    export("--sqlite", "--resume")
+    assert read_rows(Context.get_db_path()) == expected_rows(350)
+    export("--sqlite")  # starts over
+    assert read_rows(Context.get_db_path()) == expected_rows(350)
+
+    fakevk.config = FakeVkConfig(messages=420, photo_density=0, image_density=0, audio_density=0)
+    export("--sqlite", "--sync")
+    assert read_rows(Context.get_db_path()) == expected_rows(420)
+    assert search_idxs("number") == list(range(420, 0, -1))  # no stale FTS rows
+
+
+def test_fts_in_sync_after_update(export):
+    export("--sqlite")
+    with sqlite3.connect(Context.get_db_path()) as conn:
+        conn.execute("UPDATE messages SET text = 'edited text' WHERE msg_idx = 42")
+    assert search_idxs("42") == []
+    assert search_idxs("edited") == [42]
+    assert len(search_idxs("number")) == 349
+
+    export("--sqlite")  # restores the original texts
+    assert search_idxs("42") == [42]
+    assert search_idxs("edited") == []
+    assert len(search_idxs("number")) == 350
+    with sqlite3.connect(Context.get_db_path()) as conn:
+        conn.execute("INSERT INTO messages_fts (messages_fts, rank) VALUES ('integrity-check', 1)")
+
+
+def test_search(export):
+    export("--sqlite")
+    db_path = Context.get_db_path()
+
+    [result] = search(db_path, "42", highlight=("[", "]"))
+    assert (result.peer_id, result.msg_idx, result.msg_id) == (PEER_ID, 42, FIRST_MSG_ID + 42)
+    assert (result.ts, result.inbox) == (FIRST_TS + 42 * 60, True)
+    assert (result.from_peer_id, result.from_name) == (102, "User 102")
+    assert result.text == "Message number [42]"
+
+    assert search_idxs("7*") == [79, 78, 77, 76, 75, 74, 73, 72, 71, 70, 7]
+    assert search_idxs("10 OR 20") == [20, 10]
+    assert search_idxs("number NOT 1", limit=3) == [350, 349, 348]
+    assert search_idxs(None, from_peer_ids=[103], limit=3) == [348, 343, 338]
+    assert search_idxs(None, since_ts=FIRST_TS + 100 * 60, until_ts=FIRST_TS + 103 * 60) == [102, 101, 100]
+    assert search_idxs("number", peer_ids=[PEER_ID + 1]) == []
+    assert search_idxs("number", with_attachments=True) == []
+    with pytest.raises(ValueError):
+        search(db_path, '"unterminated')
+
+
+def test_search_command(export, capsys):
+    export("--sqlite")
+    capsys.readouterr()
+    search_entrypoint(["--json", "--peer", "c1", "number", "-n", "2"], standalone_mode=False)
+    results = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [r["msg_idx"] for r in results] == [350, 349]
+    assert results[0]["text"] == "Message number 350"
+
+    search_entrypoint(["42"], standalone_mode=False)
+    assert "(42)" in capsys.readouterr().out
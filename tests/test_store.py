@@ -0,0 +1,100 @@
+# ------------------------------------------------------------------------------
+#  vkimexp [VK dialogs exporter]
+#  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
+# ------------------------------------------------------------------------------
+
+import os
+from pathlib import Path
+
+import pytest
+
+from vkimexp.store import ContentStore
+
+
+@pytest.fixture
+def root(tmp_path: Path) -> Path:
+    return tmp_path / ContentStore.DIRNAME
+
+
+def make_part(tmp_path: Path, content: bytes) -> Path:
+    path = tmp_path / "download.part"
+    path.write_bytes(content)
+    return path
+
+
+def make_local_path(tmp_path: Path, peer: str, name: str) -> Path:
+    path = tmp_path / peer / "photo" / name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def list_objects(root: Path) -> list[Path]:
+    return [p for p in root.glob("*/*/*") if p.is_file()]
+
+
+def test_put_and_link(tmp_path, root):
+    store = ContentStore(root)
+    local_path = make_local_path(tmp_path, "1", "a.jpg")
+    assert not store.link("https://vk.test/a.jpg", local_path)
+
+    part_path = make_part(tmp_path, b"content")
+    store.put("https://vk.test/a.jpg", part_path, local_path)
+    assert not part_path.exists()
+    assert local_path.read_bytes() == b"content"
+
+    other_path = make_local_path(tmp_path, "2", "a.jpg")
+    assert store.link("https://vk.test/a.jpg", other_path)
+    assert other_path.read_bytes() == b"content"
+    assert os.path.samefile(local_path, other_path)
+    assert len(list_objects(root)) == 1
+
+
+def test_same_content_stored_once(tmp_path, root):
+    store = ContentStore(root)
+    for n in range(3):
+        local_path = make_local_path(tmp_path, "1", f"{n}.jpg")
+        store.put(f"https://vk.test/{n}.jpg", make_part(tmp_path, b"content"), local_path)
+    store.put("https://vk.test/other.jpg", make_part(tmp_path, b"other"), make_local_path(tmp_path, "1", "other.jpg"))
+    assert len(list_objects(root)) == 2
+
+
+def test_index_reloaded(tmp_path, root):
+    store = ContentStore(root)
+    store.put("https://vk.test/a.jpg", make_part(tmp_path, b"content"), make_local_path(tmp_path, "1", "a.jpg"))
+    store.put("https://vk.test/a.jpg", make_part(tmp_path, b"content"), make_local_path(tmp_path, "1", "b.jpg"))
+    with open(root / ContentStore.INDEX_FILENAME) as f:
+        assert len(f.readlines()) == 1
+
+    store = ContentStore(root)
+    assert store.link("https://vk.test/a.jpg", make_local_path(tmp_path, "2", "a.jpg"))
+    assert not store.link("https://vk.test/b.jpg", make_local_path(tmp_path, "2", "b.jpg"))
+
+
+def test_missing_object(tmp_path, root):
+    store = ContentStore(root)
+    store.put("https://vk.test/a.jpg", make_part(tmp_path, b"content"), make_local_path(tmp_path, "1", "a.jpg"))
+    for path in list_objects(root):
+        path.unlink()
+    assert not store.link("https://vk.test/a.jpg", make_local_path(tmp_path, "2", "a.jpg"))
+
+
+@pytest.mark.parametrize("symlinks", [True, False])
+def test_link_fallbacks(tmp_path, root, monkeypatch, symlinks: bool):
+    def fail(*args):
+        raise OSError("Cross-device link")
+
+    monkeypatch.setattr("vkimexp.store.os.link", fail)
+    if not symlinks:
+        monkeypatch.setattr("vkimexp.store.os.symlink", fail)
+
+    store = ContentStore(root)
+    local_path = make_local_path(tmp_path, "1", "a.jpg")
+    store.put("https://vk.test/a.jpg", make_part(tmp_path, b"content"), local_path)
+    assert local_path.is_symlink() == symlinks
+    assert local_path.read_bytes() == b"content"
+    assert store.link("https://vk.test/a.jpg", local_path)  # already linked
+
+
+def test_shared_instance(root, monkeypatch):
+    monkeypatch.setattr(ContentStore, "_instances", dict())
+    assert ContentStore.get_instance(root) is ContentStore.get_instance(root)
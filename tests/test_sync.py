@@ -0,0 +1,63 @@
+# ------------------------------------------------------------------------------
+#  vkimexp [VK dialogs exporter]
+#  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
+# ------------------------------------------------------------------------------
+
+import json
+
+import pytest
+
+from conftest import read_index_msg_idxs
+from fakevk import FakeVkConfig
+from vkimexp.writer import JsonWriter
+
+
+def read_json_msgs(path) -> list[dict]:
+    if path.suffix == ".jsonl":
+        return [json.loads(line) for line in path.read_text().splitlines()]
+    return json.loads(path.read_text())
+
+
+@pytest.mark.parametrize("filename, export_args", [("index.json", []), ("index.jsonl", ["--json-lines"])])
+def test_sync_appends_new_messages(export, fakevk, monkeypatch, filename: str, export_args: list[str]):
+    out_dir = export(*export_args)
+    prev_content = (out_dir / filename).read_bytes()
+    prev_index = (out_dir / "index.txt").read_bytes()
+
+    fakevk.config = FakeVkConfig(messages=420, photo_density=0, image_density=0, audio_density=0)
+    monkeypatch.setattr(JsonWriter, "READ_SIZE", 7)  # messages are split between the reads
+    export("--sync", *export_args)
+
+    msgs = read_json_msgs(out_dir / filename)
+    assert [msg["msg_idx"] for msg in msgs] == list(range(1, 421))
+    assert len({msg["msg_id"] for msg in msgs}) == 420
+    assert read_index_msg_idxs(out_dir) == list(range(1, 421))
+    assert (out_dir / "index.txt").read_bytes().startswith(prev_index)
+    if not export_args:
+        prev_content = prev_content.removesuffix(b"\n]")
+    assert (out_dir / filename).read_bytes().startswith(prev_content)
+
+
+def test_sync_without_new_messages(export, fakevk):
+    out_dir = export()
+    prev_content = (out_dir / "index.json").read_bytes()
+    export("--sync")
+    assert (out_dir / "index.json").read_bytes() == prev_content
+    assert read_index_msg_idxs(out_dir) == list(range(1, 351))
+
+
+def test_sync_damaged_output(export, fakevk, caplog):
+    out_dir = export()
+    content = (out_dir / "index.json").read_bytes()
+    (out_dir / "index.json").write_bytes(content[: len(content) // 2])
+    export("--sync")
+    assert "output seems to be damaged" in caplog.text
+    assert (out_dir / "index.json").read_bytes() == content[: len(content) // 2]
+
+
+def test_sync_reformatted_output(export, fakevk):
+    out_dir = export()
+    expected = (out_dir / "index.json").read_text()
+    (out_dir / "index.json").write_text(json.dumps(json.loads(expected), ensure_ascii=False))  # e.g. by another tool
+    export("--sync")
+    assert (out_dir / "index.json").read_text() == expected
@@ -0,0 +1,61 @@
+# ------------------------------------------------------------------------------
+#  vkimexp [VK dialogs exporter]
+#  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
+# ------------------------------------------------------------------------------
+
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+from vkimexp.transport import Transport
+
+
+@pytest.fixture
+def closed(monkeypatch) -> list[requests.Session]:
+    closed = []
+    close = requests.Session.close
+
+    def _close(self):
+        closed.append(self)
+        close(self)
+
+    monkeypatch.setattr(requests.Session, "close", _close)
+    return closed
+
+
+def make_transport(pool_size: int) -> Transport:
+    ctx = SimpleNamespace(pool_size=pool_size, host_conns=2, keep_alive=True, peer_id=1)
+    return Transport(ctx, {})
+
+
+def get_content(transport: Transport, url: str) -> bytes:
+    with transport.get(url) as response:
+        return response.content
+
+
+def test_session_per_host(fakevk, closed):
+    transport = make_transport(pool_size=2)
+    localhost_url = fakevk.base_url.replace("127.0.0.1", "localhost")
+    for _ in range(3):
+        for base_url in [fakevk.base_url, localhost_url]:
+            assert get_content(transport, base_url + "/cdn/image/a.png") == fakevk.make_attachment("/cdn/image/a.png")
+    assert not closed
+    transport.close()
+    assert len(closed) == 2
+
+
+def test_evicted_session_in_use(fakevk, closed):
+    transport = make_transport(pool_size=1)
+    path = "/cdn/audiomsg/voice.mp3"
+    with transport.get(fakevk.base_url + path, stream=True) as response:
+        # session of the first host is evicted by the second one
+        get_content(transport, fakevk.base_url.replace("127.0.0.1", "localhost") + path)
+        assert not closed
+        assert response.raw.read() == fakevk.make_attachment(path)
+    assert len(closed) == 1
+
+    get_content(transport, fakevk.base_url + path)  # evicts the second one, which is idle
+    assert len(closed) == 2
+    transport.close()
+    assert len(closed) == 3
@@ -3,11 +3,22 @@
 #  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
 # ------------------------------------------------------------------------------
 
-from vkimexp.cli import entrypoint
+import sys
+
+from vkimexp.cli import entrypoint, replay_entrypoint, search_entrypoint
+
+SUBCOMMANDS = {
+    "replay": replay_entrypoint,
+    "search": search_entrypoint,
+}
 
 
 def main():
-    entrypoint()
+    # not a click group, as it would make 'vkimexp PEER' ambiguous
+    if subcommand := SUBCOMMANDS.get(sys.argv[1] if len(sys.argv) > 1 else None):
+        subcommand(sys.argv[2:], prog_name=f"vkimexp {sys.argv[1]}")
+    else:
+        entrypoint()
 
 
 if __name__ == "__main__":
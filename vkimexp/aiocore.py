@@ -0,0 +1,360 @@
+# ------------------------------------------------------------------------------
+#  vkimexp [VK dialogs exporter]
+#  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
+# ------------------------------------------------------------------------------
+
+import asyncio
+import json
+import time
+import typing as t
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextlib import aclosing
+from pathlib import Path
+from threading import BoundedSemaphore, Lock
+
+import aiohttp
+from urllib3.util import parse_url
+
+from .common import URL, HOST, Context, AttachmentEventTypeEnum, AuthError, DownloadError, get_logger
+from .core import Task
+from .fetcher import ImData, PageResult
+from .handler import AttachmentHandler, DownloadQueue, PartialDownload
+from .transport import Transport
+
+
+class AsyncDownloadQueue(DownloadQueue):
+    """
+    Download queue which runs attachment requests as coroutines in the event
+    loop of the task. Can be fed from any thread; per-host concurrency is limited
+    with semaphores, total amount of pending downloads -- with `download_jobs`.
+    Response bodies are collected in memory and written by large blocks, so that
+    file system is accessed only a few times per download. As file I/O is still
+    blocking, it's performed by a small pool of its own (one thread per download
+    job), instead of the default executor, which is busy with page processing.
+    """
+
+    _WRITE_SIZE = 16 * PartialDownload.CHUNK_SIZE
+
+    def __init__(self, ctx: Context):
+        self._ctx = ctx
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._session: aiohttp.ClientSession | None = None
+        self._io_executor: ThreadPoolExecutor | None = None
+        self._host_sems: dict[str, asyncio.Semaphore] = dict()
+        self._slots = BoundedSemaphore(max(1, ctx.download_jobs) * self._PENDING_PER_WORKER)
+        self._futures: set[Future] = set()
+        self._lock = Lock()
+
+    def start(self, session: aiohttp.ClientSession):
+        self._loop = asyncio.get_running_loop()
+        self._session = session
+        self._io_executor = ThreadPoolExecutor(max(1, self._ctx.download_jobs), thread_name_prefix="download-io")
+
+    def submit(
+        self,
+        hdlr: AttachmentHandler,
+        idx: int,
+        urls: list[str],
+        local_abs_path: Path,
+        attachment_event_cb: callable,
+        event_type: AttachmentEventTypeEnum = AttachmentEventTypeEnum.STARTED,
+    ):
+        offset = self._ctx.offset
+        attachment_event_cb(hdlr, idx, event_type, urls[0], offset=offset)
+
+        self._slots.acquire()
+        coro = self._run(hdlr, idx, urls, local_abs_path, attachment_event_cb, offset)
+        future = asyncio.run_coroutine_threadsafe(coro, self._loop)
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._release)
+
+    async def join_async(self):
+        while True:
+            with self._lock:
+                futures = [asyncio.wrap_future(f) for f in self._futures]
+            if not futures:
+                return
+            await asyncio.wait(futures)
+
+    def close(self):
+        with self._lock:
+            futures = [*self._futures]
+        if self._loop and not self._loop.is_closed():
+            wait(futures)
+        else:
+            for future in futures:
+                future.cancel()
+        if self._io_executor:
+            self._io_executor.shutdown()
+
+    async def _run(
+        self,
+        hdlr: AttachmentHandler,
+        idx: int,
+        urls: list[str],
+        local_abs_path: Path,
+        attachment_event_cb: callable,
+        offset: int,
+    ):
+        last_error = None
+        for url in urls:
+            try:
+                with self._ctx.metrics.measure("download." + hdlr.get_type()):
+                    await self._download(hdlr, urls, url, local_abs_path)
+            except Exception as e:
+                last_error = e
+                continue
+            attachment_event_cb(hdlr, idx, AttachmentEventTypeEnum.SUCCESS, local_abs_path, offset=offset)
+            return
+
+        hdlr.forget(urls, local_abs_path, last_error)
+        attachment_event_cb(hdlr, idx, AttachmentEventTypeEnum.FAILED, last_error, offset=offset)
+
+    async def _download(self, hdlr: AttachmentHandler, urls: list[str], url: str, local_abs_path: Path):
+        if not (part := await self._run_io(self._prepare, hdlr, urls, url, local_abs_path)):
+            return
+        abs_url = url
+        if not (host := parse_url(url).host):
+            abs_url = HOST + url
+            host = parse_url(abs_url).host
+
+        self._ctx.totals.attach_found.increment()
+        async with self._get_host_semaphore(host):
+            while True:
+                async with self._session.get(abs_url, headers=part.get_request_headers()) as response:
+                    if part.is_stale(response.status):
+                        await self._run_io(part.discard)
+                        continue
+                    if not response.ok:
+                        await self._run_io(hdlr.raise_download_error, url, response.status, part)
+
+                    await self._run_io(part.begin, response.status, response.headers)
+                    buffer = bytearray()
+                    try:
+                        async for chunk in response.content.iter_any():
+                            buffer += chunk
+                            self._ctx.metrics.count("downloaded_bytes", len(chunk), type=hdlr.get_type())
+                            if len(buffer) >= self._WRITE_SIZE:
+                                await self._run_io(part.write, buffer)
+                                buffer.clear()
+                    except BaseException:
+                        # keep everything received for the next attempt (synchronously, as the task can be cancelled)
+                        part.write(buffer)
+                        part.abort()
+                        raise
+                    try:
+                        await self._run_io(self._complete, hdlr, urls, url, part, buffer, local_abs_path)
+                    except BaseException:
+                        part.abort()
+                        raise
+                break
+
+        self._ctx.totals.attach_downloaded.increment()
+
+    async def _run_io(self, fn: t.Callable, *args) -> t.Any:
+        return await self._loop.run_in_executor(self._io_executor, fn, *args)
+
+    def _prepare(
+        self, hdlr: AttachmentHandler, urls: list[str], url: str, local_abs_path: Path
+    ) -> PartialDownload | None:
+        """
+        Runs in I/O thread.
+
+        :return: None if the attachment is present already.
+        """
+        if hdlr.restore(url, local_abs_path):
+            hdlr.remember(urls, local_abs_path)
+            return None
+        return PartialDownload(url, local_abs_path)
+
+    def _complete(
+        self,
+        hdlr: AttachmentHandler,
+        urls: list[str],
+        url: str,
+        part: PartialDownload,
+        tail: bytes | bytearray,
+        local_abs_path: Path,
+    ):
+        """
+        Runs in I/O thread.
+        """
+        part.write(tail)
+        part.finish()
+        hdlr.save(url, part.path, local_abs_path)
+        hdlr.remember(urls, local_abs_path)
+
+    def _get_host_semaphore(self, host: str) -> asyncio.Semaphore:
+        if host not in self._host_sems:
+            self._host_sems[host] = asyncio.Semaphore(self._ctx.host_conns)
+        return self._host_sems[host]
+
+    def _release(self, future: Future):
+        with self._lock:
+            self._futures.discard(future)
+        self._slots.release()
+
+
+class AsyncPageFetcher:
+    """
+    Same as `ConcurrentPageFetcher`, but with coroutines instead of threads.
+    """
+
+    def __init__(self, fetch_fn: t.Callable[[int], t.Awaitable[ImData]], jobs: int, window: int):
+        self._fetch_fn = fetch_fn
+        self._jobs = jobs
+        self._window = max(jobs, window)
+
+    async def iter_pages(self, pages: t.Iterable[tuple[int, int]]) -> t.AsyncIterator[PageResult]:
+        jobs = asyncio.Semaphore(self._jobs)
+        pending = deque[tuple[int, int, asyncio.Task]]()
+        pages = iter(pages)
+
+        async def fetch(offset: int) -> ImData | Exception:
+            async with jobs:
+                try:
+                    return await self._fetch_fn(offset)
+                except Exception as e:
+                    return e
+
+        try:
+            while True:
+                while len(pending) < self._window and (next_page := next(pages, None)):
+                    page, offset = next_page
+                    pending.append((page, offset, asyncio.create_task(fetch(offset))))
+                if not pending:
+                    break
+                page, offset, task = pending.popleft()
+                yield page, offset, await task
+        finally:
+            for _, _, task in pending:
+                task.cancel()
+            await asyncio.gather(*(task for _, _, task in pending), return_exceptions=True)
+
+
+class AsyncTask(Task):
+    """
+    Asyncio flavor of `Task`. History pages and attachments are requested with
+    aiohttp, whereas parsing and writing (CPU-heavy and blocking parts) are
+    offloaded to executor threads. Output layout is exactly the same. Threaded
+    counterparts of the network parts (`requests` transport, download workers,
+    page fetching threads) are not created at all.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._api_session: aiohttp.ClientSession | None = None
+        self._api_cookies: dict = self._auth.cookies
+        self._api_auth_lock = asyncio.Lock()
+
+    def _make_transport(self) -> None:
+        return None
+
+    def _make_download_queue(self) -> AsyncDownloadQueue:
+        return AsyncDownloadQueue(self._ctx)
+
+    def _make_page_fetcher(self) -> AsyncPageFetcher:
+        jobs = self._ctx.fetch_jobs
+        return AsyncPageFetcher(self._fetch_im_data_async, jobs, jobs + self._ctx.prefetch)
+
+    async def run_async(self) -> bool:
+        get_logger().info(f"Starting to process PEER {self._ctx.peer_id} (asyncio)")
+
+        connector = aiohttp.TCPConnector(
+            limit=self._ctx.pool_size * self._ctx.host_conns,
+            limit_per_host=self._ctx.host_conns,
+            force_close=not self._ctx.keep_alive,
+        )
+        api_session = aiohttp.ClientSession(
+            connector=connector,
+            headers={**Transport.API_HEADERS, "referer": f"https://vk.com/im?sel={self._ctx.peer_id}"},
+            cookies=self._api_cookies,
+        )
+        cdn_session = aiohttp.ClientSession(connector=connector, connector_owner=False)
+
+        async with api_session, cdn_session:
+            self._api_session = api_session
+            self._download_queue.start(cdn_session)
+
+            try:
+                max_page = await asyncio.to_thread(self._start, await self._fetch_im_data_async(first=True))
+            except RuntimeError as e:
+                get_logger().error(e)
+                return False
+
+            if self._sync_max_msg_idx is not None:
+                collected = []
+                async with aclosing(self._page_fetcher.iter_pages(self._iter_new_offsets(max_page))) as results:
+                    async for result in results:
+                        collected.append(result)
+                        if self._is_synced(result[2]):
+                            break
+                for page, offset, im_data in reversed(collected):
+                    await asyncio.to_thread(self._consume_page, page, offset, im_data)
+            else:
+                async for page, offset, im_data in self._page_fetcher.iter_pages(self._iter_offsets(max_page)):
+                    await asyncio.to_thread(self._consume_page, page, offset, im_data)
+
+            await self._download_queue.join_async()
+            await asyncio.to_thread(self._finish)
+        return True
+
+    async def _fetch_im_data_async(self, offset: int = 0, first: bool = False) -> ImData:
+        cookies = self._api_cookies
+        try:
+            return await self._request_im_data_async(offset, first)
+        except AuthError as e:
+            get_logger().warning(f"Request at offset {offset} failed: {e}")
+            if not await self._refresh_auth_async(cookies):
+                raise
+        return await self._request_im_data_async(offset, first)
+
+    async def _refresh_auth_async(self, cookies: dict) -> bool:
+        """
+        Same as `_refresh_auth()`, but for the API session of the task.
+        """
+        async with self._api_auth_lock:
+            if cookies is not self._api_cookies:
+                return True  # already refreshed by another coroutine
+            if not await asyncio.to_thread(self._auth.refresh):
+                return False
+            self._api_cookies = self._auth.cookies
+            self._api_session.cookie_jar.clear()
+            self._api_session.cookie_jar.update_cookies(self._api_cookies)
+            return True
+
+    async def _request_im_data_async(self, offset: int, first: bool) -> ImData:
+        params = self._make_im_params(offset)
+        if first:
+            get_logger().debug(params)
+
+        attempt = 0
+        with self._ctx.metrics.measure("fetch"):  # including the waiting for the rate limiter
+            while True:
+                await asyncio.sleep(self._ctx.limiter.reserve())
+                started_ts = time.monotonic()
+                try:
+                    async with self._api_session.get(URL, params=params) as response:
+                        status, retry_after, error = response.status, response.headers.get("retry-after"), None
+                        body = await response.read()
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    status, retry_after, error = None, None, e
+
+                latency = time.monotonic() - started_ts
+                if (delay := self._ctx.limiter.on_response(attempt, status, latency, retry_after)) is None:
+                    break
+                self._log_retry(offset, status or error, delay)
+                await asyncio.sleep(delay)
+                attempt += 1
+
+        if error:
+            raise RuntimeError(f"Failed to get IM data: {error}") from error
+        if not response.ok:
+            raise RuntimeError(f"Failed to get IM data (HTTP {response.status})")
+        get_logger().debug(f"GET {URL}: HTTP {response.status}")
+
+        self._ctx.metrics.count("fetched_bytes", len(body))
+        text = body.decode(response.get_encoding())
+        return self._read_im_payload(json.loads(text), len(text))
@@ -3,49 +3,165 @@
 #  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
 # ------------------------------------------------------------------------------
 
+import json
 import logging
+import os
 import random
-
-import browser_cookie3
-import yt_dlp
+import tempfile
+import time
+from pathlib import Path
+from threading import Lock
 
 from .common import URL, get_logger, DOMAIN, Context
 
+# same as `yt_dlp.cookies.SUPPORTED_BROWSERS`; yt-dlp is imported only when
+# the cookies are actually extracted, as it takes a while
+SUPPORTED_BROWSERS = ["brave", "chrome", "chromium", "edge", "firefox", "opera", "safari", "vivaldi", "whale"]
 
-class Auth:
-    def __init__(self, ctx: Context):
-        self._cookies = {}
-        self._extract_fns: list[callable] = [
+
+class CookieProvider:
+    """
+    Process-wide source of browser cookies. Extraction (which involves cookie DB
+    decryption and can trigger keyring prompts) is performed once and its results
+    are shared by all tasks and attempts, until they are invalidated because of
+    an authentication failure. Optionally the cookies are cached on disk (with
+    owner-only permissions), so that subsequent runs can skip extraction, too.
+    """
+
+    _instances: dict[str, "CookieProvider"] = dict()
+    _instances_lock = Lock()
+
+    @classmethod
+    def get_instance(cls, browser: str) -> "CookieProvider":
+        with cls._instances_lock:
+            if browser not in cls._instances:
+                cls._instances[browser] = CookieProvider(browser)
+            return cls._instances[browser]
+
+    def __init__(self, browser: str):
+        self._browser = browser
+        self._cookies: dict = {}
+        self._lock = Lock()
+
+    def get_cookies(self, ctx: Context) -> dict:
+        with self._lock:
+            if not self._cookies:
+                self._cookies = self._load(ctx.cookies_ttl)
+            if not self._cookies:
+                self._cookies = self._extract(ctx)
+                if self._cookies and ctx.cookies_ttl:
+                    self._save()
+            return self._cookies
+
+    def invalidate(self, cookies: dict):
+        """
+        :param cookies: the ones which turned out to be invalid; if they were
+                        already replaced by another task, nothing happens.
+        """
+        with self._lock:
+            if cookies is not self._cookies:
+                return
+            get_logger().info(f"[{self._browser}] Invalidating cookies")
+            self._cookies = {}
+            self._get_cache_path().unlink(missing_ok=True)
+
+    def _extract(self, ctx: Context) -> dict:
+        cookies = {}
+        extract_fns: list[callable] = [
             self._extract_ytdlp,
             self._extract_bc3,
         ]
         if ctx.attempt > 1:
-            random.shuffle(self._extract_fns)
+            random.shuffle(extract_fns)
 
-        while len(self._extract_fns):
-            extract_fn = self._extract_fns.pop(0)
+        while len(extract_fns):
+            extract_fn = extract_fns.pop(0)
             try:
-                extract_fn(ctx.browser)
+                cookies = extract_fn(self._browser)
             except Exception as e:
                 if ctx.verbose:
                     get_logger().exception(e)
                 get_logger().error(f"Cookie extraction failed: {e}")
             else:
-                get_logger().info(f"[{ctx.browser}] Extracted {len(self._cookies)} cookies ({extract_fn.__name__})")
-                if len(self._cookies) > 0:
+                get_logger().info(f"[{self._browser}] Extracted {len(cookies)} cookies ({extract_fn.__name__})")
+                if len(cookies) > 0:
                     break
+        return cookies
+
+    def _extract_ytdlp(self, browser: str) -> dict:
+        import yt_dlp
 
-    def _extract_ytdlp(self, browser: str):
         cookiejar = yt_dlp.cookies.extract_cookies_from_browser(browser)
-        self._cookies = {c.name: c.value for c in cookiejar.get_cookies_for_url(URL)}
+        return {c.name: c.value for c in cookiejar.get_cookies_for_url(URL)}
+
+    def _extract_bc3(self, browser: str) -> dict:
+        import browser_cookie3
 
-    def _extract_bc3(self, browser: str):
         extractor = getattr(browser_cookie3, browser)
         if not extractor:
             logging.warning(f"Invalid browser: {browser!r}, falling back to default")
             extractor = browser_cookie3.chrome
         cookiejar = extractor(domain_name=DOMAIN)
-        self._cookies = {c.name: c.value for c in cookiejar}
+        return {c.name: c.value for c in cookiejar}
+
+    def _load(self, ttl_sec: int) -> dict:
+        if not ttl_sec:
+            return {}
+        try:
+            with open(self._get_cache_path(), "rt") as f:
+                cache = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            get_logger().warning(f"Failed to load cookie cache: {e}")
+            return {}
+
+        if time.time() - cache["ts"] >= ttl_sec:
+            return {}
+        get_logger().info(f"[{self._browser}] Loaded {len(cache['cookies'])} cookies from cache")
+        return cache["cookies"]
+
+    def _save(self):
+        cache_path = self._get_cache_path()
+        os.makedirs(cache_path.parent, mode=0o700, exist_ok=True)
+        fd, tmp_filename = tempfile.mkstemp(dir=cache_path.parent, prefix=cache_path.name)  # 0600
+        with os.fdopen(fd, "wt") as f:
+            json.dump({"ts": time.time(), "cookies": self._cookies}, f)
+        os.replace(tmp_filename, cache_path)  # atomic write
+
+    def _get_cache_path(self) -> Path:
+        cache_dir = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+        return Path(cache_dir) / __package__ / f"cookies.{self._browser}.json"
+
+
+class Auth:
+    def __init__(self, ctx: Context):
+        self._ctx = ctx
+        self._provider = CookieProvider.get_instance(ctx.browser)
+        self._cookies = self._provider.get_cookies(ctx)
+        self._refreshed = False
+
+    def invalidate(self):
+        """
+        Make the next task extract the cookies anew.
+        """
+        self._provider.invalidate(self._cookies)
+
+    def refresh(self) -> bool:
+        """
+        Replace the cookies which turned out to be invalid with the ones extracted
+        anew (or already refreshed by another task). It's done once only, as
+        failing again means that the browser session itself is not valid.
+
+        :return: False if the cookies can't be refreshed.
+        """
+        self.invalidate()
+        if self._refreshed:
+            return False
+        self._refreshed = True
+        self._cookies = self._provider.get_cookies(self._ctx)
+        get_logger().info(f"Refreshed cookies ({len(self._cookies)})")
+        return bool(self._cookies)
 
     @property
     def cookies(self) -> dict:
@@ -0,0 +1,110 @@
+# ------------------------------------------------------------------------------
+#  vkimexp [VK dialogs exporter]
+#  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
+# ------------------------------------------------------------------------------
+
+import enum
+import sqlite3
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from threading import Lock
+
+
+class CacheStatusEnum(enum.StrEnum):
+    OK = enum.auto()
+    FAILED = enum.auto()
+
+
+@dataclass(frozen=True)
+class CachedAttachment:
+    status: CacheStatusEnum
+    path: str | None
+    size: int | None
+    error: str | None
+    updated_ts: float
+
+
+class AttachmentCache:
+    """
+    Persistent index of attachments processed during previous runs, stored in
+    the peer's output directory (and therefore removed together with it).
+    Attachments which are known to be downloaded are not checked for existence
+    anymore, and the ones which are known to be unavailable are not requested
+    until `FAILURE_TTL_SEC` passes. Records are loaded on the first lookup; new
+    ones are written in batches.
+    """
+
+    FILENAME = "attachments.sqlite"
+    BATCH_SIZE = 100
+    FAILURE_TTL_SEC = 7 * 24 * 60 * 60
+
+    def __init__(self, out_dir: Path):
+        self._path = out_dir / self.FILENAME
+        self._conn: sqlite3.Connection | None = None
+        self._entries: dict[str, CachedAttachment] | None = None
+        self._pending: list[tuple] = []
+        self._lock = Lock()
+
+    def get(self, url: str) -> CachedAttachment | None:
+        with self._lock:
+            if self._entries is None:
+                self._entries = self._load()
+            entry = self._entries.get(url)
+        if entry and entry.status == CacheStatusEnum.FAILED:
+            if time.time() - entry.updated_ts >= self.FAILURE_TTL_SEC:
+                return None
+        return entry
+
+    def put(self, url: str, local_rel_path: Path, size: int):
+        self._put(url, CachedAttachment(CacheStatusEnum.OK, str(local_rel_path), size, None, time.time()))
+
+    def put_failed(self, url: str, error: Exception):
+        self._put(url, CachedAttachment(CacheStatusEnum.FAILED, None, None, str(error), time.time()))
+
+    def flush(self):
+        with self._lock:
+            if not self._pending:
+                return
+            with self._connect() as conn:  # one transaction per batch
+                conn.executemany(
+                    "INSERT OR REPLACE INTO attachments (url, status, path, size, error, updated_ts) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    self._pending,
+                )
+            self._pending.clear()
+
+    def close(self):
+        self.flush()
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+    def _put(self, url: str, entry: CachedAttachment):
+        with self._lock:
+            if self._entries is None:
+                self._entries = self._load()
+            self._entries[url] = entry
+            self._pending.append((url, entry.status, entry.path, entry.size, entry.error, entry.updated_ts))
+            full = len(self._pending) >= self.BATCH_SIZE
+        if full:
+            self.flush()
+
+    def _load(self) -> dict[str, CachedAttachment]:
+        cursor = self._connect().execute("SELECT url, status, path, size, error, updated_ts FROM attachments")
+        return {url: CachedAttachment(CacheStatusEnum(status), *rest) for url, status, *rest in cursor}
+
+    def _connect(self) -> sqlite3.Connection:
+        if not self._conn:
+            self._conn = sqlite3.connect(self._path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS attachments ("
+                " url TEXT PRIMARY KEY,"
+                " status TEXT NOT NULL,"
+                " path TEXT,"
+                " size INTEGER,"
+                " error TEXT,"
+                " updated_ts REAL NOT NULL"
+                ") WITHOUT ROWID"
+            )
+        return self._conn
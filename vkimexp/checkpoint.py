@@ -0,0 +1,77 @@
+# ------------------------------------------------------------------------------
+#  vkimexp [VK dialogs exporter]
+#  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
+# ------------------------------------------------------------------------------
+
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+
+from .common import Context, get_logger
+
+
+class Checkpoint:
+    """
+    Manifest of the export progress: completed offsets, writers' and dedup
+    state. Allows to continue an interrupted export by fetching only the pages
+    which were not completed (see `--resume` option) instead of starting from
+    scratch. The export is marked complete only if all the pages were fetched.
+    """
+
+    FILENAME = "checkpoint.json"
+    SAVE_INTERVAL_SEC = 5.0
+
+    def __init__(self, ctx: Context):
+        self._ctx = ctx
+        self._path: Path = ctx.out_dir / self.FILENAME
+        self._last_save_ts = 0.0
+        self.state: dict = dict()
+
+    def load(self) -> bool:
+        try:
+            with open(self._path, "rt") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            get_logger().warning(f"No checkpoint found, starting from scratch")
+            return False
+        except (OSError, ValueError) as e:
+            get_logger().warning(f"Failed to load checkpoint, starting from scratch: {e}")
+            return False
+
+        if state.get("complete"):
+            get_logger().warning(f"Previous export is complete, starting from scratch")
+            return False
+
+        self.state = state
+        get_logger().info(f"Loaded checkpoint: {len(self.completed)} offsets completed, last {self.offset}")
+        return True
+
+    @property
+    def offset(self) -> int | None:
+        return self.state.get("offset", None)
+
+    @property
+    def completed(self) -> list[int]:
+        return self.state.get("completed", [])
+
+    def update(self, offset: int, state_fn: callable, force: bool = False):
+        """
+        :param offset:    last completed offset
+        :param state_fn:  callable which returns the rest of the state; invoked
+                          only when the checkpoint is actually going to be saved
+        :param force:     save regardless of the time passed since the last save
+        """
+        self.state.setdefault("completed", []).append(offset)
+        self.state["offset"] = offset
+        if force or time.monotonic() - self._last_save_ts >= self.SAVE_INTERVAL_SEC:
+            self.save(state_fn())
+
+    def save(self, state: dict, complete: bool = False):
+        self.state.update(state, peer_id=self._ctx.peer_id, complete=complete)
+        fd, tmp_filename = tempfile.mkstemp(dir=self._ctx.out_dir, prefix=self.FILENAME, text=True)
+        with os.fdopen(fd, "wt") as f:
+            json.dump(self.state, f)
+        os.replace(tmp_filename, self._path)  # atomic write
+        self._last_save_ts = time.monotonic()
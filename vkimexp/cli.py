@@ -3,16 +3,105 @@
 #  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
 # ------------------------------------------------------------------------------
 
+import contextvars
+import dataclasses
+import json
 import math
-from time import sleep
+import typing as t
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from time import sleep, time
 
 import click
-from yt_dlp import SUPPORTED_BROWSERS
 
-from .common import init_logging, get_logger
-from .core import Task
+from .auth import SUPPORTED_BROWSERS
+from .common import AuthError, Context, Totals, init_logging, get_logger, set_log_peer
+from .metrics import Metrics, MetricsExporter
+from .parser import PARSER_BACKENDS
+from .preview import PREVIEW_FORMATS
 
 MAX_INIT_ATTEMPTS = 10
+# task construction errors which require user actions, the rest (e.g. locked files) are retried
+FATAL_INIT_ERRORS = (AuthError, click.UsageError)
+SEARCH_DATE_FORMATS = ["%Y-%m-%d", "%Y-%m-%d %H:%M", "%Y-%m-%d %H:%M:%S"]
+SEARCH_HIGHLIGHT = (click.style("", fg="yellow", bold=True, reset=False), click.style("", reset=True))
+
+PeerResult = tuple[int, bool, Totals]
+
+
+def _with_options(options: list[t.Callable]) -> t.Callable:
+    def decorator(fn: t.Callable) -> t.Callable:
+        for option in reversed(options):
+            fn = option(fn)
+        return fn
+
+    return decorator
+
+
+# options accepted by both export and 'replay' commands
+_JOBS_OPTION = click.option(
+    "--jobs",
+    metavar="N",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Amount of PEERs to export simultaneously; with N > 1 the progress is displayed in a compact form.",
+)
+_OUTPUT_OPTIONS = [
+    click.option(
+        "--store",
+        is_flag=True,
+        help="Keep attachments in a content-addressed storage shared by all peers ('out/.store') and link them into "
+        "peer directories, so that the same file is downloaded and stored only once.",
+    ),
+    click.option(
+        "--json-lines",
+        is_flag=True,
+        help="Write messages into 'index.jsonl' (one JSON object per line) instead of 'index.json'.",
+    ),
+    click.option(
+        "--sqlite",
+        is_flag=True,
+        help="Also write messages into SQLite database shared by all peers ('out/messages.sqlite') with full-text "
+        "index of them; run 'vkimexp search --help' for the details. Use with 'vkimexp replay' to index previous "
+        "exports.",
+    ),
+    click.option(
+        "--previews",
+        type=click.Choice([*PREVIEW_FORMATS]),
+        help="Make downsized copies of photos and images in the specified format for HTML pages to load instead of "
+        "the originals, which makes large pages open much faster; requires 'Pillow' package (installed with "
+        "'vkimexp[preview]').",
+    ),
+]
+_COMMON_OPTIONS = [
+    click.option(
+        "--parser",
+        type=click.Choice([b.get_name() for b in PARSER_BACKENDS]),
+        default=PARSER_BACKENDS[0].get_name(),
+        show_default=True,
+        help="HTML parser to use; 'lxml' is several times faster, but handles whitespace and invalid markup "
+        "slightly differently (requires 'lxml' package, installed with 'vkimexp[fast]').",
+    ),
+    click.option(
+        "--metrics-file",
+        metavar="PATH",
+        type=click.Path(dir_okay=False, writable=True, path_type=Path),
+        help="Write export metrics (per-stage timings, pages, bytes, attachments, retries etc.) in Prometheus text "
+        "format into PATH, e.g. for node_exporter textfile collector; the file is updated during the export. The JSON "
+        "summary is written into 'logs' dir regardless.",
+    ),
+    click.option(
+        "--metrics-interval",
+        metavar="SEC",
+        type=click.FloatRange(min=1),
+        default=15,
+        show_default=True,
+        help="How often to update the metrics file.",
+    ),
+    click.option("-v", "--verbose", count=True, help="Print more details."),
+]
 
 
 @click.command(no_args_is_help=True)
@@ -26,7 +115,96 @@ MAX_INIT_ATTEMPTS = 10
     show_default=True,
     help="Browser to load cookies from (process is automatic).",
 )
-@click.option("-v", "--verbose", count=True, help="Print more details.")
+@click.option(
+    "--cookies-ttl",
+    metavar="MIN",
+    type=click.IntRange(min=0),
+    default=0,
+    show_default=True,
+    help="Keep extracted cookies in a cache file (readable by the owner only) for MIN minutes, so that the next runs "
+    "do not have to access the browser (0 = do not cache).",
+)
+@click.option(
+    "--pool-size",
+    metavar="N",
+    type=click.IntRange(min=1),
+    default=16,
+    show_default=True,
+    help="Max amount of hosts to keep connection pools for.",
+)
+@click.option(
+    "--host-conns",
+    metavar="N",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    help="Max amount of simultaneous connections to a single host.",
+)
+@click.option(
+    "--keep-alive/--no-keep-alive",
+    default=True,
+    show_default=True,
+    help="Reuse HTTP connections between the requests.",
+)
+@click.option(
+    "-d",
+    "--download-jobs",
+    metavar="N",
+    type=click.IntRange(min=0),
+    default=4,
+    show_default=True,
+    help="Amount of attachments to download in the background simultaneously (0 = download in place).",
+)
+@click.option(
+    "-p",
+    "--prefetch",
+    metavar="N",
+    type=click.IntRange(min=0),
+    default=2,
+    show_default=True,
+    help="Amount of history pages to fetch ahead of processing (0 = fetch on demand).",
+)
+@click.option(
+    "-j",
+    "--fetch-jobs",
+    metavar="N",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Amount of history pages to fetch simultaneously; with N > 1 up to N+PREFETCH pages are kept in memory.",
+)
+@_JOBS_OPTION
+@click.option(
+    "-r",
+    "--resume",
+    is_flag=True,
+    help="Continue previously interrupted or partially failed export, fetching only the pages which were not "
+    "completed, instead of starting over.",
+)
+@click.option(
+    "-s",
+    "--sync",
+    is_flag=True,
+    help="Fetch only the messages newer than the ones from previous export and append them to the output.",
+)
+@click.option(
+    "-e",
+    "--engine",
+    type=click.Choice(["threads", "asyncio"]),
+    default="threads",
+    show_default=True,
+    help="Concurrency model; 'asyncio' requires 'aiohttp' package (installed with 'vkimexp[async]').",
+)
+@click.option(
+    "--raw-format",
+    type=click.Choice(["files", "segments"]),
+    default="files",
+    show_default=True,
+    help="How to save server responses into 'raw' dir: 'files' writes two plain files per page, 'segments' appends "
+    "them compressed to a few large files, which takes much less space and inodes.",
+)
+@_with_options(_OUTPUT_OPTIONS)
+@_with_options(_COMMON_OPTIONS)
 @click.pass_context
 def entrypoint(clctx: click.Context, peers: list[str], verbose: int, **kwargs):
     """
@@ -51,31 +229,282 @@ def entrypoint(clctx: click.Context, peers: list[str], verbose: int, **kwargs):
 
     """
     peer_ids = [_normalize_peer_id(p) for p in peers]
+    if clctx.params.get("resume") and clctx.params.get("sync"):
+        raise click.UsageError("--resume and --sync options are mutually exclusive")
+    _check_previews(clctx)
+
+    # heavy modules are imported on demand, so that e.g. '--help' is displayed instantly
+    if clctx.params.get("engine") == "asyncio":
+        import asyncio
+
+        try:
+            from .aiocore import AsyncTask
+        except ImportError as e:
+            raise click.UsageError(f"asyncio engine requires 'aiohttp' package to be installed: {e}")
+        _process(clctx, verbose, lambda: asyncio.run(_run_async(clctx, peer_ids, verbose, AsyncTask)))
+    else:
+        from .core import Task
+
+        _process(clctx, verbose, lambda: _run(clctx, peer_ids, verbose, Task))
+
+
+@click.command(name="replay", no_args_is_help=True)
+@click.argument("peers", nargs=-1, required=True, type=click.STRING)
+@_JOBS_OPTION
+@_with_options(_OUTPUT_OPTIONS)
+@_with_options(_COMMON_OPTIONS)
+@click.pass_context
+def replay_entrypoint(clctx: click.Context, peers: list[str], verbose: int, **kwargs):
+    """
+    Rebuild the output of previous export of PEERs (same format as for export)
+    from the server responses saved into 'raw' dir, without accessing VK, e.g.
+    after changing the output options or the application update:
+
+        vkimexp replay --sqlite --previews webp c195
+
+    Attachments are not downloaded, only the ones present already are linked.
+    Pages are processed by all CPU cores. Checkpoint of the export is left
+    intact.
+    """
+    peer_ids = [_normalize_peer_id(p) for p in peers]
+    _check_previews(clctx)
+
+    from .replay import ReplayTask
+
+    _process(clctx, verbose, lambda: _run(clctx, peer_ids, verbose, ReplayTask))
+
+
+def _check_previews(clctx: click.Context):
+    if preview_format := clctx.params.get("previews"):
+        from .preview import check_format
+
+        try:
+            check_format(preview_format)
+        except RuntimeError as e:
+            raise click.UsageError(str(e))
+
+
+def _process(clctx: click.Context, verbose: int, run_fn: t.Callable[[], list[PeerResult]]):
+    """
+    Part common for export and replay: logging, metrics and the summary.
+    """
     init_logging(verbose)
 
-    result = False
-    attempt = 0
-    while peer_ids:
-        task = Task(clctx, peer_ids[0], attempt)
+    metrics = Metrics.get_instance()
+    metrics_exporter = None
+    if metrics_file := clctx.params.get("metrics_file"):
+        metrics_exporter = MetricsExporter(metrics, metrics_file, clctx.params.get("metrics_interval"))
+        metrics_exporter.start()
+
+    try:
+        results = run_fn()
+    finally:
+        if metrics_exporter:
+            metrics_exporter.stop()
+        _write_metrics_summary(metrics)
+
+    if len(results) > 1:
+        totals = Totals()
+        for _, _, peer_totals in results:
+            totals.add(peer_totals)
+        peers_done = [peer_id for peer_id, result, _ in results if result]
+        peers_failed = [peer_id for peer_id, result, _ in results if not result]
+        from .printer import StatePrinter
+
+        StatePrinter.print_summary(totals, peers_done, peers_failed)
+
+
+def _run(clctx: click.Context, peer_ids: list[int], verbose: int, task_cls: type) -> list[PeerResult]:
+    def run_peer(peer_id: int) -> PeerResult:
+        # each peer gets its own logging context
+        return contextvars.copy_context().run(_run_peer, clctx, peer_id, verbose, task_cls)
+
+    if (jobs := min(clctx.params.get("jobs"), len(peer_ids))) == 1:
+        return [*map(run_peer, peer_ids)]
+    with ThreadPoolExecutor(jobs, thread_name_prefix="peer") as executor:
+        return [*executor.map(run_peer, peer_ids)]
+
+
+def _run_peer(clctx: click.Context, peer_id: int, verbose: int, task_cls: type) -> PeerResult:
+    set_log_peer(peer_id)
+    totals = Totals()
+    for attempt in range(MAX_INIT_ATTEMPTS):
+        if attempt:
+            _sleep(attempt)
+        try:
+            task = task_cls(clctx, peer_id, attempt)
+        except FATAL_INIT_ERRORS as e:
+            _log_task_error(e, verbose)
+            return peer_id, False, totals  # retrying wouldn't help
+        except Exception as e:
+            _log_task_error(e, verbose)
+            continue
+
+        result = False
         try:
             result = task.run()
         except Exception as e:
-            if verbose:
-                get_logger().exception(e, exc_info=e.with_traceback(e.__traceback__))
-            else:
-                get_logger().error(e)
+            _log_task_error(e, verbose)
         finally:
             task.close()
+        totals = task.totals
+        if result:
+            return peer_id, True, totals
+
+    get_logger().error("Max attempts amount reached, skipping the peer")
+    return peer_id, False, totals
+
+
+async def _run_async(clctx: click.Context, peer_ids: list[int], verbose: int, task_cls: type) -> list[PeerResult]:
+    import asyncio
+
+    jobs = asyncio.Semaphore(clctx.params.get("jobs"))
+
+    async def run_peer(peer_id: int) -> PeerResult:
+        async with jobs:
+            return await _run_peer_async(clctx, peer_id, verbose, task_cls)
+
+    # each coroutine is wrapped into a separate asyncio task, and thus gets its own logging context
+    return await asyncio.gather(*map(run_peer, peer_ids))
+
 
+async def _run_peer_async(clctx: click.Context, peer_id: int, verbose: int, task_cls: type) -> PeerResult:
+    import asyncio
+
+    set_log_peer(peer_id)
+    totals = Totals()
+    for attempt in range(MAX_INIT_ATTEMPTS):
+        if attempt:
+            await asyncio.sleep(_get_delay(attempt))
+        try:
+            task = await asyncio.to_thread(task_cls, clctx, peer_id, attempt)
+        except FATAL_INIT_ERRORS as e:
+            _log_task_error(e, verbose)
+            return peer_id, False, totals
+        except Exception as e:
+            _log_task_error(e, verbose)
+            continue
+
+        result = False
+        try:
+            result = await task.run_async()
+        except Exception as e:
+            _log_task_error(e, verbose)
+        finally:
+            await asyncio.to_thread(task.close)
+        totals = task.totals
         if result:
-            peer_ids.pop(0)
-            attempt = 0
-        else:
-            attempt += 1
-            if attempt >= MAX_INIT_ATTEMPTS:
-                get_logger().error("Max attempts amount reached, terminating")
-                break
-            _sleep(attempt)
+            return peer_id, True, totals
+
+    get_logger().error("Max attempts amount reached, skipping the peer")
+    return peer_id, False, totals
+
+
+def _write_metrics_summary(metrics: Metrics):
+    summary_path = Context.get_logs_dir() / f"{time():.0f}.metrics.json"
+    try:
+        metrics.write_json(summary_path)
+    except OSError as e:
+        get_logger().warning(f"Failed to write metrics summary: {e}")
+    else:
+        get_logger().info(f"Metrics summary written to {summary_path}")
+
+
+def _log_task_error(e: Exception, verbose: int):
+    if verbose:
+        get_logger().exception(e, exc_info=e.with_traceback(e.__traceback__))
+    else:
+        get_logger().error(e)
+
+
+@click.command(name="search")
+@click.argument("query", required=False)
+@click.option(
+    "-p",
+    "--peer",
+    "peers",
+    metavar="PEER",
+    multiple=True,
+    help="Search in the conversation with PEER only (same format as for export, can be repeated).",
+)
+@click.option(
+    "-f",
+    "--from",
+    "from_peer_ids",
+    metavar="ID",
+    type=click.INT,
+    multiple=True,
+    help="Search in the messages from VK ID in group conversations only (can be repeated).",
+)
+@click.option(
+    "--since",
+    metavar="DATE",
+    type=click.DateTime(SEARCH_DATE_FORMATS),
+    help="Skip the messages sent before DATE ('YYYY-MM-DD' or 'YYYY-MM-DD HH:MM[:SS]', local time).",
+)
+@click.option(
+    "--until",
+    metavar="DATE",
+    type=click.DateTime(SEARCH_DATE_FORMATS),
+    help="Skip the messages sent at DATE and later.",
+)
+@click.option("-a", "--with-attachments", is_flag=True, help="Search in the messages with attachments only.")
+@click.option(
+    "-n",
+    "--limit",
+    type=click.IntRange(min=0),
+    default=50,
+    show_default=True,
+    help="Maximum amount of messages to print, 0 = unlimited.",
+)
+@click.option("--json", "as_json", is_flag=True, help="Print messages as JSON objects, one per line.")
+def search_entrypoint(query: str | None, peers: list[str], as_json: bool, since, until, **kwargs):
+    """
+    Search in the messages exported with --sqlite option. QUERY is a full-text
+    query: words to find (case-insensitive), "exact phrases", prefixes* and
+    their combinations with AND, OR and NOT, e.g.:
+
+        vkimexp search 'hello OR "good morning"' --peer c195 --since 2023-01-01
+
+    Without QUERY messages are selected by other conditions only. Results are
+    ordered from the newest to the oldest.
+    """
+    from .search import search
+
+    db_path = Context.get_db_path()
+    if not db_path.exists():
+        raise click.UsageError(f"Database not found: {db_path}, export the messages with --sqlite option first")
+    try:
+        results = search(
+            db_path,
+            query,
+            peer_ids=[_normalize_peer_id(p) for p in peers],
+            since_ts=since and int(since.timestamp()),
+            until_ts=until and int(until.timestamp()),
+            highlight=("", "") if as_json else SEARCH_HIGHLIGHT,
+            **kwargs,
+        )
+    except (ValueError, RuntimeError) as e:
+        raise click.UsageError(str(e))
+
+    for result in results:
+        if as_json:
+            click.echo(json.dumps(dataclasses.asdict(result), ensure_ascii=False))
+            continue
+        sender = ["<" if result.inbox else ">"]
+        if result.peer_id >= 2000000000:
+            sender.append((result.from_name or str(result.from_peer_id)) + ":")
+        if result.attach_count:
+            sender.append(f"[+{result.attach_count:d}A]")
+        prefix = " ".join(
+            [
+                str(result.peer_id).rjust(10),
+                ("(" + str(result.msg_idx) + ")").rjust(10),
+                datetime.fromtimestamp(result.ts).strftime("[%0e-%b-%y %H:%M:%S]"),
+                *sender,
+            ]
+        )
+        click.echo(prefix + " " + result.text.replace("\n", "\n" + " " * (len(prefix) + 1)))
 
 
 def _normalize_peer_id(peer: str) -> int:
@@ -90,6 +519,10 @@ def _normalize_peer_id(peer: str) -> int:
 
 
 def _sleep(attempt: int):
+    sleep(_get_delay(attempt))
+
+
+def _get_delay(attempt: int) -> float:
     delay = math.log(attempt + 1, 1.2)
     get_logger().warning(f"Attempt {attempt+1}/{MAX_INIT_ATTEMPTS}, will retry in {delay:.1f} seconds...")
-    sleep(delay)
+    return delay
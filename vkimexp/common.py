@@ -7,30 +7,54 @@ import enum
 import logging
 import os
 import time
-from dataclasses import dataclass
+import typing as t
+from contextvars import ContextVar
+from dataclasses import dataclass, field, fields
 from logging import Logger as BaseLogger, FileHandler, StreamHandler
 from pathlib import Path
 from threading import Lock
+from urllib.parse import urlsplit
 
-import click
-from bs4 import BeautifulSoup
-from urllib3.util import parse_url
+from .cache import AttachmentCache
+from .dedup import DedupIndex
+from .metrics import Metrics
+from .parser import ParserBackend, get_parser_backend
+from .ratelimit import RateLimiter
+from .store import ContentStore
+from .visitor import DomVisitor, Selector
+
+if t.TYPE_CHECKING:
+    from bs4 import BeautifulSoup, Tag
 
 DOMAIN = "vk.com"
-URL = "https://" + DOMAIN + "/al_im.php"
-HOST = (lambda u=parse_url(URL): u.scheme + "://" + u.host)()
+# can be pointed at a stand-in server, see "bench" dir
+URL = os.environ.get("VKIMEXP_URL") or "https://" + DOMAIN + "/al_im.php"
+HOST = (lambda u=urlsplit(URL): u.scheme + "://" + u.netloc)()
 
 PAGE_SIZE = 100
 
 
 class DownloadError(Exception):
-    ...
+    def __init__(self, msg: str, status: int = None):
+        super().__init__(msg)
+        self.status = status
+
+    @property
+    def permanent(self) -> bool:
+        """
+        Whether the attachment is gone for good and retrying makes no sense.
+        """
+        return self.status in (403, 404, 410)
 
 
 class MessageHandleError(Exception):
     ...
 
 
+class AuthError(RuntimeError):
+    ...
+
+
 @dataclass(frozen=True)
 class MessageDTO:
     msg_idx: int
@@ -66,24 +90,50 @@ class Counter:
 
 @dataclass(frozen=True)
 class Totals:
-    msg_count_html = Counter()
-    msg_count_index = Counter()
-    attach_found = Counter()
-    attach_downloaded = Counter()
+    msg_count_html: Counter = field(default_factory=Counter)
+    msg_count_index: Counter = field(default_factory=Counter)
+    attach_found: Counter = field(default_factory=Counter)
+    attach_downloaded: Counter = field(default_factory=Counter)
+
+    def add(self, other: "Totals"):
+        for f in fields(self):
+            getattr(self, f.name).increment(getattr(other, f.name).value)
 
 
 class Context:
     _OUT_DIR = Path(__file__).parent.parent / "out"
 
-    def __init__(self, clctx: click.Context, peer_id: int, attempt: int):
-        self.browser: str = clctx.params.get("browser")
-        self.verbose: int = clctx.params.get("verbose")
+    def __init__(self, params: dict, peer_id: int, attempt: int):
+        self.browser: str = params.get("browser")
+        self.cookies_ttl: int = (params.get("cookies_ttl") or 0) * 60
+        self.verbose: int = params.get("verbose")
+        self.pool_size: int = params.get("pool_size")
+        self.host_conns: int = params.get("host_conns")
+        self.keep_alive: bool = params.get("keep_alive")
+        self.download_jobs: int = params.get("download_jobs")
+        self.prefetch: int = params.get("prefetch")
+        self.fetch_jobs: int = params.get("fetch_jobs")
+        self.resume: bool = params.get("resume")
+        self.sync: bool = params.get("sync")
+        self.jobs: int = min(params.get("jobs"), len(params.get("peers")))
+        self.json_lines: bool = params.get("json_lines")
+        self.raw_format: str = params.get("raw_format")
+        self.sqlite: bool = params.get("sqlite")
+        self.previews: str | None = params.get("previews")
+        self.parser: ParserBackend = get_parser_backend(params.get("parser"))
         self.peer_id: int = peer_id
         self.attempt: int = attempt
-        self.out_dir: Path = self._OUT_DIR / str(self.peer_id)
+        self.out_dir: Path = self.get_out_dir(self.peer_id)
+        self.attachment_cache = AttachmentCache(self.out_dir)
+        self.limiter = RateLimiter.get_instance()
+        self.metrics = Metrics.get_instance()
+        self.store: ContentStore | None = None
+        if params.get("store"):
+            self.store = ContentStore.get_instance(self._OUT_DIR / ContentStore.DIRNAME)
 
         self.totals = Totals()
         self.peer_name_map = PeerNameMap()
+        self.dedup = DedupIndex()
 
         self.max_msg_idx: int | None = None
         self.max_page: int | None = None
@@ -99,30 +149,75 @@ class Context:
     def is_group_conversation(self) -> bool:
         return self.peer_id >= 2000000000
 
+    @staticmethod
+    def get_out_dir(peer_id: int) -> Path:
+        return Context._OUT_DIR / str(peer_id)
+
     @staticmethod
     def get_logs_dir() -> Path:
         return Context._OUT_DIR / "logs"
 
+    @staticmethod
+    def get_db_path() -> Path:
+        return Context._OUT_DIR / "messages.sqlite"
+
 
 class PeerNameMap(dict[int, str]):
-    def add(self, soup: BeautifulSoup):
-        for mstack in soup.find_all("div", attrs={"class": "im-mess-stack"}):
-            try:
-                peer_id = int(mstack["data-peer"])
-                pname_el = mstack.find_next("div", attrs={"class": "im-mess-stack--pname"})
-                pname = pname_el.find("a").text.strip()
+    def __init__(self):
+        super().__init__()
+        self._cur_peer_id: int | None = None
+
+    def subscribe(self, visitor: DomVisitor):
+        visitor.on_begin(self._reset)
+        visitor.subscribe(Selector("div", {"class": "im-mess-stack"}), self._on_stack)
+        visitor.subscribe(Selector("div", {"class": "im-mess-stack--pname"}), self._on_name)
+
+    def _reset(self, _: "BeautifulSoup"):
+        self._cur_peer_id = None
+
+    def _on_stack(self, mstack: "Tag"):
+        try:
+            self._cur_peer_id = int(mstack["data-peer"])
+        except Exception:
+            self._cur_peer_id = None
+
+    def _on_name(self, pname_el: "Tag"):
+        if (peer_id := self._cur_peer_id) is None:
+            return
+        self._cur_peer_id = None
+        try:
+            pname = pname_el.find("a").text.strip()
+        except Exception:
+            return
+
+        if self.get(peer_id, None) != pname:
+            get_logger().debug(f"Setting peer name {peer_id} -> {pname!r}")
+            self[peer_id] = pname
 
-                if self.get(peer_id, None) != pname:
-                    get_logger().debug(f"Setting peer name {peer_id} -> {pname!r}")
-                    self[peer_id] = pname
-            except Exception as e:
-                continue
+
+_log_peer_id: ContextVar[int | None] = ContextVar("log_peer_id", default=None)
 
 
 def get_logger() -> BaseLogger:
     return logging.getLogger(__package__)
 
 
+def set_log_peer(peer_id: int | None):
+    """
+    Mark the log records made in the current context (and the ones copied from it,
+    see `contextvars.copy_context()`) with a peer ID, so that the output of
+    concurrent tasks could be told apart.
+    """
+    _log_peer_id.set(peer_id)
+
+
+class _PeerLogFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        peer_id = _log_peer_id.get()
+        record.peer = f"[{peer_id}] " if peer_id else ""
+        return True
+
+
 def init_logging(verbose: int):
     logger = get_logger()
     logger.setLevel(logging.DEBUG)
@@ -135,9 +230,11 @@ def init_logging(verbose: int):
     stderr_hdlr = StreamHandler()
     stderr_hdlr.setLevel(stderr_level)
     stderr_hdlr.setLevel(stderr_level)
+    stderr_hdlr.setFormatter(logging.Formatter("%(peer)s%(message)s"))
+    stderr_hdlr.addFilter(_PeerLogFilter())
     logger.addHandler(stderr_hdlr)
 
-    fmt = "[%(asctime)s][%(levelname)5.5s][%(name)s.%(module)s] %(message)s"
+    fmt = "[%(asctime)s][%(levelname)5.5s][%(name)s.%(module)s] %(peer)s%(message)s"
     file_fmtr = logging.Formatter(fmt)
 
     logs_dir = Context.get_logs_dir()
@@ -147,6 +244,7 @@ def init_logging(verbose: int):
         file_hdlr = FileHandler(logs_dir / f"{time.time():.0f}.{suffix}.log", "xt")
         file_hdlr.setLevel(level)
         file_hdlr.setFormatter(file_fmtr)
+        file_hdlr.addFilter(_PeerLogFilter())
         logger.addHandler(file_hdlr)
 
 
@@ -7,18 +7,28 @@ import importlib
 import importlib.resources
 import math
 import os
-from time import sleep
+import re
+import time
+from collections import deque
+from threading import Lock
 
 import click
+import requests
 
 from .auth import Auth
-from .common import URL, PAGE_SIZE, get_logger
+from .checkpoint import Checkpoint
+from .dedup import DedupIndex
+from .common import URL, PAGE_SIZE, AuthError, Totals, get_logger
+from .fetcher import ImData, PageResult, PageFetcher, PrefetchingPageFetcher, ConcurrentPageFetcher
 from .handler import *
-from .printer import StatePrinter
+from .preview import PreviewQueue
+from .printer import StatePrinter, PeerStatePrinter
+from .transport import Transport
+from .visitor import DomVisitor, Selector
 from .writer import *
 
 
-ImData = tuple[str, dict, int]
+CSS_FILENAME = "default.css"
 
 AttachmentResult = Path | Exception | None
 AttachmentStorage = dict[str, AttachmentResult]
@@ -26,20 +36,47 @@ AttachmentStorage = dict[str, AttachmentResult]
 
 class Task:
     def __init__(self, clctx: click.Context, peer_id: int, attempt: int):
-        self._ctx = Context(clctx, peer_id, attempt)
-        self._auth = Auth(self._ctx)
+        self._ctx = Context(clctx.params, peer_id, attempt)
+        self._auth = self._make_auth()
+        self._auth_lock = Lock()
+        self._transport = self._make_transport()
 
         os.makedirs(self._ctx.out_dir, exist_ok=True)
 
-        self._seen_msg_ids = set()
+        self._checkpoint = self._make_checkpoint()
+        self._completed_offsets: set[int] = set()
+        self._sync_max_msg_idx: int | None = None
+        self._page_in_progress = False
+        state = dict()
+        if self._ctx.resume and self._checkpoint.load():
+            state = self._checkpoint.state
+            self._completed_offsets = set(self._checkpoint.completed)
+
+        self._ctx.dedup.restore(state.get("dedup", {}))
+        self._seen_msg_ids = self._ctx.dedup.get_plane(DedupIndex.MSG_ID)
         self._attachment_storage = AttachmentStorage()
+        self._failed_links: dict[str, str] = dict()  # see `AttachmentHandler.get_failed_links()`
         self._failed_requests: deque[tuple[int, Exception]] = deque()
-        self._printer = StatePrinter(self._ctx)
+        self._printer = self._make_printer()
+        self._download_queue = self._make_download_queue()
+        self._preview_queue = PreviewQueue(self._ctx) if self._ctx.previews else None
+        self._page_fetcher = self._make_page_fetcher()
 
-        self._index_writer = IndexWriter(self._ctx)
-        self._json_writer = JsonWriter(self._ctx)
-        self._raw_writer = RawWriter(self._ctx)
-        self._html_writer = HtmlWriter(self._ctx)
+        writers_state = self._get_writers_state(state)
+        try:
+            json_writer_cls = JsonLinesWriter if self._ctx.json_lines else JsonWriter
+            self._json_writer = json_writer_cls(self._ctx, writers_state.get("json"))
+            if self._ctx.sync:
+                writers_state = self._init_sync()
+            self._index_writer = IndexWriter(self._ctx, writers_state.get("index"))
+            self._raw_writer = RawWriter(self._ctx)
+            self._html_writer = HtmlWriter(self._ctx, writers_state.get("html"))
+            self._sqlite_writer = SqliteWriter(self._ctx) if self._ctx.sqlite else None
+        except (OSError, ValueError) as e:
+            raise click.UsageError(
+                f"Failed to continue previous export, output seems to be damaged: {e}; run without "
+                f"{'--sync' if self._ctx.sync else '--resume'} option to start over"
+            ) from e
 
         self._writers = [
             self._index_writer,
@@ -47,80 +84,185 @@ class Task:
             self._raw_writer,
             self._html_writer,
         ]
+        if self._sqlite_writer:
+            self._writers.append(self._sqlite_writer)
         self._handlers: list[AttachmentHandler] = [
-            ImagesHandler(self._ctx),
-            PhotosHandler(self._ctx),
-            AudioMsgsHandler(self._ctx),
+            ImagesHandler(self._ctx, self._transport, self._download_queue),
+            PhotosHandler(self._ctx, self._transport, self._download_queue),
+            AudioMsgsHandler(self._ctx, self._transport, self._download_queue),
         ]
 
+        self._duplicates: list[Tag] = []
+        self._msg_count = 0
+        self._visitor = DomVisitor()
+        self._ctx.peer_name_map.subscribe(self._visitor)
+        self._visitor.on_begin(self._reset_messages)
+        self._visitor.subscribe(Selector("li", {"class": "im-mess"}), self._on_message)
+        for hdlr in self._handlers:
+            hdlr.subscribe(self._visitor)
+        self._html_writer.subscribe(self._visitor)
+
+        if state:
+            self._restore(state)
+
+    def _init_sync(self) -> dict:
+        seen_msg_idxs = self._ctx.dedup.get_plane(DedupIndex.INDEX)
+        max_msg_idx = 0
+
+        def visit(msg: MessageDTO):
+            nonlocal max_msg_idx
+            max_msg_idx = max(max_msg_idx, msg.msg_idx)
+            self._seen_msg_ids.add(msg.msg_id)
+            seen_msg_idxs.add(msg.msg_idx)
+
+        if not (prev_count := self._json_writer.load(visit)):
+            get_logger().warning(f"No previous export found, performing full export")
+            return {}
+
+        self._sync_max_msg_idx = max_msg_idx
+        get_logger().info(f"Syncing: {prev_count} messages already exported, last is {self._sync_max_msg_idx}")
+
+        return {
+            "index": {
+                "size": os.path.getsize(self._ctx.out_dir / IndexWriter.FILENAME),
+            },
+            "html": {
+                "first_page": HtmlWriter.count_pages(self._ctx) + 1,
+                "page": None,
+                "msg_count": 0,
+            },
+        }
+
+    def _get_writers_state(self, state: dict) -> dict:
+        return state.get("writers", {})
+
+    def _restore(self, state: dict):
+        for peer_id, peer_name in state.get("peer_names", {}).items():
+            self._ctx.peer_name_map[int(peer_id)] = peer_name
+        for name, value in state.get("totals", {}).items():
+            getattr(self._ctx.totals, name).increment(value)
+        self._failed_links.update(state.get("failed_links", {}))
+
+    def _get_state(self) -> dict:
+        return {
+            "dedup": self._ctx.dedup.get_state(),
+            "peer_names": self._ctx.peer_name_map,
+            "failed_links": self._get_failed_links(),
+            "totals": {
+                "msg_count_html": self._ctx.totals.msg_count_html.value,
+                "msg_count_index": self._ctx.totals.msg_count_index.value,
+            },
+            "writers": {
+                "index": self._index_writer.get_state(),
+                "json": self._json_writer.get_state(),
+                "html": self._html_writer.get_state(),
+                **({"sqlite": self._sqlite_writer.get_state()} if self._sqlite_writer else {}),
+            },
+        }
+
+    @property
+    def totals(self) -> Totals:
+        return self._ctx.totals
+
+    def _make_auth(self) -> Auth | None:
+        return Auth(self._ctx)
+
+    def _make_transport(self) -> Transport | None:
+        return Transport(self._ctx, self._auth.cookies)
+
+    def _make_checkpoint(self) -> Checkpoint:
+        return Checkpoint(self._ctx)
+
+    def _make_printer(self) -> StatePrinter:
+        if self._ctx.jobs > 1:
+            return PeerStatePrinter(self._ctx)
+        return StatePrinter(self._ctx)
+
+    def _make_download_queue(self) -> DownloadQueue:
+        return DownloadQueue(self._ctx)
+
+    def _make_page_fetcher(self) -> PageFetcher:
+        if (jobs := self._ctx.fetch_jobs) > 1:
+            return ConcurrentPageFetcher(self._fetch_im_data, jobs, jobs + self._ctx.prefetch)
+        if depth := self._ctx.prefetch:
+            return PrefetchingPageFetcher(self._fetch_im_data, depth)
+        return PageFetcher(self._fetch_im_data)
+
     def run(self) -> bool:
         get_logger().info(f"Starting to process PEER {self._ctx.peer_id}")
 
         try:
-            _, data, size = self._fetch_im_data(first=True)
-            last_page_data = [*self._handle_response_data(data)]
+            max_page = self._start(self._fetch_im_data(first=True))
         except RuntimeError as e:
             get_logger().error(e)
             return False
 
+        if self._sync_max_msg_idx is not None:
+            pages = self._iter_new_offsets(max_page)
+            results = self._collect_new_pages(self._page_fetcher.iter_pages(pages))
+        else:
+            results = self._page_fetcher.iter_pages(self._iter_offsets(max_page))
+
+        for page, offset, im_data in results:
+            self._consume_page(page, offset, im_data)
+
+        self._download_queue.join()
+        self._finish()
+        return True
+
+    def _start(self, im_data: ImData) -> int:
+        _, data, size = im_data
+        last_page_data = [*self._handle_response_data(data)]
+
         max_page = -1
         if max_idx := max([dto.msg_idx for dto in last_page_data] + [0]):
             max_page = math.ceil(max_idx // PAGE_SIZE)
 
+        if self._sync_max_msg_idx is not None:
+            # upper estimation, as some messages could have been deleted
+            max_page = min(max_page, math.ceil((max_idx - self._sync_max_msg_idx) / PAGE_SIZE))
+
         self._ctx.max_msg_idx = max_idx
         self._ctx.max_page = max_page
         self._printer.print_header()
+        return max_page
 
-        for page in range(max_page, -2, -1):
-            # page -1 is the last one, without an offset
-
-            offset = (page * PAGE_SIZE) + 30
-            if offset < 0:
-                offset = 0
-
-            self._ctx.page = page
-            self._ctx.offset = offset
-            self._printer.print_pre_request()
+    def _consume_page(self, page: int, offset: int, im_data: ImData | Exception):
+        self._ctx.page = page
+        self._ctx.offset = offset
+        self._printer.print_pre_request()
 
-            try:
-                html, data, size = self._fetch_im_data(offset)
-                soup = BeautifulSoup(html, features="html.parser")
-                self._ctx.peer_name_map.add(soup)
-                self._raw_writer.write(html, data, offset)
-
-                html_count_cur = self._delete_duplicates(soup)
-                index_count_cur = 0
-                for dto in self._handle_response_data(data):
-                    if self._index_writer.write(dto):
-                        index_count_cur += 1
-                    self._json_writer.write(dto)
-
-                extra_count = html_count_cur - index_count_cur
-                self._printer.print_post_request(size, index_count_cur, extra_count)
-
-                for hdlr in self._handlers:
-                    hdlr.prepare(soup)
-                    hdlr.handle(soup, self._attachment_event)
-
-                self._html_writer.write(soup, offset, html_count_cur)
-
-                self._ctx.totals.msg_count_html.increment(html_count_cur)
-                self._ctx.totals.msg_count_index.increment(index_count_cur)
-
-            except RuntimeError as e:
-                self._printer.print_failed_request(e)
-                self._failed_requests.append((offset, e))
-            else:
-                self._printer.print_completed_request()
-
-            sleep(0.05)
+        try:
+            if isinstance(im_data, Exception):
+                raise im_data
+            self._page_in_progress = True
+            self._process_page(offset, *im_data)
+            self._page_in_progress = False
+        except RuntimeError as e:
+            self._ctx.metrics.count("pages", status="failed")
+            self._printer.print_failed_request(e)
+            if not self._failed_requests and not self._page_in_progress:
+                self._checkpoint.save(self._get_state())
+            self._failed_requests.append((offset, e))
+            if isinstance(e, AuthError) and self._auth:
+                # cookies could not be refreshed (see `_fetch_im_data()`), the rest of the pages would fail as well
+                raise
+        else:
+            self._ctx.metrics.count("pages", status="completed")
+            self._printer.print_completed_request()
+            # pages after the failed one are not checkpointed, so that the output is
+            # truncated back to it on --resume and the messages stay in order
+            if not self._failed_requests:
+                with self._ctx.metrics.measure("checkpoint"):
+                    self._checkpoint.update(offset, self._get_state)
+
+    def _finish(self):
+        if not self._failed_requests:
+            self._checkpoint.save(self._get_state(), complete=True)
+            self._relink_failed_attachments()
 
         try:
-            src_css = importlib.resources.read_text("vkimexp.data", "default.css")
-            dst_css = self._ctx.out_dir / "default.css"
-            if not os.path.exists(dst_css):
-                with open(dst_css, "xt") as dst_f:
-                    dst_f.write(src_css)
+            self._write_css()
         except Exception as e:
             get_logger().exception(e)
 
@@ -130,83 +272,269 @@ class Task:
                 get_logger().error(f"Attachment {attach_idx} load failed: {attach_res}")
         for offset, failed_req_err in self._failed_requests:
             get_logger().error(f"Request at offset {offset} failed: {failed_req_err}")
+        if self._failed_requests:
+            get_logger().warning(f"{len(self._failed_requests)} page(s) failed, run with --resume to fetch them again")
 
         self._printer.print_footer()
-        return True
 
-    def _fetch_im_data(self, offset: int = 0, first: bool = False) -> ImData:
-        request_attributes = dict(
-            params={
-                "act": "a_history",
-                "al": 1,
-                "gid": 0,
-                "im_v": 3,
-                "offset": offset,
-                "peer": self._ctx.peer_id,
-                "toend": 0,
-                "whole": 0,
-            },
-            headers={
-                "authority": "vk.com",
-                "accept": "*/*",
-                "accept-language": "en-US,en;q=0.9,bg;q=0.8,sr;q=0.7,ja;q=0.6,tg;q=0.5,zu;q=0.4,ru;q=0.3",
-                "cache-control": "no-cache",
-                "content-type": "application/x-www-form-urlencoded",
-                "dnt": "1",
-                "origin": "https://vk.com",
-                "pragma": "no-cache",
-                "referer": f"https://vk.com/im?sel={self._ctx.peer_id}",
-                "sec-ch-ua": '"Not.A/Brand";v="8", "Chromium";v="114", "Google Chrome";v="114"',
-                "sec-ch-ua-mobile": "?0",
-                "sec-ch-ua-platform": '"Linux"',
-                "sec-fetch-dest": "empty",
-                "sec-fetch-mode": "cors",
-                "sec-fetch-site": "same-origin",
-                "user-agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36",
-                "x-requested-with": "XMLHttpRequest",
-            },
-            cookies=self._auth.cookies,
-        )
-        if first:
-            get_logger().debug(request_attributes)
+    def _write_css(self):
+        """
+        Copy the stylesheet to the output, unless it's there already. The one
+        from previous exports is replaced if it's outdated (see "version" in
+        the header), and is kept as a backup, as it could have been edited.
+        """
+        src_css = importlib.resources.read_text("vkimexp.data", CSS_FILENAME)
+        dst_css = self._ctx.out_dir / CSS_FILENAME
+        try:
+            with open(dst_css, "rt") as dst_f:
+                if self._get_css_version(dst_f.read()) >= self._get_css_version(src_css):
+                    return
+        except FileNotFoundError:
+            pass
+        else:
+            os.replace(dst_css, dst_css.with_name(CSS_FILENAME + ".bak"))
+            get_logger().info(f"Outdated {CSS_FILENAME} updated, previous one is saved as {CSS_FILENAME}.bak")
+
+        with open(dst_css, "xt") as dst_f:
+            dst_f.write(src_css)
+
+    @staticmethod
+    def _get_css_version(css: str) -> int:
+        if version_match := re.search(r"/\* version: (\d+) \*/", css):
+            return int(version_match.group(1))
+        return 1  # before the versioning
+
+    def _get_failed_links(self) -> dict[str, str]:
+        failed_links = dict(self._failed_links)
+        for hdlr in self._handlers:
+            failed_links.update(hdlr.get_failed_links())
+        return failed_links
+
+    def _relink_failed_attachments(self):
+        """
+        Point the links to the attachments which failed to download (after their
+        pages had been written) back to the remote URLs. Pages can be rewritten
+        only when the export is complete, as the checkpoint refers to their sizes.
+        """
+        links = {
+            rel_path: url
+            for rel_path, url in self._get_failed_links().items()
+            if not (self._ctx.out_dir / rel_path).exists()
+        }
+        if not links:
+            return
+        self._html_writer.close()
+        with self._ctx.metrics.measure("write.html"):
+            pages = self._html_writer.replace_links(links)
+        if pages:
+            get_logger().info(f"Links to failed attachments replaced with remote URLs in {pages} page(s)")
 
-        response = requests.get(URL, **request_attributes)
+    def _iter_offsets(self, max_page: int) -> t.Iterable[tuple[int, int]]:
+        for page in range(max_page, -2, -1):
+            # page -1 is the last one, without an offset
+            offset = (page * PAGE_SIZE) + 30
+            if offset < 0:
+                offset = 0
+            if offset in self._completed_offsets:
+                continue
+            yield page, offset
+
+    def _iter_new_offsets(self, max_page: int) -> t.Iterable[tuple[int, int]]:
+        """
+        Same as `_iter_offsets()`, but from the newest messages to the oldest.
+        """
+        yield from reversed([*self._iter_offsets(max_page)])
+
+    def _collect_new_pages(self, results: t.Iterator[PageResult]) -> list[PageResult]:
+        """
+        Accumulate the pages (which are fetched starting from the newest messages)
+        until the one with already exported message is encountered, and return
+        them in a regular order, i.e. from the oldest to the newest.
+        """
+        collected = []
+        for result in results:
+            collected.append(result)
+            if self._is_synced(result[2]):
+                break
+        results.close()
+        return [*reversed(collected)]
+
+    def _is_synced(self, im_data: ImData | Exception) -> bool:
+        if isinstance(im_data, Exception):
+            return False
+        _, data, _ = im_data
+        return any(dto.msg_idx <= self._sync_max_msg_idx for dto in self._handle_response_data(data))
+
+    def _process_page(self, offset: int, html: str, data: dict, size: int):
+        metrics = self._ctx.metrics
+        with metrics.measure("parse"):
+            soup = self._ctx.parser.parse(html)
+        with metrics.measure("visit"):
+            self._visitor.visit(soup)
+        with metrics.measure("write.raw"):
+            self._raw_writer.write(html, data, offset)
+
+        with metrics.measure("dedup"):
+            html_count_cur = self._delete_duplicates()
+        index_count_cur = self._write_messages(data)
+
+        extra_count = html_count_cur - index_count_cur
+        self._printer.print_post_request(size, index_count_cur, extra_count)
+
+        for hdlr in self._handlers:
+            with metrics.measure("handle." + hdlr.get_type()):
+                hdlr.handle(soup, self._attachment_event)
+
+        with metrics.measure("write.html"):
+            self._html_writer.write(soup, offset, html_count_cur)
+
+        self._ctx.totals.msg_count_html.increment(html_count_cur)
+        self._ctx.totals.msg_count_index.increment(index_count_cur)
+
+    def _write_messages(self, data: dict) -> int:
+        """
+        :return: amount of messages which were not exported before.
+        """
+        index_count_cur = 0
+        index_sec = json_sec = sqlite_sec = 0.0
+        for dto in self._handle_response_data(data):
+            started_ts = time.perf_counter()
+            if self._index_writer.write(dto):
+                index_count_cur += 1
+            index_written_ts = time.perf_counter()
+            self._json_writer.write(dto)
+            json_written_ts = time.perf_counter()
+            if self._sqlite_writer:
+                self._sqlite_writer.write(dto)
+            index_sec += index_written_ts - started_ts
+            json_sec += json_written_ts - index_written_ts
+            sqlite_sec += time.perf_counter() - json_written_ts
+
+        self._ctx.metrics.observe("write.index", index_sec)
+        self._ctx.metrics.observe("write.json", json_sec)
+        if self._sqlite_writer:
+            self._ctx.metrics.observe("write.sqlite", sqlite_sec)
+        return index_count_cur
 
+    def _fetch_im_data(self, offset: int = 0, first: bool = False) -> ImData:
+        cookies = self._transport.cookies
+        try:
+            return self._request_im_data(offset, first)
+        except AuthError as e:
+            get_logger().warning(f"Request at offset {offset} failed: {e}")
+            if not self._refresh_auth(cookies):
+                raise
+        return self._request_im_data(offset, first)
+
+    def _refresh_auth(self, cookies: dict) -> bool:
+        """
+        :param cookies: the ones the failed request was made with.
+        :return: True if the request should be repeated with the current cookies.
+        """
+        with self._auth_lock:
+            if cookies is not self._transport.cookies:
+                return True  # already refreshed by another fetching thread
+            if not self._auth.refresh():
+                return False
+            self._transport.set_cookies(self._auth.cookies)
+            return True
+
+    def _request_im_data(self, offset: int, first: bool) -> ImData:
+        params = self._make_im_params(offset)
+        if first:
+            get_logger().debug(params)
+
+        attempt = 0
+        with self._ctx.metrics.measure("fetch"):  # including the waiting for the rate limiter
+            while True:
+                time.sleep(self._ctx.limiter.reserve())
+                started_ts = time.monotonic()
+                try:
+                    response = self._transport.get_api(params)
+                    status, retry_after, error = response.status_code, response.headers.get("retry-after"), None
+                except requests.RequestException as e:
+                    status, retry_after, error = None, None, e
+
+                latency = time.monotonic() - started_ts
+                if (delay := self._ctx.limiter.on_response(attempt, status, latency, retry_after)) is None:
+                    break
+                self._log_retry(offset, status or error, delay)
+                time.sleep(delay)
+                attempt += 1
+
+        if error:
+            raise RuntimeError(f"Failed to get IM data: {error}") from error
         if not response.ok:
             raise RuntimeError(f"Failed to get IM data (HTTP {response.status_code})")
         get_logger().debug(f"GET {URL}: HTTP {response.status_code}")
 
+        self._ctx.metrics.count("fetched_bytes", len(response.content))
+        return self._read_im_payload(response.json(), len(response.text))
+
+    def _log_retry(self, offset: int, reason: int | Exception, delay: float):
+        self._ctx.metrics.count("retries", kind="api")
+        get_logger().warning(
+            f"Request at offset {offset} failed ({reason}), retrying in {delay:.1f}s "
+            f"(rate {self._ctx.limiter.rate:.1f}/s)"
+        )
+
+    def _make_im_params(self, offset: int) -> dict:
+        return {
+            "act": "a_history",
+            "al": 1,
+            "gid": 0,
+            "im_v": 3,
+            "offset": offset,
+            "peer": self._ctx.peer_id,
+            "toend": 0,
+            "whole": 0,
+        }
+
+    @classmethod
+    def _read_im_payload(cls, response_data: dict, size: int) -> ImData:
         try:
-            rendered, data, *_ = response.json()["payload"][1]
-            return rendered, data, len(response.text)
+            rendered, data, *_ = response_data["payload"][1]
         except KeyError:
-            raise RuntimeError(f"Failed to read payload: {response.json():.1000s}")
-
-    def _delete_duplicates(self, soup: BeautifulSoup) -> int:
-        count = 0
-        for li in soup.find_all("li", attrs={"class": "im-mess"}):
-            try:
-                msg_id = int(li["data-msgid"])
-            except ValueError as e:
-                get_logger().warning(f"Message element without ID: {li}")
-                continue
+            raise RuntimeError(f"Failed to read payload: {response_data!s:.1000s}")
+        cls._check_auth(data)
+        return rendered, data, size
 
-            if msg_id in self._seen_msg_ids:
-                li.replace_with("")
-                continue
-            self._seen_msg_ids.add(msg_id)
-            count += 1
-        return count
+    def _on_message(self, li: Tag) -> t.Any:
+        try:
+            msg_id = int(li["data-msgid"])
+        except ValueError as e:
+            get_logger().warning(f"Message element without ID: {li}")
+            return None
+
+        if not self._seen_msg_ids.add(msg_id):
+            self._duplicates.append(li)
+            return DomVisitor.SKIP  # attachments of duplicates are not to be processed
+        self._msg_count += 1
+        return None
+
+    def _reset_messages(self, _: BeautifulSoup):
+        self._duplicates.clear()
+        self._msg_count = 0
+
+    def _delete_duplicates(self) -> int:
+        for li in self._duplicates:
+            li.replace_with("")
+        self._duplicates.clear()
+        return self._msg_count
+
+    @staticmethod
+    def _check_auth(data: dict | t.Any):
+        if data and not isinstance(data, dict):
+            raise AuthError(
+                f"Auth failed: expected JSON object response, got: {data!r}. "
+                f"Are you logged in? Refresh the page in your browser."
+            )
 
     @classmethod
     def _handle_response_data(cls, data: dict | t.Any) -> t.Iterable[MessageDTO]:
         if not data:
             return
-        if not isinstance(data, dict):
-            raise RuntimeError(
-                f"Auth failed: expected JSON object response, got: {data!r}. "
-                f"Are you logged in? Refresh the page in your browser."
-            )
+        cls._check_auth(data)
         for _, msg in data.items():
             msg_id, flags, _2, ts, text, attach, _6, _7, num, *_ = msg
             inbox = not bool(flags & 2)
@@ -223,12 +551,23 @@ class Task:
         idx: int,
         event_type: AttachmentEventTypeEnum,
         res: Path | Exception = None,
+        offset: int = None,
     ):
+        """
+        Can be invoked from download workers, so `offset` is the one at the
+        moment of the attachment discovery, not the current one.
+        """
+        if offset is None:
+            offset = self._ctx.offset
         type_letter = hdlr.get_type().upper()[0]
-        attach_idx = f"{self._ctx.offset}/{type_letter}{idx}"
+        attach_idx = f"{offset}/{type_letter}{idx}"
 
         self._attachment_storage[attach_idx] = res
         self._printer.print_attachment(type_letter, attach_idx, event_type)
+        if event_type in (AttachmentEventTypeEnum.SUCCESS, AttachmentEventTypeEnum.FAILED):
+            self._ctx.metrics.count("attachments", type=hdlr.get_type(), status=event_type)
+        if event_type == AttachmentEventTypeEnum.SUCCESS and self._preview_queue:
+            self._preview_queue.submit(hdlr.get_type(), res)
 
         msg = f"Attachment {attach_idx}: {event_type}"
         if res:
@@ -236,5 +575,14 @@ class Task:
         get_logger().debug(msg)
 
     def close(self):
+        self._download_queue.close()
+        if self._preview_queue:
+            self._preview_queue.close()
+        self._ctx.attachment_cache.close()
+        if self._checkpoint.offset is not None and not self._checkpoint.state.get("complete"):
+            if not self._page_in_progress and not self._failed_requests:
+                self._checkpoint.save(self._get_state())
         for actor in self._writers:
             actor.close()
+        if self._transport:
+            self._transport.close()
@@ -0,0 +1,223 @@
+# ------------------------------------------------------------------------------
+#  vkimexp [VK dialogs exporter]
+#  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
+# ------------------------------------------------------------------------------
+
+import base64
+import typing as t
+import zlib
+from array import array
+from bisect import bisect_left
+
+
+class Bitmap:
+    """
+    Set of integers stored as a bit array, which grows in both directions on
+    demand. Takes one bit per value in the range between the lowest and the
+    highest ones added, which is very compact for dense sets (such as message
+    indexes within one dialog), compared to regular sets.
+    """
+
+    def __init__(self, state: dict = None):
+        self._base = 0  # value corresponding to the first bit
+        self._bits = bytearray()
+        self._count = 0
+
+        if state:
+            self._base = state["base"]
+            self._bits = bytearray(zlib.decompress(base64.b64decode(state["bits"])))
+            self._count = state["count"]
+
+    def add(self, value: int) -> bool:
+        """
+        :return: True if value was not present before.
+        """
+        pos = self._locate(value)
+        byte, mask = pos >> 3, 1 << (pos & 7)
+        if self._bits[byte] & mask:
+            return False
+        self._bits[byte] |= mask
+        self._count += 1
+        return True
+
+    def update(self, values: t.Iterable[int]):
+        for value in values:
+            self.add(value)
+
+    def clear(self):
+        self._bits.clear()
+        self._count = 0
+
+    def get_state(self) -> dict:
+        return {
+            "base": self._base,
+            "bits": base64.b64encode(zlib.compress(self._bits)).decode(),
+            "count": self._count,
+        }
+
+    def __contains__(self, value: int) -> bool:
+        pos = value - self._base
+        if pos < 0 or pos >= len(self._bits) * 8:
+            return False
+        return bool(self._bits[pos >> 3] & (1 << (pos & 7)))
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __iter__(self) -> t.Iterator[int]:
+        for byte, bits in enumerate(self._bits):
+            if bits:
+                yield from (self._base + byte * 8 + n for n in range(8) if bits & (1 << n))
+
+    def _locate(self, value: int) -> int:
+        """
+        Get bit position of `value`, growing the array if it's out of bounds
+        (at least twice, so that the reallocations are amortized).
+        """
+        if not self._bits:
+            self._base = value // 8 * 8
+        pos = value - self._base
+
+        if pos < 0:
+            extra = (max(-pos, len(self._bits) * 8) + 7) // 8
+            self._bits[:0] = bytes(extra)
+            self._base -= extra * 8
+            pos += extra * 8
+        elif (byte := pos >> 3) >= len(self._bits):
+            self._bits.extend(bytes(max(byte + 1 - len(self._bits), len(self._bits))))
+        return pos
+
+
+class SparseSet:
+    """
+    Set of integers split into blocks of 2^16 values, each of which is stored
+    either as a sorted array of 16-bit offsets (while there are few values in
+    the block), or as a bitmap (similar to "roaring bitmaps"). Takes 2 bytes per
+    value at most, no matter how far apart the values are, which suits message
+    IDs: they are shared by all dialogs, so IDs of a single dialog are scattered
+    over the whole range of them.
+    """
+
+    BLOCK_BITS = 16
+    _BLOCK_MASK = (1 << BLOCK_BITS) - 1
+    _ARRAY_MAX_LEN = (1 << BLOCK_BITS) // 16  # at this point bitmap is smaller than array
+
+    def __init__(self, state: dict = None):
+        self._blocks: dict[int, array | bytearray] = dict()
+        self._count = 0
+
+        if state and "bits" in state:  # saved as a `Bitmap` by previous versions
+            self.update(Bitmap(state))
+        elif state:
+            keys, sizes = array("q", self._decode(state["keys"])), array("l", self._decode(state["sizes"]))
+            data, pos = self._decode(state["data"]), 0
+            for key, size in zip(keys, sizes):
+                if size < 0:  # bitmap
+                    self._blocks[key] = bytearray(data[pos : pos - size])
+                    pos -= size
+                else:
+                    self._blocks[key] = array("H", data[pos : pos + size * 2])
+                    pos += size * 2
+            self._count = state["count"]
+
+    def add(self, value: int) -> bool:
+        """
+        :return: True if value was not present before.
+        """
+        key, low = value >> self.BLOCK_BITS, value & self._BLOCK_MASK
+        if (block := self._blocks.get(key)) is None:
+            self._blocks[key] = array("H", [low])
+        elif isinstance(block, bytearray):
+            if block[low >> 3] & (1 << (low & 7)):
+                return False
+            block[low >> 3] |= 1 << (low & 7)
+        else:
+            pos = bisect_left(block, low)
+            if pos < len(block) and block[pos] == low:
+                return False
+            block.insert(pos, low)
+            if len(block) > self._ARRAY_MAX_LEN:
+                self._blocks[key] = self._to_bitmap(block)
+        self._count += 1
+        return True
+
+    def update(self, values: t.Iterable[int]):
+        for value in values:
+            self.add(value)
+
+    def clear(self):
+        self._blocks.clear()
+        self._count = 0
+
+    def get_state(self) -> dict:
+        """
+        All blocks are saved as one blob, as there can be as many of them as
+        there are values, and per-block fields would take more than the data.
+        """
+        keys = array("q", self._blocks.keys())
+        sizes = array("l", (-len(b) if isinstance(b, bytearray) else len(b) for b in self._blocks.values()))
+        return {
+            "keys": self._encode(keys),
+            "sizes": self._encode(sizes),
+            "data": self._encode(b"".join(bytes(b) for b in self._blocks.values())),
+            "count": self._count,
+        }
+
+    def __contains__(self, value: int) -> bool:
+        low = value & self._BLOCK_MASK
+        if (block := self._blocks.get(value >> self.BLOCK_BITS)) is None:
+            return False
+        if isinstance(block, bytearray):
+            return bool(block[low >> 3] & (1 << (low & 7)))
+        pos = bisect_left(block, low)
+        return pos < len(block) and block[pos] == low
+
+    def __len__(self) -> int:
+        return self._count
+
+    @staticmethod
+    def _encode(data: array | bytes) -> str:
+        return base64.b64encode(zlib.compress(data)).decode()
+
+    @staticmethod
+    def _decode(data: str) -> bytes:
+        return zlib.decompress(base64.b64decode(data))
+
+    def _to_bitmap(self, block: array) -> bytearray:
+        bits = bytearray(1 << (self.BLOCK_BITS - 3))
+        for low in block:
+            bits[low >> 3] |= 1 << (low & 7)
+        return bits
+
+
+IntSet = Bitmap | SparseSet
+
+
+class DedupIndex:
+    """
+    Registry of already processed messages, shared between the task and the
+    writers. Each of them has its own plane (a separate set), as the same
+    message is to be processed once by every consumer. Planes of message
+    indexes are `Bitmap`s, as the indexes are dense; message IDs are not.
+    """
+
+    MSG_ID = "msg_id"
+    INDEX = "index"
+    JSON = "json"
+
+    _PLANE_TYPES: dict[str, type[IntSet]] = {MSG_ID: SparseSet}
+
+    def __init__(self):
+        self._planes: dict[str, IntSet] = dict()
+
+    def get_plane(self, name: str) -> IntSet:
+        if name not in self._planes:
+            self._planes[name] = self._PLANE_TYPES.get(name, Bitmap)()
+        return self._planes[name]
+
+    def restore(self, state: dict):
+        for name, plane_state in state.items():
+            self._planes[name] = self._PLANE_TYPES.get(name, Bitmap)(plane_state)
+
+    def get_state(self) -> dict:
+        return {name: plane.get_state() for name, plane in self._planes.items()}
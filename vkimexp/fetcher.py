@@ -0,0 +1,116 @@
+# ------------------------------------------------------------------------------
+#  vkimexp [VK dialogs exporter]
+#  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
+# ------------------------------------------------------------------------------
+
+import contextvars
+import queue
+import typing as t
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from threading import Thread, Event
+
+from .common import get_logger
+
+ImData = tuple[str, dict, int]
+PageResult = tuple[int, int, ImData | Exception]
+
+
+class PageFetcher:
+    """
+    Fetches history pages one by one right when they are requested by the
+    processing stage. Request rate is governed by `fetch_fn` (see `RateLimiter`).
+    """
+
+    def __init__(self, fetch_fn: t.Callable[[int], ImData]):
+        self._fetch_fn = fetch_fn
+
+    def iter_pages(self, pages: t.Iterable[tuple[int, int]]) -> t.Iterator[PageResult]:
+        """
+        :param pages: (page, offset) pairs, in the order they should be processed in
+        :return: (page, offset, im_data) triplets in the same order, with im_data
+                 being an exception instance if the request has failed
+        """
+        for page, offset in pages:
+            yield page, offset, self._fetch(offset)
+
+    def _fetch(self, offset: int) -> ImData | Exception:
+        try:
+            return self._fetch_fn(offset)
+        except Exception as e:
+            return e
+
+
+class PrefetchingPageFetcher(PageFetcher):
+    """
+    Fetches history pages in a separate thread, running ahead of the processing
+    stage by `depth` pages at most.
+    """
+
+    def __init__(self, fetch_fn: t.Callable[[int], ImData], depth: int):
+        super().__init__(fetch_fn)
+        self._depth = depth
+
+    def iter_pages(self, pages: t.Iterable[tuple[int, int]]) -> t.Iterator[PageResult]:
+        results = queue.Queue[PageResult | None](maxsize=self._depth)
+        stop = Event()
+
+        def put(result: PageResult | None) -> bool:
+            while not stop.is_set():
+                try:
+                    results.put(result, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def produce():
+            try:
+                for page, offset in pages:
+                    if not put((page, offset, self._fetch(offset))):
+                        return
+            finally:
+                put(None)
+
+        producer = Thread(target=contextvars.copy_context().run, args=(produce,), name="prefetch", daemon=True)
+        producer.start()
+        get_logger().debug(f"Started prefetching with depth {self._depth}")
+        try:
+            while (result := results.get()) is not None:
+                yield result
+        finally:
+            stop.set()
+            producer.join()
+
+
+class ConcurrentPageFetcher(PageFetcher):
+    """
+    Fetches history pages with a pool of `jobs` workers. Responses can arrive in
+    any order, but are yielded in the original one, i.e. the first pending page
+    blocks the rest of them in a reorder buffer. Amount of pages requested, but
+    not yet consumed, is limited by `window`, which also bounds memory usage.
+    """
+
+    def __init__(self, fetch_fn: t.Callable[[int], ImData], jobs: int, window: int):
+        super().__init__(fetch_fn)
+        self._jobs = jobs
+        self._window = max(jobs, window)
+
+    def iter_pages(self, pages: t.Iterable[tuple[int, int]]) -> t.Iterator[PageResult]:
+        pages = iter(pages)
+        pending = deque[tuple[int, int, Future]]()
+        executor = ThreadPoolExecutor(self._jobs, thread_name_prefix="fetch")
+        get_logger().debug(f"Started fetching with {self._jobs} workers, window {self._window}")
+
+        try:
+            while True:
+                while len(pending) < self._window and (next_page := next(pages, None)):
+                    page, offset = next_page
+                    future = executor.submit(contextvars.copy_context().run, self._fetch, offset)
+                    pending.append((page, offset, future))
+                if not pending:
+                    break
+                page, offset, future = pending.popleft()
+                yield page, offset, future.result()
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
@@ -3,20 +3,197 @@
 #  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
 # ------------------------------------------------------------------------------
 
+import contextvars
+import hashlib
 import json
 import operator
 import os.path
 import re
+import typing as t
 from abc import abstractmethod, ABCMeta
+from concurrent.futures import ThreadPoolExecutor, Future, wait
 from json import JSONDecodeError
 from pathlib import Path
+from threading import BoundedSemaphore, Lock
 
-import requests
-from bs4 import BeautifulSoup, ResultSet
+from bs4 import BeautifulSoup, Tag
 from urllib3.util import parse_url
 
-from .common import Context, HOST, AttachmentEventTypeEnum
+from .cache import CacheStatusEnum
+from .common import Context, AttachmentEventTypeEnum
 from .common import DownloadError
+from .preview import PreviewQueue
+from .transport import Transport
+from .visitor import DomVisitor, Selector
+
+# (idx, urls, local path relative to output dir, event type, error), see `AttachmentHandler.handle_deferred()`
+DeferredAttachment = tuple[int, list[str] | None, Path | None, AttachmentEventTypeEnum, Exception | None]
+
+
+class DownloadQueue:
+    """
+    Bounded pool of workers which download attachments in the background, so
+    that page processing doesn't have to wait for them. Local paths are known
+    beforehand, therefore HTML can be rewritten right away. Zero concurrency
+    means that downloads are performed in place, i.e. synchronously.
+    """
+
+    _PENDING_PER_WORKER = 8
+
+    def __init__(self, ctx: Context):
+        self._ctx = ctx
+        self._executor: ThreadPoolExecutor | None = None
+        self._slots: BoundedSemaphore | None = None
+        self._futures: set[Future] = set()
+        self._lock = Lock()
+
+        if concurrency := ctx.download_jobs:
+            self._executor = ThreadPoolExecutor(concurrency, thread_name_prefix="download")
+            self._slots = BoundedSemaphore(concurrency * self._PENDING_PER_WORKER)
+
+    def submit(
+        self,
+        hdlr: "AttachmentHandler",
+        idx: int,
+        urls: list[str],
+        local_abs_path: Path,
+        attachment_event_cb: callable,
+        event_type: AttachmentEventTypeEnum = AttachmentEventTypeEnum.STARTED,
+    ):
+        offset = self._ctx.offset
+        attachment_event_cb(hdlr, idx, event_type, urls[0], offset=offset)
+        args = (hdlr, idx, urls, local_abs_path, attachment_event_cb, offset)
+
+        if not self._executor:
+            self._run(*args)
+            return
+
+        self._slots.acquire()
+        future = self._executor.submit(contextvars.copy_context().run, self._run, *args)
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._release)
+
+    def join(self):
+        while True:
+            with self._lock:
+                futures = [*self._futures]
+            if not futures:
+                return
+            wait(futures)
+
+    def close(self):
+        self.join()
+        if self._executor:
+            self._executor.shutdown()
+
+    def _run(
+        self,
+        hdlr: "AttachmentHandler",
+        idx: int,
+        urls: list[str],
+        local_abs_path: Path,
+        attachment_event_cb: callable,
+        offset: int,
+    ):
+        last_error = None
+        for url in urls:
+            try:
+                with self._ctx.metrics.measure("download." + hdlr.get_type()):
+                    hdlr.download(url, local_abs_path)
+            except Exception as e:
+                last_error = e
+                continue
+            hdlr.remember(urls, local_abs_path)
+            attachment_event_cb(hdlr, idx, AttachmentEventTypeEnum.SUCCESS, local_abs_path, offset=offset)
+            return
+
+        hdlr.forget(urls, local_abs_path, last_error)
+        attachment_event_cb(hdlr, idx, AttachmentEventTypeEnum.FAILED, last_error, offset=offset)
+
+    def _release(self, future: Future):
+        with self._lock:
+            self._futures.discard(future)
+        self._slots.release()
+
+
+class PartialDownload:
+    """
+    Temporary file the attachment is streamed into, which replaces the target
+    file only when it's complete and its size is the expected one, so that an
+    interrupted download never leaves a truncated file under the final name.
+    The next attempt to download the same URL continues from where the previous
+    one has stopped, if the server supports range requests.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, url: str, local_abs_path: Path):
+        url_hash = hashlib.sha1(url.encode()).hexdigest()[:8]
+        self.path = local_abs_path.with_name(f".{local_abs_path.name}.{url_hash}.part")
+        try:
+            self.offset = self.path.stat().st_size
+        except FileNotFoundError:
+            self.offset = 0
+        self._expected_size: int | None = None
+        self._file: t.BinaryIO | None = None
+
+    def get_request_headers(self) -> dict:
+        # compressed transfer would make both ranges and sizes meaningless
+        headers = {"accept-encoding": "identity"}
+        if self.offset:
+            headers["range"] = f"bytes={self.offset}-"
+        return headers
+
+    def is_stale(self, status: int) -> bool:
+        """
+        :return: True if the server rejected the range, i.e. partial file should
+                 be discarded and the download should start from scratch.
+        """
+        return status == 416 and self.offset > 0
+
+    def begin(self, status: int, headers: t.Mapping[str, str]):
+        if status == 206 and self.offset:
+            range_match = re.fullmatch(r"bytes (\d+)-\d+/(\d+|\*)", headers.get("content-range", ""))
+            if not range_match or int(range_match.group(1)) != self.offset:
+                self.discard()
+                raise DownloadError(f"Unexpected content range: {headers.get('content-range')!r}")
+            if range_match.group(2) != "*":
+                self._expected_size = int(range_match.group(2))
+            self._file = open(self.path, "ab")
+            return
+
+        self.offset = 0
+        if content_length := headers.get("content-length"):
+            self._expected_size = int(content_length)
+        self._file = open(self.path, "wb")
+
+    def write(self, chunk: bytes):
+        self._file.write(chunk)
+
+    def finish(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        size = os.fstat(self._file.fileno()).st_size
+        self._file.close()
+
+        if self._expected_size is not None and size != self._expected_size:
+            if size > self._expected_size:
+                self.discard()  # can't be continued
+            raise DownloadError(f"Size mismatch: expected {self._expected_size} bytes, got {size}")
+
+    def abort(self):
+        """
+        Keep what's been received for the next attempt.
+        """
+        if self._file and not self._file.closed:
+            self._file.close()
+
+    def discard(self):
+        self.abort()
+        self.path.unlink(missing_ok=True)
+        self.offset = 0
+        self._expected_size = None
 
 
 class AttachmentHandler(metaclass=ABCMeta):
@@ -31,47 +208,192 @@ class AttachmentHandler(metaclass=ABCMeta):
     def get_type(cls) -> str:
         ...
 
-    def __init__(self, ctx: Context):
+    @classmethod
+    @abstractmethod
+    def get_selector(cls) -> Selector:
+        ...
+
+    def __init__(self, ctx: Context, transport: Transport, queue: DownloadQueue):
         self._ctx = ctx
+        self._transport = transport
+        self._queue = queue
         os.makedirs(self._get_out_subdir(), exist_ok=True)
 
         self.url_to_abs_path_map: dict[str, Path] = dict()
-        self.prepared: ResultSet | None = None
+        self.prepared: list[Tag] = []
+        self._failed_links: dict[str, str] = dict()
+        self._failed_links_lock = Lock()
 
-    @abstractmethod
-    def prepare(self, soup: BeautifulSoup) -> int:
-        ...
+    def subscribe(self, visitor: DomVisitor):
+        visitor.on_begin(self._reset)
+        visitor.subscribe(self.get_selector(), self.prepared.append)
+
+    def _reset(self, _: BeautifulSoup):
+        self.prepared.clear()
 
     @abstractmethod
     def handle(self, soup: BeautifulSoup, attachment_event_cb: callable) -> None:
         ...
 
+    def handle_deferred(self, deferred: list[DeferredAttachment], attachment_event_cb: callable):
+        """
+        Process the attachments which were found by `handle()` in another process
+        (see `replay.PageRenderer`): either enqueue them, or report the errors.
+        """
+        for idx, urls, local_rel_path, event_type, error in deferred:
+            if error:
+                attachment_event_cb(self, idx, event_type, error)
+                continue
+            local_abs_path = self._ctx.out_dir / local_rel_path if local_rel_path else None
+            self._enqueue(idx, urls, attachment_event_cb, local_abs_path, event_type)
+
+    def download(self, url: str, local_abs_path: Path) -> Path:
+        if self.restore(url, local_abs_path):
+            return local_abs_path
+
+        self._ctx.totals.attach_found.increment()
+        part = PartialDownload(url, local_abs_path)
+        while True:
+            with self._transport.get(url, stream=True, headers=part.get_request_headers()) as response:
+                if part.is_stale(response.status_code):
+                    part.discard()
+                    continue
+                if not response.ok:
+                    self.raise_download_error(url, response.status_code, part)
+
+                part.begin(response.status_code, response.headers)
+                try:
+                    for chunk in response.iter_content(part.CHUNK_SIZE):
+                        part.write(chunk)
+                        self._ctx.metrics.count("downloaded_bytes", len(chunk), type=self.get_type())
+                    part.finish()
+                except BaseException:
+                    part.abort()
+                    raise
+            break
+
+        self.save(url, part.path, local_abs_path)
+        self._ctx.totals.attach_downloaded.increment()
+        return local_abs_path
+
+    def restore(self, url: str, local_abs_path: Path) -> bool:
+        """
+        :return: True if the attachment is already present at the output directory,
+                 or it has been linked from the content store.
+        """
+        if local_abs_path.exists() or (self._ctx.store is not None and self._ctx.store.link(url, local_abs_path)):
+            self._ctx.metrics.count("cache_hits", type=self.get_type())
+            return True
+        return False
+
+    def save(self, url: str, part_path: Path, local_abs_path: Path):
+        """
+        Move completely downloaded file to its place.
+        """
+        if self._ctx.store is not None:
+            self._ctx.store.put(url, part_path, local_abs_path)
+            return
+        os.replace(part_path, local_abs_path)  # atomic write
+
+    def raise_download_error(self, url: str, status: int, part: PartialDownload):
+        error = DownloadError(f"Failed to download {self.get_type()} (HTTP {status}): {url}", status)
+        if error.permanent:
+            part.discard()
+        raise error
+
+    def remember(self, urls: list[str], local_abs_path: Path):
+        """
+        Record successfully downloaded attachment and get rid of partial files
+        left by the other sources (fallback URLs).
+        """
+        local_rel_path = local_abs_path.relative_to(self._ctx.out_dir)
+        self._ctx.attachment_cache.put(urls[0], local_rel_path, local_abs_path.stat().st_size)
+        with self._failed_links_lock:
+            self._failed_links.pop(str(local_rel_path), None)
+        if len(urls) > 1:
+            for url in urls:
+                PartialDownload(url, local_abs_path).discard()
+
+    def forget(self, urls: list[str], local_abs_path: Path, error: Exception = None):
+        """
+        Record failed attachment. As the page could be written already, its local
+        path is remembered, so that the link could be pointed back to the remote
+        URL later (see `get_failed_links()`).
+        """
+        self.url_to_abs_path_map.pop(urls[0], None)
+        self._add_failed_link(urls[0], local_abs_path)
+        if isinstance(error, DownloadError) and error.permanent:
+            self._ctx.attachment_cache.put_failed(urls[0], error)
+
+    def get_failed_links(self) -> dict[str, str]:
+        """
+        :return: local paths (relative to output dir) of the attachments which
+                 failed to download, mapped to their remote URLs.
+        """
+        with self._failed_links_lock:
+            return dict(self._failed_links)
+
+    def _add_failed_link(self, url: str, local_abs_path: Path):
+        local_rel_path = local_abs_path.relative_to(self._ctx.out_dir)
+        with self._failed_links_lock:
+            self._failed_links[str(local_rel_path)] = url
+
     def _get_out_subdir(self) -> Path:
         return self._ctx.out_dir / self.get_type()
 
-    def _download(self, url: str) -> Path:
+    def _set_preview(self, img: Tag, local_abs_path: Path):
+        """
+        Make `img` display the preview of the attachment, which is made after the
+        download (see `PreviewQueue`), or the attachment itself if there is none.
+        """
+        local_rel_path = local_abs_path.relative_to(self._ctx.out_dir)
+        preview_rel_path = PreviewQueue.get_preview_path(self._ctx, local_abs_path).relative_to(self._ctx.out_dir)
+        img["src"] = "./" + str(preview_rel_path)
+        img["data-original"] = "./" + str(local_rel_path)
+        img["onerror"] = "this.onerror=null; this.src=this.dataset.original"
+        img["loading"] = "lazy"
+
+    def _get_local_abs_path(self, url: str) -> Path:
         remote_path = parse_url(url).path
         basename = os.path.basename(remote_path)
         if len(basename) < 10:
             basename = re.sub(r"[^\d\w]+", "-", remote_path).strip("-")
-
-        local_abs_path = self._get_out_subdir() / basename
-        if local_abs_path.exists():
+        return self._get_out_subdir() / basename
+
+    def _enqueue(
+        self,
+        idx: int,
+        urls: list[str],
+        attachment_event_cb: callable,
+        local_abs_path: Path = None,
+        event_type: AttachmentEventTypeEnum = AttachmentEventTypeEnum.STARTED,
+    ) -> Path | None:
+        """
+        Return local path of the attachment right away, while the actual
+        downloading is (possibly) happening in the background.
+
+        :return: None if the attachment is known to be unavailable, i.e. the
+                 remote URL should be kept.
+        """
+        if known_abs_path := self.url_to_abs_path_map.get(urls[0]):
+            return known_abs_path
+
+        local_abs_path = local_abs_path or self._get_local_abs_path(urls[0])
+        if cached := self._ctx.attachment_cache.get(urls[0]):
+            self._ctx.metrics.count("cache_hits", type=self.get_type())
+            attachment_event_cb(self, idx, event_type, urls[0])
+            if cached.status == CacheStatusEnum.FAILED:
+                # the page could have been rendered already (see `handle_deferred()`)
+                self._add_failed_link(urls[0], local_abs_path)
+                attachment_event_cb(self, idx, AttachmentEventTypeEnum.FAILED, DownloadError(cached.error))
+                return None
+            local_abs_path = self._ctx.out_dir / cached.path
+            self.url_to_abs_path_map[urls[0]] = local_abs_path
+            attachment_event_cb(self, idx, AttachmentEventTypeEnum.SUCCESS, local_abs_path)
             return local_abs_path
 
-        self._ctx.totals.attach_found.increment()
-        try:
-            response = requests.get(url)
-        except requests.exceptions.MissingSchema:
-            response = requests.get(HOST + url)
-
-        if not response.ok:
-            raise DownloadError(f"Failed to download {self.get_type()} (HTTP {response.status_code}): {url}")
-
-        with open(local_abs_path, "wb") as f:
-            f.write(response.content)
-
-        self._ctx.totals.attach_downloaded.increment()
+        self.url_to_abs_path_map[urls[0]] = local_abs_path
+        self._queue.submit(self, idx, urls, local_abs_path, attachment_event_cb, event_type)
         return local_abs_path
 
 
@@ -85,47 +407,47 @@ class PhotosHandler(AttachmentHandler):
     def get_type(cls) -> str:
         return "photo"
 
-    def prepare(self, soup: BeautifulSoup) -> int:
-        self.prepared = soup.find_all(name="a", attrs={"aria-label": "фотография"})
-        return len(self.prepared)
+    @classmethod
+    def get_selector(cls) -> Selector:
+        return Selector("a", {"aria-label": "фотография"})
 
     def handle(self, soup: BeautifulSoup, attachment_event_cb: callable) -> None:
         for idx, a in enumerate(self.prepared):
             try:
                 source_url = self._extract_from_onclick(a.get("onclick"))
-                if source_url in self.url_to_abs_path_map.keys():
-                    source_local_abs_path = self.url_to_abs_path_map[source_url]
-                else:
-                    attachment_event_cb(self, idx, AttachmentEventTypeEnum.STARTED, source_url)
-                    source_local_abs_path = self._download(source_url)
-                    attachment_event_cb(self, idx, AttachmentEventTypeEnum.SUCCESS, source_local_abs_path)
-                    self.url_to_abs_path_map[source_url] = source_local_abs_path
-                source_local_rel_path = source_local_abs_path.relative_to(self._ctx.out_dir)
-            except (DownloadError, ValueError) as e:
+                thumb_url = self._extract_from_style(a.get("style"))
+            except ValueError as e:
                 attachment_event_cb(self, idx, AttachmentEventTypeEnum.FAILED, e)
                 continue
 
-            try:
-                thumb_url = self._extract_from_style(a.get("style"))
-                if thumb_url in self.url_to_abs_path_map.keys():
-                    thumb_local_abs_path = self.url_to_abs_path_map[thumb_url]
-                else:
-                    attachment_event_cb(self, idx, AttachmentEventTypeEnum.PARTIAL, thumb_url)
-                    thumb_local_abs_path = self._download(thumb_url, thumb=True)
-                    attachment_event_cb(self, idx, AttachmentEventTypeEnum.SUCCESS, thumb_local_abs_path)
-                    self.url_to_abs_path_map[thumb_url] = thumb_local_abs_path
-                thumb_local_rel_path = thumb_local_abs_path.relative_to(self._ctx.out_dir)
-            except (DownloadError, ValueError) as e:
-                attachment_event_cb(self, idx, AttachmentEventTypeEnum.FAILED, e)
+            if not (source_local_abs_path := self._enqueue(idx, [source_url], attachment_event_cb)):
                 continue
+            source_local_rel_path = source_local_abs_path.relative_to(self._ctx.out_dir)
 
             a["href"] = "./" + str(source_local_rel_path)
-            a["style"] = "display: block; background-size: contain; " + a["style"].replace(
-                thumb_url, "./" + str(thumb_local_rel_path)
-            )
             a["target"] = "_blank"
             del a["onclick"]
 
+            if self._ctx.previews:
+                # preview is made from the original, so the thumb is not needed
+                a["style"] = "display: block; " + re.sub(r"background-image:\s+url\(.+\);\s*", "", a["style"])
+                img = soup.new_tag("img", attrs={"class": "preview"})
+                self._set_preview(img, source_local_abs_path)
+                a.append(img)
+                continue
+
+            thumb_local_abs_path = self._enqueue(
+                idx,
+                [thumb_url],
+                attachment_event_cb,
+                self._get_local_abs_path(thumb_url, thumb=True),
+                AttachmentEventTypeEnum.PARTIAL,
+            )
+            if thumb_local_abs_path:
+                thumb_local_rel_path = thumb_local_abs_path.relative_to(self._ctx.out_dir)
+                a["style"] = a["style"].replace(thumb_url, "./" + str(thumb_local_rel_path))
+            a["style"] = "display: block; background-size: contain; " + a["style"]
+
     @classmethod
     def _extract_from_onclick(cls, onclick: str) -> str:
         jmatch = re.search(r"(?:showPhoto|showManyPhoto.pbind)\(.+?(\{.+\}).*\)", onclick)
@@ -158,27 +480,12 @@ class PhotosHandler(AttachmentHandler):
             raise ValueError(f"Thumb URL not found for photo")
         return urlmatch.group(1)
 
-    def _download(self, url: str, thumb=False) -> Path:
-        remote_path = parse_url(url).path
-        basename = os.path.basename(remote_path)
+    def _get_local_abs_path(self, url: str, thumb=False) -> Path:
+        basename = os.path.basename(parse_url(url).path)
         if thumb:
             name, ext = os.path.splitext(basename)
             basename = f"{name}_{ext}"
-
-        local_abs_path = Path(self._get_out_subdir()) / basename
-        if local_abs_path.exists():
-            return local_abs_path
-
-        self._ctx.totals.attach_found.increment()
-        response = requests.get(url)
-        if not response.ok:
-            raise DownloadError(f"Failed to download photo (HTTP {response.status_code}): {url}")
-
-        with open(local_abs_path, "wb") as f:
-            f.write(response.content)
-
-        self._ctx.totals.attach_downloaded.increment()
-        return local_abs_path
+        return self._get_out_subdir() / basename
 
 
 class AudioMsgsHandler(AttachmentHandler):
@@ -186,38 +493,23 @@ class AudioMsgsHandler(AttachmentHandler):
     def get_type(self) -> str:
         return "audiomsg"
 
-    def prepare(self, soup: BeautifulSoup) -> int:
-        self.prepared = soup.find_all(name="div", attrs={"class": "audio-msg-track"})
-        return len(self.prepared)
+    @classmethod
+    def get_selector(cls) -> Selector:
+        return Selector("div", {"class": "audio-msg-track"})
 
     def handle(self, soup: BeautifulSoup, attachment_event_cb: callable) -> None:
         for idx, div in enumerate(self.prepared):
-            data_urls = [div.get("data-mp3"), div.get("data-ogg")]
-            last_error = None
-            local_abs_path = None
-
-            while local_abs_path is None:
-                if not len(data_urls):
-                    attachment_event_cb(self, idx, AttachmentEventTypeEnum.FAILED, last_error)
-                    break
-
-                url = data_urls.pop(0)
-                if url in self.url_to_abs_path_map.keys():
-                    local_abs_path = self.url_to_abs_path_map[url]
-                else:
-                    attachment_event_cb(self, idx, AttachmentEventTypeEnum.STARTED, url)
-                    try:
-                        local_abs_path = self._download(url)
-                    except DownloadError as e:
-                        last_error = e
-                        continue
-                    attachment_event_cb(self, idx, AttachmentEventTypeEnum.SUCCESS, local_abs_path)
-                    self.url_to_abs_path_map[url] = local_abs_path
-
-                local_rel_path = local_abs_path.relative_to(self._ctx.out_dir)
-                a = soup.new_tag("a", attrs=dict(href=local_rel_path, target="_blank"))
-                a.append(str(local_rel_path))
-                div.append(a)
+            # if mp3 is unavailable, ogg is saved under the same name instead
+            data_urls = [*filter(None, [div.get("data-mp3"), div.get("data-ogg")])]
+            if not data_urls:
+                continue
+
+            if not (local_abs_path := self._enqueue(idx, data_urls, attachment_event_cb)):
+                continue
+            local_rel_path = local_abs_path.relative_to(self._ctx.out_dir)
+            a = soup.new_tag("a", attrs=dict(href=local_rel_path, target="_blank"))
+            a.append(str(local_rel_path))
+            div.append(a)
 
 
 class ImagesHandler(AttachmentHandler):
@@ -230,25 +522,19 @@ class ImagesHandler(AttachmentHandler):
     def get_type(cls) -> str:
         return "image"
 
-    def prepare(self, soup: BeautifulSoup) -> int:
-        self.prepared = soup.find_all(name="img")
-        return len(self.prepared)
+    @classmethod
+    def get_selector(cls) -> Selector:
+        return Selector("img")
 
     def handle(self, soup: BeautifulSoup, attachment_event_cb: callable) -> None:
         for (idx, img) in enumerate(self.prepared):
             url = img.get("src")
             if not url:
                 continue
-            try:
-                if url in self.url_to_abs_path_map.keys():
-                    local_abs_path = self.url_to_abs_path_map[url]
-                else:
-                    attachment_event_cb(self, idx, AttachmentEventTypeEnum.STARTED, url)
-                    local_abs_path = self._download(url)
-                    attachment_event_cb(self, idx, AttachmentEventTypeEnum.SUCCESS, local_abs_path)
-                    self.url_to_abs_path_map[url] = local_abs_path
-
-                local_rel_path = local_abs_path.relative_to(self._ctx.out_dir)
-                img["src"] = "./" + str(local_rel_path)
-            except DownloadError as e:
-                attachment_event_cb(self, idx, AttachmentEventTypeEnum.FAILED, e)
+            if not (local_abs_path := self._enqueue(idx, [url], attachment_event_cb)):
+                continue
+            if self._ctx.previews:
+                self._set_preview(img, local_abs_path)
+                continue
+            local_rel_path = local_abs_path.relative_to(self._ctx.out_dir)
+            img["src"] = "./" + str(local_rel_path)
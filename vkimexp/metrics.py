@@ -0,0 +1,190 @@
+# ------------------------------------------------------------------------------
+#  vkimexp [VK dialogs exporter]
+#  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
+# ------------------------------------------------------------------------------
+
+import json
+import logging
+import os
+import tempfile
+import time
+import typing as t
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Event, Lock, Thread
+
+PROMETHEUS_PREFIX = "vkimexp_"
+
+# counter name: description (for Prometheus "HELP")
+COUNTERS = {
+    "pages": "History pages processed, by status",
+    "fetched_bytes": "Size of history API responses",
+    "downloaded_bytes": "Size of downloaded attachments, by type",
+    "attachments": "Attachments processed, by type and status",
+    "cache_hits": "Attachments which were not downloaded, as they had been already, by type",
+    "retries": "Requests retried, by kind",
+    "previews": "Previews of photos and images processed, by type and status",
+}
+
+
+class Metrics:
+    """
+    Per-stage timers and counters of the export, shared by all the tasks (in
+    all threads). Stage names are like "parse" or "write.html", counters can
+    have labels, e.g. ``count("attachments", type="photo", status="success")``.
+    """
+
+    _instance: "Metrics" = None
+    _instance_lock = Lock()
+
+    @classmethod
+    def get_instance(cls) -> "Metrics":
+        with cls._instance_lock:
+            if not cls._instance:
+                cls._instance = Metrics()
+            return cls._instance
+
+    def __init__(self):
+        self._started_ts = time.monotonic()
+        self._stages: dict[str, list[int | float]] = dict()  # name: [calls, seconds]
+        self._counters: dict[str, dict[tuple[tuple[str, str], ...], int]] = {name: dict() for name in COUNTERS}
+        self._lock = Lock()
+
+    @contextmanager
+    def measure(self, stage: str) -> t.Iterator[None]:
+        started_ts = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started_ts)
+
+    def observe(self, stage: str, sec: float, calls: int = 1):
+        with self._lock:
+            timer = self._stages.setdefault(stage, [0, 0.0])
+            timer[0] += calls
+            timer[1] += sec
+
+    def count(self, name: str, value: int = 1, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counter = self._counters[name]
+            counter[key] = counter.get(key, 0) + value
+
+    def get(self, name: str, **labels: str) -> int:
+        """
+        :return: sum of the counter values with the specified labels.
+        """
+        with self._lock:
+            return sum(v for k, v in self._counters[name].items() if labels.items() <= dict(k).items())
+
+    @property
+    def elapsed_sec(self) -> float:
+        return time.monotonic() - self._started_ts
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            stages = sorted(self._stages.items())
+            return {
+                "elapsed_sec": round(self.elapsed_sec, 3),
+                "stages": {stage: {"calls": calls, "sec": round(sec, 4)} for stage, (calls, sec) in stages},
+                "counters": {
+                    name: [{**dict(k), "value": v} for k, v in sorted(counter.items())]
+                    for name, counter in self._counters.items()
+                },
+            }
+
+    def to_prometheus(self) -> str:
+        """
+        Text exposition format, see https://prometheus.io/docs/instrumenting/exposition_formats/
+        """
+        lines = []
+
+        def add(name: str, type_: str, help_: str, samples: t.Iterable[tuple[dict, float]]):
+            name = PROMETHEUS_PREFIX + name
+            lines.extend([f"# HELP {name} {help_}", f"# TYPE {name} {type_}"])
+            for labels, value in samples:
+                labels_str = ",".join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(f"{name}{{{labels_str}}} {value}" if labels_str else f"{name} {value}")
+
+        with self._lock:
+            add("elapsed_seconds", "gauge", "Time since the start of the export", [({}, round(self.elapsed_sec, 3))])
+            add("last_update_timestamp_seconds", "gauge", "Time of the update", [({}, round(time.time(), 3))])
+            stages = [({"stage": stage}, calls, round(sec, 6)) for stage, (calls, sec) in sorted(self._stages.items())]
+            add("stage_seconds_total", "counter", "Time spent at a stage", [(l, sec) for l, _, sec in stages])
+            add("stage_calls_total", "counter", "Times a stage was entered", [(l, calls) for l, calls, _ in stages])
+            for name, help_ in COUNTERS.items():
+                add(name + "_total", "counter", help_, [(dict(k), v) for k, v in sorted(self._counters[name].items())])
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, path: Path):
+        _write_atomic(path, json.dumps(self.to_dict(), indent=4))
+
+    def write_prometheus(self, path: Path):
+        _write_atomic(path, self.to_prometheus())
+
+
+class MetricsExporter:
+    """
+    Keeps Prometheus textfile (e.g. for node_exporter's textfile collector)
+    up to date during the export, rewriting it every `interval_sec`.
+    """
+
+    def __init__(self, metrics: Metrics, path: Path, interval_sec: float):
+        self._metrics = metrics
+        self._path = path
+        self._interval_sec = interval_sec
+        self._stopped = Event()
+        self._thread = Thread(target=self._run, name="metrics", daemon=True)
+
+    def start(self):
+        self._write()
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self._write()
+
+    def _run(self):
+        while not self._stopped.wait(self._interval_sec):
+            self._write()
+
+    def _write(self):
+        try:
+            self._metrics.write_prometheus(self._path)
+        except OSError as e:
+            logging.getLogger(__package__).warning(f"Failed to write metrics: {e}")
+
+
+class RateMeter:
+    """
+    Rate of the events over the last `WINDOW_SEC` seconds.
+    """
+
+    WINDOW_SEC = 10.0
+
+    def __init__(self):
+        self._samples: deque[tuple[float, float]] = deque()
+        self._started_ts = time.monotonic()
+
+    def add(self, value: float = 1):
+        now = time.monotonic()
+        self._samples.append((now, value))
+        while self._samples[0][0] < now - self.WINDOW_SEC:
+            self._samples.popleft()
+
+    @property
+    def rate(self) -> float:
+        now = time.monotonic()
+        total = sum(v for ts, v in self._samples if ts >= now - self.WINDOW_SEC)
+        return total / max(1e-3, min(self.WINDOW_SEC, now - self._started_ts))
+
+
+def _write_atomic(path: Path, content: str):
+    # scrapers should never see a partially written file
+    fd, tmp_filename = tempfile.mkstemp(dir=path.parent, prefix=path.name)
+    with os.fdopen(fd, "wt") as f:
+        f.write(content)
+    os.chmod(tmp_filename, 0o644)
+    os.replace(tmp_filename, path)
@@ -0,0 +1,112 @@
+# ------------------------------------------------------------------------------
+#  vkimexp [VK dialogs exporter]
+#  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
+# ------------------------------------------------------------------------------
+
+import importlib.util
+import typing as t
+from abc import abstractmethod, ABCMeta
+
+if t.TYPE_CHECKING:
+    from bs4 import BeautifulSoup
+
+
+class ParserBackend(metaclass=ABCMeta):
+    """
+    Parser implementations are responsible for building a soup out of the
+    history page fragments and for converting it back to the HTML. All of them
+    produce regular `BeautifulSoup` trees, so the rest of the app works the
+    same regardless of the backend. `bs4` is imported on first use, as the
+    module is needed for CLI options setup.
+    """
+
+    @classmethod
+    @abstractmethod
+    def get_name(cls) -> str:
+        ...
+
+    @classmethod
+    def is_available(cls) -> bool:
+        return True
+
+    @abstractmethod
+    def parse(self, html: str) -> "BeautifulSoup":
+        ...
+
+    def serialize(self, soup: "BeautifulSoup") -> str:
+        return str(soup)
+
+
+class HtmlParserBackend(ParserBackend):
+    """
+    Pure Python parser from the standard library. Slow, but always available.
+    """
+
+    @classmethod
+    def get_name(cls) -> str:
+        return "html.parser"
+
+    def parse(self, html: str) -> "BeautifulSoup":
+        from bs4 import BeautifulSoup
+
+        return BeautifulSoup(html, features="html.parser")
+
+
+class LxmlParserBackend(ParserBackend):
+    """
+    C-backed parser, several times faster than `html.parser`, but not exactly
+    equivalent to it: whitespace preceding the first element of a fragment is
+    dropped, and invalid nesting is rebuilt differently (e.g. `<p><div>x</div></p>`
+    becomes `<p></p><div>x</div>`), therefore it's used only on demand. It wraps
+    the fragments into <html><body> document, which is undone on the way back.
+    """
+
+    @classmethod
+    def get_name(cls) -> str:
+        return "lxml"
+
+    @classmethod
+    def is_available(cls) -> bool:
+        return importlib.util.find_spec("lxml") is not None
+
+    def parse(self, html: str) -> "BeautifulSoup":
+        from bs4 import BeautifulSoup
+
+        return BeautifulSoup(html, features="lxml")
+
+    def serialize(self, soup: "BeautifulSoup") -> str:
+        from bs4 import NavigableString, Tag
+
+        def decode(el: Tag | NavigableString) -> str:
+            # str() of a text node is not escaped
+            return el.output_ready() if isinstance(el, NavigableString) else el.decode()
+
+        result = []
+        for el in soup.contents:
+            if not isinstance(el, Tag) or el.name != "html":
+                result.append(decode(el))
+                continue
+            for html_el in el.contents:
+                if isinstance(html_el, Tag) and html_el.name == "body":
+                    result.extend(decode(body_el) for body_el in html_el.contents)
+                else:
+                    result.append(decode(html_el))
+        return "".join(result)
+
+
+PARSER_BACKENDS: list[type[ParserBackend]] = [
+    HtmlParserBackend,  # default
+    LxmlParserBackend,
+]
+
+
+def get_parser_backend(name: str = None) -> ParserBackend:
+    """
+    :param name: backend name, or None for the default one
+    """
+    for backend_cls in PARSER_BACKENDS:
+        if name in (None, backend_cls.get_name()):
+            if not backend_cls.is_available():
+                raise RuntimeError(f"Parser {name!r} is unavailable, install the corresponding package")
+            return backend_cls()
+    raise RuntimeError(f"Unknown parser: {name!r}")
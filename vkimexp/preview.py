@@ -0,0 +1,219 @@
+# ------------------------------------------------------------------------------
+#  vkimexp [VK dialogs exporter]
+#  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
+# ------------------------------------------------------------------------------
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import typing as t
+from collections import deque
+from concurrent.futures import Future, wait
+from dataclasses import dataclass
+from pathlib import Path
+from threading import Lock
+
+from .common import Context, get_logger
+
+if t.TYPE_CHECKING:
+    from concurrent.futures import ProcessPoolExecutor
+
+# format: file extension
+PREVIEW_FORMATS = {"webp": "webp", "jpeg": "jpg"}
+
+
+def check_format(fmt: str):
+    """
+    :raises RuntimeError: if Pillow is not installed or can't write `fmt` files.
+    """
+    try:
+        from PIL import features
+    except ImportError as e:
+        raise RuntimeError(f"Previews require 'Pillow' package to be installed: {e}") from e
+    if fmt == "webp" and not features.check("webp"):
+        raise RuntimeError("Installed 'Pillow' package is built without WebP support, use 'jpeg' previews instead")
+
+
+@dataclass(frozen=True)
+class _PreviewJob:
+    attachment_type: str
+    key: str  # path of the source relative to output dir
+    source_id: list[int]  # size, mtime_ns
+    source_path: Path
+    preview_path: Path
+    max_side: int
+
+
+class PreviewQueue:
+    """
+    Makes downsized copies of downloaded photos and images for the HTML pages
+    to load instead of the originals (see `AttachmentHandler._set_preview()`).
+    Images are processed by a pool of processes in the background; the pool
+    is started on the first image which needs a preview. Submitting never
+    blocks (it's done from the event loop by asyncio engine): images above the
+    pool capacity are put into a backlog, which is drained as the pool becomes
+    free. Size and mtime of the originals are recorded into a manifest, so that
+    the next runs only process new or changed ones. Process pool machinery is
+    imported on first use, as the module is needed for CLI options setup.
+    """
+
+    DIRNAME = "preview"
+    MANIFEST_FILENAME = "manifest.json"
+    MAX_SIDE = {"photo": 604, "image": 256}  # px, photos are displayed 302px wide
+    QUALITY = 80
+
+    _PENDING_PER_WORKER = 8
+
+    def __init__(self, ctx: Context):
+        self._ctx = ctx
+        self._manifest_path = ctx.out_dir / self.DIRNAME / self.MANIFEST_FILENAME
+        self._manifest: dict[str, list[int]] = self._load_manifest()  # path: [size, mtime_ns]
+        self._manifest_changed = False
+        self._submitted: set[str] = set()
+        self._executor: "ProcessPoolExecutor | None" = None
+        self._max_pending = 0
+        self._pending = 0  # submitted to the pool
+        self._backlog: deque[_PreviewJob] = deque()
+        self._futures: set[Future] = set()
+        self._lock = Lock()
+
+    @classmethod
+    def get_preview_path(cls, ctx: Context, local_abs_path: Path) -> Path:
+        local_rel_path = local_abs_path.relative_to(ctx.out_dir)
+        filename = f"{local_rel_path.name}.{PREVIEW_FORMATS[ctx.previews]}"  # e.g. "photo.jpg.webp"
+        return ctx.out_dir / cls.DIRNAME / local_rel_path.parent / filename
+
+    def submit(self, attachment_type: str, local_abs_path: Path):
+        if not (max_side := self.MAX_SIDE.get(attachment_type)):
+            return
+        try:
+            stat = local_abs_path.stat()
+        except OSError:
+            return
+        key = str(local_abs_path.relative_to(self._ctx.out_dir))
+        source_id = [stat.st_size, stat.st_mtime_ns]
+        preview_abs_path = self.get_preview_path(self._ctx, local_abs_path)
+
+        with self._lock:
+            if key in self._submitted:
+                return
+            self._submitted.add(key)
+            if self._manifest.get(key) == source_id and preview_abs_path.exists():
+                self._ctx.metrics.count("previews", type=attachment_type, status="skipped")
+                return
+            if not self._executor:
+                self._start()
+            job = _PreviewJob(attachment_type, key, source_id, local_abs_path, preview_abs_path, max_side)
+            if self._pending >= self._max_pending:
+                self._backlog.append(job)
+                return
+            self._pending += 1
+        self._submit(job)
+
+    def close(self):
+        while True:
+            with self._lock:
+                if not self._pending:
+                    break
+                futures = [*self._futures]
+            wait(futures)  # backlog is submitted from the done callbacks
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._manifest_changed:
+            self._save_manifest()
+
+    def _start(self):
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        workers = max(1, (os.cpu_count() or 1) // self._ctx.jobs)
+        # forking a process with running threads is unsafe
+        mp_context = multiprocessing.get_context("spawn")
+        self._executor = ProcessPoolExecutor(workers, mp_context)
+        self._max_pending = workers * self._PENDING_PER_WORKER
+        get_logger().debug(f"Started making previews with {workers} processes")
+
+    def _submit(self, job: _PreviewJob):
+        future = self._executor.submit(
+            _make_preview, job.source_path, job.preview_path, job.max_side, self._ctx.previews, self.QUALITY
+        )
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(lambda f: self._on_done(f, job))
+
+    def _on_done(self, future: Future, job: _PreviewJob):
+        next_job = None
+        with self._lock:
+            self._futures.discard(future)
+            if error := future.exception():
+                self._manifest.pop(job.key, None)
+            else:
+                self._manifest[job.key] = job.source_id
+            self._manifest_changed = True
+            if self._backlog:
+                next_job = self._backlog.popleft()  # takes the place of the finished one
+            else:
+                self._pending -= 1
+        if next_job:
+            self._submit(next_job)
+
+        if error:
+            # the page falls back to the original, see `AttachmentHandler._set_preview()`
+            get_logger().warning(f"Failed to make preview of {job.key}: {error}")
+            self._ctx.metrics.count("previews", type=job.attachment_type, status="failed")
+            return
+        self._ctx.metrics.observe("preview." + job.attachment_type, future.result())
+        self._ctx.metrics.count("previews", type=job.attachment_type, status="success")
+
+    def _load_manifest(self) -> dict[str, list[int]]:
+        try:
+            with open(self._manifest_path, "rt") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return dict()
+        except (OSError, ValueError) as e:
+            get_logger().warning(f"Failed to load previews manifest, all previews will be made again: {e}")
+            return dict()
+
+    def _save_manifest(self):
+        os.makedirs(self._manifest_path.parent, exist_ok=True)
+        fd, tmp_filename = tempfile.mkstemp(dir=self._manifest_path.parent, prefix=self.MANIFEST_FILENAME)
+        with os.fdopen(fd, "wt") as f:
+            json.dump(self._manifest, f)
+        os.replace(tmp_filename, self._manifest_path)  # atomic write
+
+
+def _make_preview(source_path: Path, preview_path: Path, max_side: int, fmt: str, quality: int) -> float:
+    """
+    Runs in worker processes.
+
+    :return: time spent.
+    """
+    from PIL import Image, ImageOps
+
+    started_ts = time.perf_counter()
+    os.makedirs(preview_path.parent, exist_ok=True)
+    part_path = preview_path.with_name(preview_path.name + ".part")
+    with Image.open(source_path) as image:
+        if getattr(image, "is_animated", False):
+            # downsizing all the frames is not worth it, stickers are small anyway
+            shutil.copyfile(source_path, part_path)
+        else:
+            # before anything else, so that JPEG is decoded right at the reduced scale;
+            # the box is square, so it's the same for the rotated image
+            image.draft(None, (max_side, max_side))
+            # rotated before downsizing, for the box to be applied to the displayed dimensions
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((max_side, max_side))  # keeps aspect ratio, never upscales
+            if image.mode not in ("RGB", "L"):
+                image = image.convert("RGBA")
+                if fmt == "jpeg":  # no transparency
+                    background = Image.new("RGB", image.size, "white")
+                    background.paste(image, mask=image.getchannel("A"))
+                    image = background
+            image.save(part_path, format=fmt.upper(), quality=quality)
+    os.replace(part_path, preview_path)
+    return time.perf_counter() - started_ts
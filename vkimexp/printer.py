@@ -6,13 +6,16 @@
 import enum
 import re
 import sys
+import time
 import typing as t
-from functools import cached_property
+from functools import cached_property, wraps
+from threading import Lock, RLock
 
 import pytermor as pt
 from pytermor import Styles as BaseStyles
 
-from .common import Context, PAGE_SIZE, AttachmentEventTypeEnum
+from .common import Context, PAGE_SIZE, AttachmentEventTypeEnum, Totals
+from .metrics import RateMeter
 
 
 class Styles(BaseStyles):
@@ -29,13 +32,24 @@ class ColumnEnum(enum.IntEnum):
     PROGRESS = enum.auto()
     OFFSET = enum.auto()
     SIZE = enum.auto()
+    RATE = enum.auto()
     MSG_COUNT = enum.auto()
     ATTACHMENTS = enum.auto()
 
 
+def _locked(fn: callable) -> callable:
+    @wraps(fn)
+    def wrapper(self: "StatePrinter", *args, **kwargs):
+        with self._lock:
+            return fn(self, *args, **kwargs)
+
+    return wrapper
+
+
 class StatePrinter:
     """
-    Class responsible for displaying the progress in a terminal.
+    Class responsible for displaying the progress in a terminal. Public methods
+    are thread-safe, as attachment events can come from download workers.
     """
 
     SEP_SIZE = 2
@@ -43,6 +57,7 @@ class StatePrinter:
     def __init__(self, ctx: Context, io_: t.TextIO = None):
         self._ctx = ctx
         self._io = io_ or sys.stdout
+        self._lock = RLock()
         self._styles = Styles()
         self._size_formatter = pt.StaticFormatter(pt.formatter_bytes_human, auto_color=True, unit="b")
 
@@ -51,6 +66,14 @@ class StatePrinter:
         self._cur_attach_states = ""
         self._cur_attach_idx = None
 
+        self._started_ts = time.monotonic()
+        self._page_rate = RateMeter()
+        self._pages_done = 0
+        self._bytes_done = 0
+
+        self._print_intro()
+
+    def _print_intro(self):
         self._print(f"Estimating" + pt.OVERFLOW_CHAR)
 
     def _print(self, val: pt.RT = "", *, nl=False):
@@ -84,15 +107,18 @@ class StatePrinter:
         self._print(nl=True)
         self._cur_column_idx = 0
 
+    @_locked
     def print_init_attempt(self, attempts: int):
         self._print("#")
 
+    @_locked
     def print_header(self):
         msg = f"  {self._req_total} queries, " + pt.highlight(str(self._ctx.max_msg_idx)) + " messages"
         self._print(msg)
         self._next_row()
         self._print_sep()
 
+    @_locked
     def print_pre_request(self):
         self._cur_attach_states = ""
         self._print_cell("·")
@@ -111,8 +137,11 @@ class StatePrinter:
         )
         self._print_cell(offset_str)
 
+    @_locked
     def print_post_request(self, size: int, msg_num: int, msg_extra_num: int):
+        self._bytes_done += size
         self._print_cell(self._size_formatter.format(size), align=">")
+        self._print_cell(self._format_rate(self._page_rate.rate), align=">")
 
         msg_str = f"{msg_num:>{self._max_idx_len}d}"
         if msg_extra_num > 0:
@@ -121,6 +150,7 @@ class StatePrinter:
             msg_str += pt.pad(self._max_idx_len)
         self._print_cell(msg_str, align="<")
 
+    @_locked
     def print_attachment(
         self,
         type_letter: str,
@@ -151,16 +181,33 @@ class StatePrinter:
                 frags.append(pt.Fragment(part, self._styles.REQUEST_FAILED))
             else:
                 frags.append(part)
+
+        prev_column_idx = self._cur_column_idx
         self._print_cell(pt.Composite(*frags), ColumnEnum.ATTACHMENTS)
+        if prev_column_idx != self._cur_column_idx:
+            # event from a background worker, return to where the row was left
+            self._cur_column_idx = prev_column_idx
+            self._move_cursor_to_column()
 
+    @_locked
     def print_failed_request(self, e: Exception):
         self._print_cell(pt.Fragment("E", self._styles.REQUEST_FAILED), ColumnEnum.STATUS)
         self._next_row()
 
+    @_locked
     def print_completed_request(self):
+        self._count_completed()
         self._print_cell(pt.Fragment("S", self._styles.REQUEST_SUCCESS), ColumnEnum.STATUS)
         self._next_row()
 
+    def _count_completed(self):
+        self._pages_done += 1
+        self._page_rate.add()
+
+    @staticmethod
+    def _format_rate(rate: float) -> str:
+        return pt.format_auto_float(rate, 4) + "/s"
+
     def _get_column_width(self, idx: int = None) -> int:
         if idx is None:
             idx = self._cur_column_idx
@@ -177,6 +224,7 @@ class StatePrinter:
             5,
             6 + 1 + self._max_idx_len + 1,
             6,
+            6,
             self._max_msg_count_len * 2 + 1,
         ]
         while len(fixed_widths) and (sum(self._column_widths) + fixed_widths[0] + self.SEP_SIZE <= max_width):
@@ -214,6 +262,7 @@ class StatePrinter:
         self._print("-" * self._max_width)
         self._next_row()
 
+    @_locked
     def print_footer(self):
         self._print_sep()
 
@@ -223,4 +272,110 @@ class StatePrinter:
 
         self._printn(f"   Messages (indexed/rendered):  " + tot_msg)
         self._printn(f"Attachments (found/downloaded):  " + tot_atm)
+        self._printn(f"                    Throughput:  " + self._format_throughput())
         self._printn(f"              Output directory:  {self._ctx.out_dir!s}")
+
+    def _format_throughput(self) -> pt.Text:
+        elapsed_sec = max(1e-3, time.monotonic() - self._started_ts)
+        pages_rate = pt.highlight(pt.format_auto_float(self._pages_done / elapsed_sec, 4).strip())
+        return pages_rate + " pages/s, " + self._size_formatter.format(self._bytes_done / elapsed_sec) + "/s"
+
+    @classmethod
+    def print_summary(cls, totals: Totals, peers_done: list[int], peers_failed: list[int], io_: t.TextIO = None):
+        """
+        Aggregated results of several tasks.
+        """
+        tot_peers = pt.highlight(f"{len(peers_done)}/{len(peers_failed)}")
+        tot_msg = pt.highlight(f"{totals.msg_count_index}/{totals.msg_count_html}")
+        tot_atm = pt.highlight(f"{totals.attach_found}/{totals.attach_downloaded}")
+
+        lines = [
+            "=" * min(80, pt.get_terminal_width()),
+            f"       Peers (exported/failed):  " + tot_peers,
+            f"   Messages (indexed/rendered):  " + tot_msg,
+            f"Attachments (found/downloaded):  " + tot_atm,
+        ]
+        if peers_failed:
+            lines.append(f"                  Failed peers:  " + ", ".join(map(str, peers_failed)))
+        for line in lines:
+            pt.echo(line, file=io_ or sys.stdout, flush=True)
+
+
+class PeerStatePrinter(StatePrinter):
+    """
+    Compact progress display for the tasks running concurrently. Instead of a
+    detailed table (which requires the whole terminal), prints a short line
+    prefixed with peer ID every `PROGRESS_STEP` percent of the requests. Lines
+    of different peers can interleave, but never mix up.
+    """
+
+    PROGRESS_STEP = 10
+
+    _io_lock = Lock()
+
+    def __init__(self, ctx: Context, io_: t.TextIO = None):
+        self._last_progress = 0
+        super().__init__(ctx, io_)
+
+    def _print_intro(self):
+        pass
+
+    def _print_line(self, val: pt.RT):
+        prefix = pt.Fragment(f"[{self._ctx.peer_id}]", self._styles.LABELS)
+        with self._io_lock:
+            pt.echo(pt.Text(prefix, " ", val), file=self._io, flush=True)
+
+    @_locked
+    def print_header(self):
+        self._print_line(f"{self._req_total} queries, " + pt.highlight(str(self._ctx.max_msg_idx)) + " messages")
+
+    @_locked
+    def print_pre_request(self):
+        pass
+
+    @_locked
+    def print_post_request(self, size: int, msg_num: int, msg_extra_num: int):
+        self._bytes_done += size
+
+    @_locked
+    def print_attachment(self, type_letter: str, attach_idx: str, event_type: AttachmentEventTypeEnum):
+        pass
+
+    @_locked
+    def print_failed_request(self, e: Exception):
+        self._print_line(pt.Text(pt.Fragment("E", self._styles.REQUEST_FAILED), f" offset {self._ctx.offset}: {e}"))
+
+    @_locked
+    def print_completed_request(self):
+        self._count_completed()
+        req_cur = self._ctx.max_page - self._ctx.page + 1
+        progress = 100 * req_cur // self._req_total
+        if progress < self._last_progress + self.PROGRESS_STEP and req_cur < self._req_total:
+            return
+        self._last_progress = progress
+
+        tot = self._ctx.totals
+        self._print_line(
+            pt.Text(
+                f"{progress:>3d}%  {req_cur:>{self._max_page_len}d}/{self._req_total}  ",
+                ("messages ", self._styles.LABELS),
+                pt.highlight(str(tot.msg_count_html)),
+                ("  attachments ", self._styles.LABELS),
+                pt.highlight(f"{tot.attach_found}/{tot.attach_downloaded}"),
+                ("  pages ", self._styles.LABELS),
+                pt.highlight(self._format_rate(self._page_rate.rate)),
+            )
+        )
+
+    @_locked
+    def print_footer(self):
+        tot = self._ctx.totals
+        self._print_line(
+            pt.Text(
+                pt.Fragment("Done", self._styles.REQUEST_SUCCESS),
+                "  messages " + pt.highlight(f"{tot.msg_count_index}/{tot.msg_count_html}"),
+                "  attachments " + pt.highlight(f"{tot.attach_found}/{tot.attach_downloaded}"),
+                "  " + self._format_throughput(),
+                f"  {self._ctx.out_dir!s}",
+            )
+        )
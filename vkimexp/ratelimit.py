@@ -0,0 +1,123 @@
+# ------------------------------------------------------------------------------
+#  vkimexp [VK dialogs exporter]
+#  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
+# ------------------------------------------------------------------------------
+
+import random
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from threading import Lock
+
+
+class RateLimiter:
+    """
+    Token bucket shared by all the requests to VK API (in all threads and
+    tasks), which adapts its rate to the server's behaviour: it's increased
+    slightly after each successful request and is cut in half when the server
+    asks to slow down (HTTP 429/503 responses, which also pause the bucket for
+    the time specified in "Retry-After" header) or is responding too slowly.
+    Failed requests are retried with jittered exponential backoff.
+    """
+
+    INITIAL_RATE = 20.0  # requests per second
+    MIN_RATE = 0.2
+    MAX_RATE = 50.0
+    RATE_INCREASE = 0.1
+    SLOW_LATENCY_SEC = 2.0
+
+    MAX_RETRIES = 5
+    BACKOFF_BASE_SEC = 0.5
+    BACKOFF_MAX_SEC = 60.0
+    RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+    THROTTLE_STATUSES = frozenset({429, 503})
+
+    _instance: "RateLimiter" = None
+    _instance_lock = Lock()
+
+    @classmethod
+    def get_instance(cls) -> "RateLimiter":
+        with cls._instance_lock:
+            if not cls._instance:
+                cls._instance = RateLimiter()
+            return cls._instance
+
+    def __init__(self):
+        self._rate = self.INITIAL_RATE
+        self._tokens = 1.0
+        self._last_ts = time.monotonic()
+        self._lock = Lock()
+
+    @property
+    def rate(self) -> float:
+        return self._rate
+
+    def reserve(self) -> float:
+        """
+        Take a token from the bucket.
+
+        :return: time to wait before making the request, in seconds.
+        """
+        with self._lock:
+            self._refill()
+            self._tokens -= 1
+            return max(0.0, -self._tokens / self._rate)
+
+    def on_response(self, attempt: int, status: int | None, latency: float, retry_after: str = None) -> float | None:
+        """
+        Adjust the rate according to the response.
+
+        :param attempt:      number of the retry, starting from 0
+        :param status:       HTTP status, or None if the request has failed altogether
+        :param latency:      request duration
+        :param retry_after:  "Retry-After" response header
+        :return: time to wait before retrying the request, or None if it
+                 shouldn't be retried (succeeded or failed permanently).
+        """
+        with self._lock:
+            if status is not None and status < 400:
+                if latency > self.SLOW_LATENCY_SEC:
+                    self._slow_down()
+                else:
+                    self._rate = min(self.MAX_RATE, self._rate + self.RATE_INCREASE)
+                return None
+
+            if status is not None and status not in self.RETRY_STATUSES:
+                return None
+            if attempt >= self.MAX_RETRIES:
+                return None
+
+            delay = random.uniform(0, min(self.BACKOFF_MAX_SEC, self.BACKOFF_BASE_SEC * 2**attempt))
+            if status in self.THROTTLE_STATUSES:
+                self._slow_down()
+                if (pause := self._parse_retry_after(retry_after)) is not None:
+                    # nobody gets a token until the pause is over
+                    self._refill()
+                    self._tokens = min(self._tokens, -pause * self._rate)
+                    delay = max(delay, pause)
+            return delay
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(1.0, self._tokens + (now - self._last_ts) * self._rate)
+        self._last_ts = now
+
+    def _slow_down(self):
+        self._refill()
+        self._rate = max(self.MIN_RATE, self._rate / 2)
+
+    @classmethod
+    def _parse_retry_after(cls, value: str | None) -> float | None:
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            retry_dt = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if retry_dt.tzinfo is None:
+            retry_dt = retry_dt.replace(tzinfo=timezone.utc)
+        return max(0.0, (retry_dt - datetime.now(timezone.utc)).total_seconds())
@@ -0,0 +1,130 @@
+# ------------------------------------------------------------------------------
+#  vkimexp [VK dialogs exporter]
+#  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
+# ------------------------------------------------------------------------------
+
+import typing as t
+import zlib
+from dataclasses import dataclass
+from pathlib import Path
+
+
+@dataclass(frozen=True)
+class RawBlob:
+    """
+    Reference to a saved piece of content: either a regular file, or a
+    compressed record of a segment file. Can be passed to another process.
+    """
+
+    path: Path
+    size: int  # uncompressed
+    pos: int | None = None  # None for regular files
+    length: int = 0  # compressed
+
+    def read(self) -> str:
+        with open(self.path, "rb") as f:
+            if self.pos is None:
+                return f.read().decode()
+            f.seek(self.pos)
+            try:
+                return zlib.decompress(f.read(self.length)).decode()
+            except zlib.error as e:
+                raise ValueError(f"Damaged record at {self.path}:{self.pos}: {e}") from e
+
+
+class SegmentStore:
+    """
+    Append-only storage of named text blobs, which are compressed and written
+    one after another into a few large segment files instead of a file per
+    blob. Location of each record is kept in a plain text index (one line per
+    record), which is appended to after the record itself, so an interrupted
+    write leaves at most an unreferenced tail of a segment behind. Blobs are
+    never overwritten; `put()` of an existing name is ignored.
+    """
+
+    INDEX_FILENAME = "segments.idx"
+    SEGMENT_FILENAME_FMT = "segment.{:04d}.z"
+    SEGMENT_MAX_SIZE = 64 * 1024 * 1024
+    COMPRESSION_LEVEL = 6
+
+    def __init__(self, path: Path):
+        self._path = path
+        self._blobs: dict[str, RawBlob] = dict()
+        self._segment_num = 0
+        self._segment_file: t.BinaryIO | None = None
+        self._index_file: t.TextIO | None = None
+        self._index_terminated = True
+        self._load_index()
+
+    @classmethod
+    def exists(cls, path: Path) -> bool:
+        return (path / cls.INDEX_FILENAME).exists()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._blobs
+
+    def __iter__(self) -> t.Iterator[str]:
+        return iter(self._blobs)
+
+    def get(self, name: str) -> RawBlob | None:
+        return self._blobs.get(name)
+
+    def put(self, name: str, content: str) -> bool:
+        """
+        :return: False if the blob with this name already exists.
+        """
+        if name in self._blobs:
+            return False
+        raw = content.encode()
+        compressed = zlib.compress(raw, self.COMPRESSION_LEVEL)
+
+        segment_file = self._get_segment_file(len(compressed))
+        pos = segment_file.tell()
+        segment_file.write(compressed)
+        segment_file.flush()
+
+        if not self._index_file:
+            self._index_file = open(self._path / self.INDEX_FILENAME, "at")
+            if not self._index_terminated:
+                self._index_file.write("\n")  # isolate the incomplete line left by an interrupted write
+        self._index_file.write(f"{name}\t{self._segment_num}\t{pos}\t{len(compressed)}\t{len(raw)}\n")
+        self._index_file.flush()
+
+        self._blobs[name] = RawBlob(self._get_segment_path(self._segment_num), len(raw), pos, len(compressed))
+        return True
+
+    def close(self):
+        for f in (self._segment_file, self._index_file):
+            if f:
+                f.close()
+        self._segment_file = self._index_file = None
+
+    def _load_index(self):
+        try:
+            with open(self._path / self.INDEX_FILENAME, "rt") as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return
+
+        self._index_terminated = not lines or lines[-1].endswith("\n")
+        for line in lines:
+            try:
+                name, segment_num, pos, length, size = line.rstrip("\n").split("\t")
+                segment_num = int(segment_num)
+                blob = RawBlob(self._get_segment_path(segment_num), int(size), int(pos), int(length))
+            except ValueError:
+                continue  # incomplete last line
+            self._blobs.setdefault(name, blob)
+            self._segment_num = max(self._segment_num, segment_num)
+
+    def _get_segment_file(self, record_size: int) -> t.BinaryIO:
+        if not self._segment_file:
+            self._segment_file = open(self._get_segment_path(self._segment_num), "ab")
+        if 0 < (segment_size := self._segment_file.tell()) and segment_size + record_size > self.SEGMENT_MAX_SIZE:
+            self._segment_file.close()
+            self._segment_num += 1
+            self._segment_file = open(self._get_segment_path(self._segment_num), "ab")
+        return self._segment_file
+
+    def _get_segment_path(self, segment_num: int) -> Path:
+        return self._path / self.SEGMENT_FILENAME_FMT.format(segment_num)
@@ -0,0 +1,368 @@
+# ------------------------------------------------------------------------------
+#  vkimexp [VK dialogs exporter]
+#  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
+# ------------------------------------------------------------------------------
+
+import json
+import multiprocessing
+import os
+import typing as t
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass, replace
+from pathlib import Path
+
+import click
+from bs4 import Tag
+
+from .checkpoint import Checkpoint
+from .common import Context, AttachmentEventTypeEnum, DownloadError, PeerNameMap, get_logger
+from .core import Task
+from .dedup import SparseSet
+from .fetcher import PageResult
+from .handler import (
+    AttachmentHandler,
+    AudioMsgsHandler,
+    DeferredAttachment,
+    DownloadQueue,
+    ImagesHandler,
+    PhotosHandler,
+)
+from .metrics import Metrics
+from .rawstore import RawBlob
+from .visitor import DomVisitor, Selector
+from .writer import HtmlWriter, IndexWriter, RawWriter
+
+
+@dataclass(frozen=True)
+class PageJob:
+    offset: int
+    html: RawBlob
+    duplicate_ids: frozenset[int]  # messages encountered on the previous pages
+
+
+@dataclass(frozen=True)
+class RenderedPage:
+    html: str
+    msg_ids: list[int]  # all the messages encountered, including the duplicates
+    msg_count: int
+    peer_names: dict[int, str]
+    attachments: dict[str, list[DeferredAttachment]]
+    stages: dict[str, dict]  # see `Metrics.to_dict()`
+
+
+class DeferredEnqueueMixin:
+    """
+    Makes attachment handler collect the attachments instead of enqueuing them,
+    so that the main process could do it later. Local paths are computed the
+    same way, so the page can be rendered right away.
+    """
+
+    deferred: list[DeferredAttachment]
+
+    def _enqueue(
+        self,
+        idx: int,
+        urls: list[str],
+        attachment_event_cb: callable,
+        local_abs_path: Path = None,
+        event_type: AttachmentEventTypeEnum = AttachmentEventTypeEnum.STARTED,
+    ) -> Path:
+        local_rel_path = local_abs_path.relative_to(self._ctx.out_dir) if local_abs_path else None
+        self.deferred.append((idx, urls, local_rel_path, event_type, None))
+        return local_abs_path or self._get_local_abs_path(urls[0])
+
+
+class PageRenderer:
+    """
+    Part of the page processing which doesn't depend on the other pages, i.e.
+    parsing, removal of the messages encountered before (their IDs should be
+    known in advance), rewriting of attachment URLs and serialization. Runs in
+    worker processes; the rest is done by `ReplayTask` in the original order.
+    """
+
+    def __init__(self, ctx: Context):
+        self._ctx = ctx
+        self._handlers: list[AttachmentHandler | DeferredEnqueueMixin] = [
+            type(f"Deferred{cls.__name__}", (DeferredEnqueueMixin, cls), {})(ctx, None, None)
+            for cls in (ImagesHandler, PhotosHandler, AudioMsgsHandler)
+        ]
+        self._html_writer = HtmlWriter(ctx)
+        self._peer_name_map = PeerNameMap()
+
+        self._duplicate_ids: frozenset[int] = frozenset()
+        self._msg_ids: list[int] = []
+        self._duplicates: list[Tag] = []
+        self._visitor = DomVisitor()
+        self._peer_name_map.subscribe(self._visitor)
+        self._visitor.subscribe(Selector("li", {"class": "im-mess"}), self._on_message)
+        for hdlr in self._handlers:
+            hdlr.subscribe(self._visitor)
+        self._html_writer.subscribe(self._visitor)
+
+    def render(self, job: PageJob) -> RenderedPage:
+        self._ctx.offset = job.offset
+        self._duplicate_ids = job.duplicate_ids
+        self._msg_ids = []
+        self._duplicates.clear()
+        self._peer_name_map.clear()
+        for hdlr in self._handlers:
+            hdlr.deferred = []
+        # worker's own metrics are not visible to the main process
+        metrics = Metrics()
+
+        html = job.html.read()
+        with metrics.measure("parse"):
+            soup = self._ctx.parser.parse(html)
+        with metrics.measure("visit"):
+            self._visitor.visit(soup)
+        with metrics.measure("dedup"):
+            msg_count = len(self._msg_ids) - len(self._duplicates)
+            for li in self._duplicates:
+                li.replace_with("")
+        for hdlr in self._handlers:
+            with metrics.measure("handle." + hdlr.get_type()):
+                hdlr.handle(soup, self._on_attachment_event)
+        with metrics.measure("render"):
+            html = self._html_writer.render(soup)
+
+        return RenderedPage(
+            html=html,
+            msg_ids=self._msg_ids,
+            msg_count=msg_count,
+            peer_names=dict(self._peer_name_map),
+            attachments={hdlr.get_type(): hdlr.deferred for hdlr in self._handlers},
+            stages=metrics.to_dict()["stages"],
+        )
+
+    def _on_message(self, li: Tag) -> t.Any:
+        try:
+            msg_id = int(li["data-msgid"])
+        except ValueError:
+            return None
+
+        duplicate = msg_id in self._duplicate_ids or msg_id in self._msg_ids
+        self._msg_ids.append(msg_id)
+        if duplicate:
+            self._duplicates.append(li)
+            return DomVisitor.SKIP
+        return None
+
+    def _on_attachment_event(
+        self,
+        hdlr: DeferredEnqueueMixin,
+        idx: int,
+        event_type: AttachmentEventTypeEnum,
+        res: Path | Exception = None,
+        offset: int = None,
+    ):
+        hdlr.deferred.append((idx, None, None, event_type, res))
+
+
+_renderer: PageRenderer | None = None
+
+
+def _init_worker(params: dict, peer_id: int, out_dir_root: Path):
+    global _renderer
+    Context._OUT_DIR = out_dir_root  # in case it's overridden in the main process
+    _renderer = PageRenderer(Context(params, peer_id, 0))
+
+
+def _render(job: PageJob) -> RenderedPage:
+    return _renderer.render(job)
+
+
+class OfflineDownloadQueue(DownloadQueue):
+    """
+    Doesn't download anything: attachments which are already present at the
+    output directory (or in the content store) are accepted, the rest of them
+    are reported as failed.
+    """
+
+    def _run(
+        self,
+        hdlr: AttachmentHandler,
+        idx: int,
+        urls: list[str],
+        local_abs_path: Path,
+        attachment_event_cb: callable,
+        offset: int,
+    ):
+        for url in urls:
+            if hdlr.restore(url, local_abs_path):
+                hdlr.remember(urls, local_abs_path)
+                attachment_event_cb(hdlr, idx, AttachmentEventTypeEnum.SUCCESS, local_abs_path, offset=offset)
+                return
+
+        error = DownloadError(f"Not downloaded during the export: {urls[0]}")
+        hdlr.forget(urls, local_abs_path, error)
+        attachment_event_cb(hdlr, idx, AttachmentEventTypeEnum.FAILED, error, offset=offset)
+
+
+class TransientCheckpoint(Checkpoint):
+    """
+    Keeps the state in memory only, so that the checkpoint of the export being
+    replayed is left intact (replay itself is fast enough to start over).
+    """
+
+    def load(self) -> bool:
+        return False
+
+    def save(self, state: dict, complete: bool = False):
+        self.state.update(state, peer_id=self._ctx.peer_id, complete=complete)
+
+
+class ReplayTask(Task):
+    """
+    Rebuilds the output from the responses saved by `RawWriter`, without
+    accessing VK. Pages are rendered by a pool of processes and are merged in
+    the original order. Messages to be removed from each page as duplicates are
+    determined in advance from the saved data; in case the page contents turn
+    out to be different, the page is rendered again. Header of the index (the
+    time of the export) is kept as is, so that the output is the same as after
+    the export, provided that the options are the same.
+    """
+
+    def __init__(self, clctx: click.Context, peer_id: int, attempt: int):
+        self._sources = [*RawWriter.iter_saved(Context.get_out_dir(peer_id))]
+        if not self._sources:
+            raise click.UsageError(f"Nothing to replay, no saved responses found for PEER {peer_id}")
+        # content store is accessed by the main process only
+        self._worker_params = {**clctx.params, "store": False}
+        super().__init__(clctx, peer_id, attempt)
+
+    def _make_auth(self) -> None:
+        return None
+
+    def _make_transport(self) -> None:
+        return None
+
+    def _make_checkpoint(self) -> Checkpoint:
+        return TransientCheckpoint(self._ctx)
+
+    def _make_download_queue(self) -> DownloadQueue:
+        return OfflineDownloadQueue(self._ctx)
+
+    def _make_page_fetcher(self) -> None:
+        return None  # see `_iter_rendered_pages()`
+
+    def _get_writers_state(self, state: dict) -> dict:
+        if (header_size := IndexWriter.get_header_size(self._ctx)) is None:
+            return {}
+        return {"index": {"size": header_size}}
+
+    def run(self) -> bool:
+        get_logger().info(f"Replaying PEER {self._ctx.peer_id} from {len(self._sources)} saved responses")
+
+        try:
+            last_page_data = [*self._handle_response_data(json.loads(self._sources[-1][2].read()))]
+        except (OSError, ValueError, RuntimeError) as e:
+            get_logger().error(f"Failed to read the last saved response: {e}")
+            return False
+        self._ctx.max_msg_idx = max([dto.msg_idx for dto in last_page_data] + [0])
+        self._ctx.max_page = len(self._sources) - 2
+        self._printer.print_header()
+
+        for page, offset, im_data in self._iter_rendered_pages():
+            self._consume_page(page, offset, im_data)
+
+        self._download_queue.join()
+        self._finish()
+        return True
+
+    def _iter_rendered_pages(self) -> t.Iterator[PageResult]:
+        """
+        Same as `ConcurrentPageFetcher.iter_pages()`, but pages are rendered
+        by processes, and instead of raw response `RenderedPage` is provided.
+        """
+        jobs = max(1, min(len(self._sources), (os.cpu_count() or 1) // self._ctx.jobs))
+        window = jobs * 2
+        sources = iter(enumerate(self._sources))
+        expected_ids = SparseSet()
+        pending = deque[tuple[int, int, tuple[PageJob, dict, int] | Exception, Future | None]]()
+
+        # forking a process with running threads is unsafe
+        mp_context = multiprocessing.get_context("spawn")
+        init_args = (self._worker_params, self._ctx.peer_id, self._ctx.out_dir_root)
+        executor = ProcessPoolExecutor(jobs, mp_context, _init_worker, init_args)
+        get_logger().debug(f"Started rendering with {jobs} processes, window {window}")
+
+        try:
+            while True:
+                while len(pending) < window and (next_source := next(sources, None)):
+                    idx, (offset, html, data) = next_source
+                    page = self._ctx.max_page - idx
+                    try:
+                        job, data, size = self._make_job(offset, html, data, expected_ids)
+                    except (OSError, ValueError) as e:
+                        pending.append((page, offset, e, None))
+                        continue
+                    pending.append((page, offset, (job, data, size), executor.submit(_render, job)))
+                if not pending:
+                    break
+
+                page, offset, job_data, future = pending.popleft()
+                if isinstance(job_data, Exception):
+                    yield page, offset, job_data
+                    continue
+                job, data, size = job_data
+                try:
+                    rendered = self._verify(executor, job, future.result())
+                except Exception as e:
+                    yield page, offset, e
+                    continue
+                yield page, offset, (rendered, data, size)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def _make_job(
+        self,
+        offset: int,
+        html: RawBlob,
+        data: RawBlob,
+        expected_ids: SparseSet,
+    ) -> tuple[PageJob, dict, int]:
+        size = html.size + data.size
+        data = json.loads(data.read())
+
+        page_ids = []
+        if isinstance(data, dict):
+            page_ids = [msg[0] for msg in data.values()]
+        job = PageJob(offset, html, frozenset(filter(expected_ids.__contains__, page_ids)))
+        expected_ids.update(page_ids)
+        return job, data, size
+
+    def _verify(self, executor: ProcessPoolExecutor, job: PageJob, rendered: RenderedPage) -> RenderedPage:
+        """
+        Make sure the messages removed from the page are exactly the ones which
+        were encountered before, and render the page again otherwise.
+        """
+        while True:
+            msg_ids = set(rendered.msg_ids)
+            duplicate_ids = frozenset(filter(self._seen_msg_ids.__contains__, msg_ids))
+            if duplicate_ids == job.duplicate_ids & msg_ids:
+                break
+            get_logger().debug(f"Rendering page at offset {job.offset} again")
+            job = replace(job, duplicate_ids=duplicate_ids)
+            rendered = executor.submit(_render, job).result()
+
+        self._seen_msg_ids.update(rendered.msg_ids)
+        return rendered
+
+    def _process_page(self, offset: int, rendered: RenderedPage, data: dict, size: int):
+        for stage, timer in rendered.stages.items():
+            self._ctx.metrics.observe(stage, timer["sec"], timer["calls"])
+        self._ctx.peer_name_map.update(rendered.peer_names)
+        index_count_cur = self._write_messages(data)
+
+        extra_count = rendered.msg_count - index_count_cur
+        self._printer.print_post_request(size, index_count_cur, extra_count)
+
+        for hdlr in self._handlers:
+            hdlr.handle_deferred(rendered.attachments[hdlr.get_type()], self._attachment_event)
+
+        with self._ctx.metrics.measure("write.html"):
+            self._html_writer.write_rendered(rendered.html, offset, rendered.msg_count)
+
+        self._ctx.totals.msg_count_html.increment(rendered.msg_count)
+        self._ctx.totals.msg_count_index.increment(index_count_cur)
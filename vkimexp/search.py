@@ -0,0 +1,92 @@
+# ------------------------------------------------------------------------------
+#  vkimexp [VK dialogs exporter]
+#  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
+# ------------------------------------------------------------------------------
+
+import sqlite3
+from dataclasses import dataclass
+from pathlib import Path
+
+# messages of the errors caused by malformed FTS5 queries
+QUERY_ERRORS = ["fts5", "syntax error", "unterminated string", "no such column"]
+
+
+@dataclass(frozen=True)
+class SearchResult:
+    peer_id: int
+    msg_idx: int
+    msg_id: int
+    ts: int
+    inbox: bool
+    from_peer_id: int | None
+    from_name: str | None
+    attach_count: int
+    text: str
+
+
+def search(
+    db_path: Path,
+    query: str | None,
+    peer_ids: list[int] = None,
+    from_peer_ids: list[int] = None,
+    since_ts: int = None,
+    until_ts: int = None,
+    with_attachments: bool = False,
+    limit: int = 0,
+    highlight: tuple[str, str] = ("", ""),
+) -> list[SearchResult]:
+    """
+    Query the database made by `SqliteWriter`.
+
+    :param query:      FTS5 full-text query (words, "phrases", prefix*, AND/OR/NOT,
+                       see https://sqlite.org/fts5.html#full_text_query_syntax);
+                       if empty, messages are selected by other conditions only.
+    :param highlight:  strings to surround the matched words with.
+    :param limit:      0 = unlimited.
+    :return:           matching messages, the newest first.
+    :raises ValueError: if the query is malformed.
+    """
+    conditions, params = [], []
+    if query:
+        text_expr = "highlight(messages_fts, 0, ?, ?)"
+        source = "messages_fts JOIN messages m ON m.id = messages_fts.rowid"
+        conditions.append("messages_fts MATCH ?")
+        params.extend([*highlight, query])
+    else:
+        text_expr = "m.text"
+        source = "messages m"
+    if peer_ids:
+        conditions.append(f"m.peer_id IN ({', '.join('?' * len(peer_ids))})")
+        params.extend(peer_ids)
+    if from_peer_ids:
+        conditions.append(f"m.from_peer_id IN ({', '.join('?' * len(from_peer_ids))})")
+        params.extend(from_peer_ids)
+    if since_ts is not None:
+        conditions.append("m.ts >= ?")
+        params.append(since_ts)
+    if until_ts is not None:
+        conditions.append("m.ts < ?")
+        params.append(until_ts)
+    if with_attachments:
+        conditions.append("m.attach_count > 0")
+
+    sql = (
+        f"SELECT m.peer_id, m.msg_idx, m.msg_id, m.ts, m.inbox, m.from_peer_id, p.name, m.attach_count, {text_expr} "
+        f"FROM {source} LEFT JOIN peers p ON p.peer_id = m.from_peer_id "
+        f"WHERE {' AND '.join(conditions) or 1} "
+        f"ORDER BY m.ts DESC, m.msg_idx DESC"
+    )
+    if limit:
+        sql += " LIMIT ?"
+        params.append(limit)
+
+    conn = sqlite3.connect(db_path)
+    try:
+        cursor = conn.execute(sql, params)
+        return [SearchResult(*row[:4], bool(row[4]), *row[5:]) for row in cursor]
+    except sqlite3.OperationalError as e:
+        if query and any(s in str(e) for s in QUERY_ERRORS):
+            raise ValueError(f"Invalid query: {e}") from e
+        raise
+    finally:
+        conn.close()
@@ -0,0 +1,112 @@
+# ------------------------------------------------------------------------------
+#  vkimexp [VK dialogs exporter]
+#  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
+# ------------------------------------------------------------------------------
+
+import hashlib
+import os
+import shutil
+from pathlib import Path
+from threading import Lock
+
+
+class ContentStore:
+    """
+    Content-addressed attachment storage shared by all peers. Each file is
+    stored once under its SHA-256 digest (with two levels of fan-out dirs, e.g.
+    "ab/cd/abcd...") and is linked into peer directories; URL-to-digest index
+    allows to skip downloading of attachments which were already encountered,
+    e.g. in the other dialogs.
+    """
+
+    DIRNAME = ".store"
+    INDEX_FILENAME = "urls.txt"
+
+    _instances: dict[Path, "ContentStore"] = dict()
+    _instances_lock = Lock()
+
+    @classmethod
+    def get_instance(cls, root: Path) -> "ContentStore":
+        """
+        Instances are shared between the tasks, so that the index is loaded once.
+        """
+        with cls._instances_lock:
+            if root not in cls._instances:
+                cls._instances[root] = ContentStore(root)
+            return cls._instances[root]
+
+    def __init__(self, root: Path):
+        self._root = root
+        self._url_to_digest: dict[str, str] = dict()
+        self._lock = Lock()
+
+        os.makedirs(root, exist_ok=True)
+        index_path = root / self.INDEX_FILENAME
+        if index_path.exists():
+            with open(index_path, "rt") as f:
+                for line in f:
+                    digest, _, url = line.rstrip("\n").partition(" ")
+                    if url:
+                        self._url_to_digest[url] = digest
+        self._index_file = open(index_path, "at", buffering=1)
+
+    def link(self, url: str, local_abs_path: Path) -> bool:
+        """
+        Make the attachment available at `local_abs_path`, if it's already stored.
+
+        :return: False if attachment has to be downloaded.
+        """
+        with self._lock:
+            digest = self._url_to_digest.get(url)
+        if not digest or not (obj_path := self._get_obj_path(digest)).exists():
+            return False
+        self._link(obj_path, local_abs_path)
+        return True
+
+    def put(self, url: str, src_path: Path, local_abs_path: Path):
+        """
+        Move `src_path` file into the store (unless it's already there) and link it.
+        """
+        digest = self._get_digest(src_path)
+        obj_path = self._get_obj_path(digest)
+        if obj_path.exists():
+            src_path.unlink()
+        else:
+            os.makedirs(obj_path.parent, exist_ok=True)
+            try:
+                os.replace(src_path, obj_path)  # atomic write
+            except OSError:  # different device
+                shutil.move(src_path, obj_path)
+
+        with self._lock:
+            if self._url_to_digest.get(url) != digest:
+                self._url_to_digest[url] = digest
+                self._index_file.write(f"{digest} {url}\n")
+        self._link(obj_path, local_abs_path)
+
+    def _get_digest(self, path: Path) -> str:
+        with open(path, "rb") as f:
+            return hashlib.file_digest(f, "sha256").hexdigest()
+
+    def _get_obj_path(self, digest: str) -> Path:
+        return self._root / digest[:2] / digest[2:4] / digest
+
+    def _link(self, obj_path: Path, local_abs_path: Path):
+        """
+        Prefer hardlinks, as they survive moving of the output directory; fall
+        back to relative symlinks (e.g. store is on a different device), and
+        then to plain copying.
+        """
+        try:
+            os.link(obj_path, local_abs_path)
+            return
+        except FileExistsError:
+            return
+        except OSError:
+            pass
+        try:
+            os.symlink(os.path.relpath(obj_path, local_abs_path.parent), local_abs_path)
+        except FileExistsError:
+            return
+        except OSError:
+            shutil.copyfile(obj_path, local_abs_path)
@@ -0,0 +1,148 @@
+# ------------------------------------------------------------------------------
+#  vkimexp [VK dialogs exporter]
+#  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
+# ------------------------------------------------------------------------------
+
+import typing as t
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import parse_url
+
+from .common import Context, HOST, URL, get_logger
+
+
+class Transport:
+    """
+    Per-run HTTP layer. Keeps a pooled keep-alive session for each host (VK API
+    and every CDN host attachments are loaded from), so that consecutive requests
+    reuse already established connections instead of making a new TCP+TLS
+    handshake every time. Sessions of the least recently used hosts are evicted,
+    but not closed until the requests made with them are done.
+    """
+
+    API_HEADERS = {
+        "authority": "vk.com",
+        "accept": "*/*",
+        "accept-language": "en-US,en;q=0.9,bg;q=0.8,sr;q=0.7,ja;q=0.6,tg;q=0.5,zu;q=0.4,ru;q=0.3",
+        "cache-control": "no-cache",
+        "content-type": "application/x-www-form-urlencoded",
+        "dnt": "1",
+        "origin": "https://vk.com",
+        "pragma": "no-cache",
+        "sec-ch-ua": '"Not.A/Brand";v="8", "Chromium";v="114", "Google Chrome";v="114"',
+        "sec-ch-ua-mobile": "?0",
+        "sec-ch-ua-platform": '"Linux"',
+        "sec-fetch-dest": "empty",
+        "sec-fetch-mode": "cors",
+        "sec-fetch-site": "same-origin",
+        "user-agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36",
+        "x-requested-with": "XMLHttpRequest",
+    }
+
+    def __init__(self, ctx: Context, cookies: dict):
+        self._ctx = ctx
+        self._cookies = cookies
+        self._sessions: OrderedDict[str, requests.Session] = OrderedDict()
+        self._leases: dict[requests.Session, int] = dict()  # amount of requests in flight
+        self._evicted: set[requests.Session] = set()  # to be closed when their requests are done
+        self._lock = Lock()
+
+    @property
+    def cookies(self) -> dict:
+        return self._cookies
+
+    def set_cookies(self, cookies: dict):
+        """
+        Replace the cookies of API session, e.g. after they were refreshed.
+        """
+        with self._lock:
+            if session := self._sessions.get(parse_url(HOST).host):
+                session.cookies.clear()
+                session.cookies.update(cookies)
+            self._cookies = cookies
+
+    def get_api(self, params: dict) -> requests.Response:
+        with self._lease(URL) as session:
+            return session.get(URL, params=params)
+
+    @contextmanager
+    def get(self, url: str, **kwargs) -> t.Iterator[requests.Response]:
+        """
+        Response should be used within the context only (e.g. when it's streamed),
+        as the session it's made with can be closed after that.
+        """
+        if not parse_url(url).host:
+            url = HOST + url
+        with self._lease(url) as session, session.get(url, **kwargs) as response:
+            yield response
+
+    def close(self):
+        with self._lock:
+            sessions = [*self._sessions.values(), *self._evicted]
+            self._sessions.clear()
+            self._evicted.clear()
+        for session in sessions:
+            session.close()
+
+    @contextmanager
+    def _lease(self, url: str) -> t.Iterator[requests.Session]:
+        """
+        Provide the session for the host of `url`, which is kept open until the
+        context is left, even if it's evicted meanwhile.
+        """
+        session = self._get_session(url)
+        try:
+            yield session
+        finally:
+            closing = False
+            with self._lock:
+                self._leases[session] -= 1
+                if not self._leases[session]:
+                    del self._leases[session]
+                    closing = session in self._evicted
+                    self._evicted.discard(session)
+            if closing:
+                session.close()
+
+    def _get_session(self, url: str) -> requests.Session:
+        host = parse_url(url).host
+        with self._lock:
+            if session := self._sessions.get(host):
+                self._sessions.move_to_end(host)
+            else:
+                session = self._make_session(url)
+                self._sessions[host] = session
+                get_logger().debug(f"Opened session for {host} ({len(self._sessions)} total)")
+            self._leases[session] = self._leases.get(session, 0) + 1
+
+            while len(self._sessions) > self._ctx.pool_size:
+                evicted_host, evicted = self._sessions.popitem(last=False)
+                get_logger().debug(f"Closing session for {evicted_host}")
+                if evicted in self._leases:
+                    self._evicted.add(evicted)
+                else:
+                    evicted.close()
+            return session
+
+    def _make_session(self, url: str) -> requests.Session:
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self._ctx.host_conns,
+            pool_block=True,
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+        if not self._ctx.keep_alive:
+            session.headers["connection"] = "close"
+
+        if url.startswith(HOST):
+            session.headers.update(self.API_HEADERS)
+            session.headers["referer"] = f"https://vk.com/im?sel={self._ctx.peer_id}"
+            session.cookies.update(self._cookies)
+        return session
@@ -0,0 +1,87 @@
+# ------------------------------------------------------------------------------
+#  vkimexp [VK dialogs exporter]
+#  (c) 2023-2024 A. Shavykin <0.delameter@gmail.com>
+# ------------------------------------------------------------------------------
+
+import typing as t
+from collections import defaultdict
+from dataclasses import dataclass, field
+
+if t.TYPE_CHECKING:
+    from bs4 import BeautifulSoup, Tag
+
+ElementCallback = t.Callable[["Tag"], t.Any]
+BeginCallback = t.Callable[["BeautifulSoup"], t.Any]
+
+
+@dataclass(frozen=True)
+class Selector:
+    """
+    Matches elements the same way `soup.find_all(name, attrs=attrs)` does:
+    "class" value should be one of element's classes, other attributes'
+    values should be equal to the specified ones.
+    """
+
+    name: str | None
+    attrs: dict[str, str] = field(default_factory=dict)
+
+    def matches(self, el: "Tag") -> bool:
+        if self.name and el.name != self.name:
+            return False
+        for attr, value in self.attrs.items():
+            if attr == "class":
+                if value not in el.get("class", ()):
+                    return False
+            elif el.get(attr) != value:
+                return False
+        return True
+
+
+class DomVisitor:
+    """
+    Walks the soup once and routes the elements to the subscribers, which
+    registered the selectors they are interested in, instead of each of them
+    scanning the whole tree by themselves. Callbacks should not modify the tree
+    (rather remember the elements to modify them later); if a callback returns
+    `SKIP`, the element's children are not visited, and the rest of callbacks
+    for this element are not invoked.
+    """
+
+    SKIP = object()
+
+    def __init__(self):
+        self._begin_cbs: list[BeginCallback] = []
+        self._named_subs: dict[str, list[tuple[Selector, ElementCallback]]] = defaultdict(list)
+        self._any_subs: list[tuple[Selector, ElementCallback]] = []
+
+    def subscribe(self, selector: Selector, callback: ElementCallback):
+        if selector.name:
+            self._named_subs[selector.name].append((selector, callback))
+        else:
+            self._any_subs.append((selector, callback))
+
+    def on_begin(self, callback: BeginCallback):
+        """
+        :param callback: invoked before each traversal, e.g. to reset per-page state
+        """
+        self._begin_cbs.append(callback)
+
+    def visit(self, soup: "BeautifulSoup"):
+        from bs4 import Tag
+
+        for begin_cb in self._begin_cbs:
+            begin_cb(soup)
+
+        stack = [*reversed(soup.contents)]
+        while stack:
+            el = stack.pop()
+            if not isinstance(el, Tag):
+                continue
+            if self._dispatch(el) is not self.SKIP:
+                stack.extend(reversed(el.contents))
+
+    def _dispatch(self, el: "Tag") -> t.Any:
+        for selector, callback in (*self._named_subs.get(el.name, ()), *self._any_subs):
+            if selector.matches(el) and callback(el) is self.SKIP:
+                return self.SKIP
+        return None
@@ -6,20 +6,23 @@ import dataclasses
 import html
 import re
 import shutil
-import tempfile
+import sqlite3
+import time
 
 import pytermor as pt
 import json
 import os.path
 from abc import abstractmethod, ABCMeta
-from collections import deque
 from collections.abc import Iterable
 from datetime import datetime
 from pathlib import Path
 import typing as t
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, Tag
 from .common import Context, MessageDTO
+from .dedup import DedupIndex
+from .rawstore import RawBlob, SegmentStore
+from .visitor import DomVisitor, Selector
 
 
 class Writer(metaclass=ABCMeta):
@@ -28,7 +31,11 @@ class Writer(metaclass=ABCMeta):
     in different formats.
     """
 
-    def __init__(self, ctx: "Context"):
+    def __init__(self, ctx: "Context", state: dict = None):
+        """
+        :param state: result of `get_state()` call made during previous (interrupted)
+                      export; if provided, writer should continue from that point.
+        """
         self._ctx = ctx
 
     @abstractmethod
@@ -39,36 +46,62 @@ class Writer(metaclass=ABCMeta):
     def close(self):
         ...
 
+    def get_state(self) -> dict:
+        """
+        Data required to continue writing after an interruption, see `Checkpoint`.
+        """
+        return {}
+
 
 class IndexWriter(Writer):
     """
     Writes fetched history in plain text format (e.g. for quick greping).
     """
 
-    def __init__(self, ctx: "Context"):
+    FILENAME = "index.txt"
+    _SEPARATOR = "-" * 120 + "\n"
+
+    def __init__(self, ctx: "Context", state: dict = None):
         super().__init__(ctx)
-        self._seen_msg_idxs = set()
+        self._seen_msg_idxs = ctx.dedup.get_plane(DedupIndex.INDEX)
+
+        index_path = ctx.out_dir / self.FILENAME
+        if state:
+            os.truncate(index_path, state["size"])
+            self._index_file = open(index_path, "at")
+            return
 
         now_ts = datetime.now().timestamp()
-        self._index_file = open(ctx.out_dir / "index.txt", "wt")
+        self._index_file = open(index_path, "wt")
 
         header = self._fmt_row("#", "|", "", int(now_ts), 0, f"INDEX FOR PEER {ctx.peer_id}")
         self._write_row(*header)
-        self._index_file.write("-" * 120 + "\n")
+        self._index_file.write(self._SEPARATOR)
+
+    @classmethod
+    def get_header_size(cls, ctx: "Context") -> int | None:
+        """
+        :return: size of the header of existing index (it contains the time of
+                 the export), or None if there is no index.
+        """
+        try:
+            with open(ctx.out_dir / cls.FILENAME, "rb") as f:
+                header = f.readline() + f.readline()
+        except FileNotFoundError:
+            return None
+        if not header.endswith(cls._SEPARATOR.encode()):
+            return None
+        return len(header)
 
     def write(self, dto: MessageDTO) -> bool:
-        if dto.msg_idx in self._seen_msg_idxs:
+        if not self._seen_msg_idxs.add(dto.msg_idx):
             return False
-        self._seen_msg_idxs.add(dto.msg_idx)
 
         peer_name = None
         if self._ctx.is_group_conversation:
             peer_name = self._ctx.peer_name_map.get(dto.from_peer_id, str(dto.from_peer_id))
 
-        text = html.unescape(dto.text).replace("<br>", "\n")
-        text = re.sub(R'<img class="emoji".+?alt="(.+?)".*?>\s*', r"\1", text)
-
-        fields = self._fmt_row(dto.msg_idx, dto.inbox, peer_name, dto.ts, dto.attach_count, text)
+        fields = self._fmt_row(dto.msg_idx, dto.inbox, peer_name, dto.ts, dto.attach_count, unescape_text(dto.text))
         self._write_row(*fields)
         return True
 
@@ -103,58 +136,376 @@ class IndexWriter(Writer):
         if not self._index_file.closed:
             self._index_file.close()
 
+    def get_state(self) -> dict:
+        self._index_file.flush()
+        return {
+            "size": os.fstat(self._index_file.fileno()).st_size,
+        }
+
 
 class JsonWriter(Writer):
     """
-    Writes fetched history in machine-readable JSON format.
+    Writes fetched history in machine-readable JSON format. Messages are
+    streamed into a temporary file as soon as they arrive (the result is the
+    same as of `json.dump(..., indent=4)` call for the whole history), which
+    replaces the output file when the writer is closed.
     """
 
-    def __init__(self, ctx: "Context"):
+    FILENAME = "index.json"
+    FSYNC_INTERVAL_SEC = 5.0
+    READ_SIZE = 1 << 20
+
+    _HEAD = "["
+    _TAIL = "\n]"
+    _EMPTY_TAIL = "]"
+
+    def __init__(self, ctx: "Context", state: dict = None):
         super().__init__(ctx)
-        self._output_filename = ctx.out_dir / "index.json"
-        self._seen_msg_idxs = set()
-        self._msgs = deque[MessageDTO]()
-        # now_ts = datetime.now().timestamp()
-        # self._json_file = open(, "wt")
+        self._output_filename = ctx.out_dir / self.FILENAME
+        self._part_filename = ctx.out_dir / (self.FILENAME + ".part")
+        self._seen_msg_idxs = ctx.dedup.get_plane(DedupIndex.JSON)
+        self._count = 0
+        self._last_fsync_ts = time.monotonic()
+
+        if state:
+            self._count = state["count"]
+            if not self._part_filename.exists():
+                # previous run was interrupted, but managed to finalize the output
+                os.replace(self._output_filename, self._part_filename)
+            os.truncate(self._part_filename, state["size"])
+            self._json_file = open(self._part_filename, "at")
+            return
+
+        self._json_file = open(self._part_filename, "wt")
+        self._json_file.write(self._HEAD)
+
+    def load(self, visit_fn: t.Callable[[MessageDTO], t.Any] = None) -> int:
+        """
+        Read the results of previous export and copy them to the output, as if
+        they were just written. Used to merge the new messages into existing history.
+        Messages are parsed one by one and passed to `visit_fn`, so that the whole
+        history is never kept in memory.
+
+        :return: amount of messages read.
+        """
+        count = 0
+        try:
+            for msg in self._iter_msgs():
+                self._seen_msg_idxs.add(msg.msg_idx)
+                count += 1
+                if visit_fn:
+                    visit_fn(msg)
+        except FileNotFoundError:
+            return 0
+
+        self._count = count
+        tail = (self._TAIL if count else self._EMPTY_TAIL).encode()
+        self._json_file.close()
+
+        shutil.copyfile(self._output_filename, self._part_filename)
+        with open(self._part_filename, "r+b") as f:
+            f.seek(-len(tail), os.SEEK_END)
+            tail_ok = f.read() == tail
+            if tail_ok:
+                f.truncate(f.tell() - len(tail))
+        self._json_file = open(self._part_filename, "at")
+
+        if not tail_ok:  # formatted differently, rewrite from scratch
+            self._json_file.truncate(0)
+            self._json_file.write(self._HEAD)
+            self._seen_msg_idxs.clear()
+            self._count = 0
+            for msg in self._iter_msgs():
+                self.write(msg)
+        return count
 
     def write(self, dto: MessageDTO) -> bool:
-        """Not an actual 'write', rather buffering"""
-        if dto.msg_idx in self._seen_msg_idxs:
+        if not self._seen_msg_idxs.add(dto.msg_idx):
             return False
-        self._seen_msg_idxs.add(dto.msg_idx)
-        self._msgs.append(dto)
+
+        self._json_file.write(self._format(dto, self._count == 0))
+        self._count += 1
+        if time.monotonic() - self._last_fsync_ts >= self.FSYNC_INTERVAL_SEC:
+            self._fsync()
         return True
 
     def close(self):
-        """Actual writing happens here"""
-        data = [dataclasses.asdict(msg) for msg in self._msgs]
-        _, tmp_filename = tempfile.mkstemp(text=True)
-        with open(tmp_filename, "wt") as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)
-        shutil.move(tmp_filename, self._output_filename)  # atomic write
+        if not hasattr(self, "_json_file") or self._json_file.closed:
+            return
+        self._json_file.write(self._TAIL if self._count else self._EMPTY_TAIL)
+        self._fsync()
+        self._json_file.close()
+        os.replace(self._part_filename, self._output_filename)  # atomic write
+
+    def get_state(self) -> dict:
+        self._fsync()
+        return {
+            "size": os.fstat(self._json_file.fileno()).st_size,
+            "count": self._count,
+        }
+
+    def _format(self, dto: MessageDTO, first: bool) -> str:
+        record = json.dumps(dataclasses.asdict(dto), ensure_ascii=False, indent=4)
+        return ("\n" if first else ",\n") + "    " + record.replace("\n", "\n    ")
+
+    def _iter_msgs(self) -> t.Iterator[MessageDTO]:
+        """
+        Incremental parser of the output: reads it by blocks of `READ_SIZE`
+        and decodes the elements of top-level array one at a time.
+        """
+        decoder = json.JSONDecoder()
+        with open(self._output_filename, "rt") as f:
+            buffer, pos = "", 0
+
+            def peek() -> str:
+                """
+                :return: next non-whitespace char, or "" at the end of file.
+                """
+                nonlocal buffer, pos
+                while True:
+                    while pos < len(buffer) and buffer[pos].isspace():
+                        pos += 1
+                    if pos < len(buffer):
+                        return buffer[pos]
+                    if not (chunk := f.read(self.READ_SIZE)):
+                        return ""
+                    buffer, pos = chunk, 0
+
+            if peek() != "[":
+                raise ValueError(f"Expected JSON array in {self._output_filename}")
+            pos += 1
+            first = True
+            while (char := peek()) != "]":
+                if not first:
+                    if char != ",":
+                        raise ValueError(f"Expected ',' or ']' in {self._output_filename}, got: {char!r}")
+                    pos += 1
+                    peek()
+                while True:
+                    try:
+                        msg, pos = decoder.raw_decode(buffer, pos)
+                        break
+                    except json.JSONDecodeError:
+                        if not (chunk := f.read(self.READ_SIZE)):
+                            raise
+                        buffer, pos = buffer[pos:] + chunk, 0
+                yield MessageDTO(**msg)
+                first = False
+
+    def _fsync(self):
+        self._json_file.flush()
+        os.fsync(self._json_file.fileno())
+        self._last_fsync_ts = time.monotonic()
+
+
+class JsonLinesWriter(JsonWriter):
+    """
+    Writes fetched history in JSON Lines format, one message per line.
+    """
+
+    FILENAME = "index.jsonl"
+
+    _HEAD = ""
+    _TAIL = ""
+    _EMPTY_TAIL = ""
+
+    def _format(self, dto: MessageDTO, first: bool) -> str:
+        return json.dumps(dataclasses.asdict(dto), ensure_ascii=False) + "\n"
+
+    def _iter_msgs(self) -> t.Iterator[MessageDTO]:
+        with open(self._output_filename, "rt") as f:
+            for line in f:
+                if line.strip():
+                    yield MessageDTO(**json.loads(line))
+
+
+class SqliteWriter(Writer):
+    """
+    Writes messages into SQLite database shared by all the peers (see
+    `Context.get_db_path()`) along with full-text index of their (unescaped)
+    texts, which is queried by "vkimexp search". Rows are keyed by peer ID and
+    message index, so writing the same message again just updates it; that
+    makes the writer safe to resume and to re-run over the same history.
+    Rows are inserted in batches, one transaction per batch.
+    """
+
+    BATCH_SIZE = 500
+    BUSY_TIMEOUT_SEC = 30.0  # other peers' writers can hold the lock
+
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS messages ("
+        " id INTEGER PRIMARY KEY,"
+        " peer_id INTEGER NOT NULL,"
+        " msg_idx INTEGER NOT NULL,"
+        " msg_id INTEGER NOT NULL,"
+        " ts INTEGER NOT NULL,"
+        " inbox INTEGER NOT NULL,"
+        " from_peer_id INTEGER,"
+        " attach_count INTEGER NOT NULL,"
+        " text TEXT NOT NULL,"
+        " attach TEXT NOT NULL,"
+        " UNIQUE (peer_id, msg_idx)"  # also serves as an index on peer_id
+        ")",
+        "CREATE INDEX IF NOT EXISTS messages_ts ON messages (ts)",
+        "CREATE INDEX IF NOT EXISTS messages_from_peer_id ON messages (from_peer_id)",
+        "CREATE TABLE IF NOT EXISTS peers (peer_id INTEGER PRIMARY KEY, name TEXT NOT NULL)",
+        "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+        " text, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2'"
+        ")",
+        # external content FTS table is kept in sync by triggers
+        "CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN"
+        " INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);"
+        " END",
+        "CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN"
+        " INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.id, old.text);"
+        " END",
+        "CREATE TRIGGER IF NOT EXISTS messages_au AFTER UPDATE OF text ON messages BEGIN"
+        " INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.id, old.text);"
+        " INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);"
+        " END",
+    ]
+
+    def __init__(self, ctx: "Context", state: dict = None):
+        super().__init__(ctx)
+        self._path = ctx.get_db_path()
+        self._conn: sqlite3.Connection | None = None
+        self._pending: list[tuple] = []
+        self._connect()
+
+    def write(self, dto: MessageDTO) -> bool:
+        from_peer_id = int(dto.from_peer_id) if dto.from_peer_id else None
+        self._pending.append(
+            (
+                self._ctx.peer_id,
+                dto.msg_idx,
+                dto.msg_id,
+                dto.ts,
+                dto.inbox,
+                from_peer_id,
+                dto.attach_count,
+                unescape_text(dto.text),
+                json.dumps(dto.attach, ensure_ascii=False),
+            )
+        )
+        if len(self._pending) >= self.BATCH_SIZE:
+            self.flush()
+        return True
+
+    def flush(self):
+        if not self._pending or not self._conn:
+            return
+        with self._conn:  # one transaction per batch
+            self._conn.executemany(
+                "INSERT INTO messages (peer_id, msg_idx, msg_id, ts, inbox, from_peer_id, attach_count, text, attach) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (peer_id, msg_idx) DO UPDATE SET "
+                " msg_id = excluded.msg_id, ts = excluded.ts, inbox = excluded.inbox,"
+                " from_peer_id = excluded.from_peer_id, attach_count = excluded.attach_count,"
+                " text = excluded.text, attach = excluded.attach",
+                self._pending,
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO peers (peer_id, name) VALUES (?, ?)",
+                [(int(peer_id), name) for peer_id, name in self._ctx.peer_name_map.items()],
+            )
+        self._pending.clear()
+
+    def close(self):
+        if not self._conn:
+            return
+        self.flush()
+        self._conn.close()
+        self._conn = None
+
+    def get_state(self) -> dict:
+        # everything written before the checkpoint should be in the database
+        self.flush()
+        return {}
+
+    def _connect(self):
+        self._conn = sqlite3.connect(self._path, timeout=self.BUSY_TIMEOUT_SEC, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode = WAL")  # readers (search) don't block the writers
+        self._conn.execute("PRAGMA synchronous = NORMAL")
+        with self._conn:
+            for statement in self.SCHEMA:
+                self._conn.execute(statement)
 
 
 class RawWriter(Writer):
     """
     Writes backend's responses before any processing happens; mostly for debugging purposes.
+    Depending on `--raw-format` each response is written either into two separate files, or
+    into compressed segments (see `SegmentStore`); both can be read by `iter_saved()`.
     """
 
-    def __init__(self, ctx: "Context"):
+    HTML_FILENAME_FMT = "html.{}.txt"
+    DATA_FILENAME_FMT = "data.{}.json"
+
+    def __init__(self, ctx: "Context", state: dict = None):
         super().__init__(ctx)
+        self._out_subdir = ctx.out_dir / "raw"
+        if ctx.sync:
+            # offsets are shifted by the new messages, so the responses can't
+            # be mixed up with the ones from previous exports
+            self._out_subdir /= f"sync.{datetime.now():%Y%m%d-%H%M%S}"
         os.makedirs(self._get_out_subdir(), exist_ok=True)
 
+        self._segments: SegmentStore | None = None
+        if ctx.raw_format == "segments":
+            self._segments = SegmentStore(self._get_out_subdir())
+
     def write(self, html: str, data: dict, offset: int) -> bool:
-        self._write_file(f"html.{offset}.txt", html)
-        self._write_file(f"data.{offset}.json", json.dumps(data, ensure_ascii=False, indent=4))
+        # segments are compressed anyway, no need to make them readable
+        indent = 4 if self._segments is None else None
+        self._write_file(self.HTML_FILENAME_FMT.format(offset), html)
+        self._write_file(self.DATA_FILENAME_FMT.format(offset), json.dumps(data, ensure_ascii=False, indent=indent))
         return True
 
+    @classmethod
+    def iter_saved(cls, out_dir: Path) -> t.Iterator[tuple[int, RawBlob, RawBlob]]:
+        """
+        :return: (offset, html, data) triplets of the saved responses in the
+                 order they were processed in, i.e. from the oldest messages
+                 to the newest, including the ones from sync exports.
+        """
+        raw_dir = out_dir / "raw"
+        for subdir in [raw_dir, *sorted(raw_dir.glob("sync.*"))]:
+            blobs = cls._find_saved(subdir)
+            offsets = []
+            for filename in blobs.keys():
+                if offset_match := re.fullmatch(r"html\.(\d+)\.txt", filename):
+                    offsets.append(int(offset_match.group(1)))
+            for offset in sorted(offsets, reverse=True):
+                if data := blobs.get(cls.DATA_FILENAME_FMT.format(offset)):
+                    yield offset, blobs[cls.HTML_FILENAME_FMT.format(offset)], data
+
+    @classmethod
+    def _find_saved(cls, subdir: Path) -> dict[str, RawBlob]:
+        blobs = dict()
+        if SegmentStore.exists(subdir):
+            segments = SegmentStore(subdir)
+            blobs.update((name, segments.get(name)) for name in segments)
+        for path in [*subdir.glob("html.*.txt"), *subdir.glob("data.*.json")]:
+            blobs.setdefault(path.name, RawBlob(path, path.stat().st_size))
+        return blobs
+
+    def read(self, offset: int) -> tuple[str, dict]:
+        blobs = self._find_saved(self._get_out_subdir())
+        html = blobs[self.HTML_FILENAME_FMT.format(offset)].read()
+        data = json.loads(blobs[self.DATA_FILENAME_FMT.format(offset)].read())
+        return html, data
+
     def close(self):
-        pass
+        if self._segments:
+            self._segments.close()
 
     def _get_out_subdir(self) -> Path:
-        return self._ctx.out_dir / "raw"
+        return self._out_subdir
 
     def _write_file(self, filename: str, content: str):
+        if self._segments is not None:
+            self._segments.put(filename, content)
+            return
         local_abs_path = self._get_out_subdir() / filename
         if local_abs_path.exists():
             return local_abs_path
@@ -164,7 +515,9 @@ class RawWriter(Writer):
 
 class HtmlWriter(Writer):
     """
-    Creates a set of navigable HTML pages with the history.
+    Creates a set of navigable HTML pages with the history. Each page is
+    finished (and closed) as soon as the next one is started, so that only one
+    file is open at a time, and finished pages can be viewed during the export.
     """
 
     _MSG_PAGE_LIMIT = 1000
@@ -176,48 +529,155 @@ class HtmlWriter(Writer):
         f"</head>"
         f"<body>"
     )
+    HTML_TAIL = "</body></html>"
 
-    def __init__(self, ctx: Context):
+    def __init__(self, ctx: Context, state: dict = None):
         super().__init__(ctx)
-        self._outs: deque[t.TextIO] = deque()
+        self._out: t.TextIO | None = None
+        self._page_num = 0  # of the current page, 0 = none were started yet
         self._cur_msg_count = 0
+        self._first_page_num = 1
+        self._blind_labels: list[Tag] = []
+
+        if state:
+            self._cur_msg_count = state["msg_count"]
+            self._first_page_num = state.get("first_page", 1)
+            if page_num := state.get("page"):
+                self._page_num = page_num
+                page_path = self._get_page_path(page_num)
+                os.truncate(page_path, state["size"])
+                self._out = open(page_path, "at")
+
+    @classmethod
+    def count_pages(cls, ctx: Context) -> int:
+        page_num = 0
+        while os.path.exists(ctx.out_dir / f"rendered{page_num + 1}.html"):
+            page_num += 1
+        return page_num
 
     def close(self):
-        self._finalize()
+        if self._out:
+            self._finish_page(has_next=False)
 
     def write(self, soup: BeautifulSoup, offset: int, msg_count: int) -> bool:
         """
         Modifies `soup` param!
         """
+        return self.write_rendered(self.render(soup), offset, msg_count)
+
+    def write_rendered(self, html: str, offset: int, msg_count: int) -> bool:
+        """
+        Same as `write()`, but for the soup which is already rendered (possibly
+        in another process, see `replay.PageRenderer`).
+        """
         self._cur_msg_count += msg_count
-        if self._cur_msg_count > self._MSG_PAGE_LIMIT or len(self._outs) == 0:
+        if not msg_count and not self._page_num and self._first_page_num > 1:
+            return False  # do not append an empty page to the previous export
+        if self._cur_msg_count > self._MSG_PAGE_LIMIT or not self._out:
             self._cur_msg_count = msg_count
-            out = open(self._ctx.out_dir / f"rendered{len(self._outs) + 1}.html", "wt")
-            out.write(self.HTML_HEAD)
-            self._outs.append(out)
+            self._start_page()
 
         marker = f"<!-- offset={offset} --> "
-        self._cur_out.write(marker + self._sanitize(soup) + "\n")
+        self._out.write(marker + html + "\n")
         return True
 
-    def _sanitize(self, soup: BeautifulSoup) -> str:
-        for label in soup.find_all("span", attrs={"class": "blind_label"}):
+    def get_state(self) -> dict:
+        """
+        Only the current page can change after this point, the previous ones are finished.
+        """
+        if not self._out:
+            return {"first_page": self._first_page_num, "page": None, "size": 0, "msg_count": self._cur_msg_count}
+        self._out.flush()
+        return {
+            "first_page": self._first_page_num,
+            "page": self._page_num,
+            "size": os.fstat(self._out.fileno()).st_size,
+            "msg_count": self._cur_msg_count,
+        }
+
+    def replace_links(self, links: dict[str, str]) -> int:
+        """
+        Point the links to local files (relative to output dir) in the pages of
+        the export to other locations, e.g. back to remote URLs. Should be called
+        after `close()`, as the pages are rewritten.
+
+        :return: amount of pages changed.
+        """
+        if not links or not self._page_num:
+            return 0
+        alternatives = "|".join(map(re.escape, sorted(links, key=len, reverse=True)))
+        regex = re.compile(rf"(?<![\w/.-])(?:\./)?({alternatives})(?![\w.-])")
+
+        changed = 0
+        for page_num in range(self._first_page_num, self._page_num + 1):
+            page_path = self._get_page_path(page_num)
+            with open(page_path, "rt") as f:
+                content = f.read()
+            content, count = regex.subn(lambda m: html.escape(links[m.group(1)]), content)
+            if not count:
+                continue
+            tmp_path = page_path.with_name(f".{page_path.name}.tmp")
+            with open(tmp_path, "wt") as f:
+                f.write(content)
+            os.replace(tmp_path, page_path)  # atomic write
+            changed += 1
+        return changed
+
+    def _get_page_path(self, page_num: int) -> Path:
+        return self._ctx.out_dir / f"rendered{page_num}.html"
+
+    def subscribe(self, visitor: DomVisitor):
+        visitor.on_begin(lambda _: self._blind_labels.clear())
+        visitor.subscribe(Selector("span", {"class": "blind_label"}), self._blind_labels.append)
+
+    def render(self, soup: BeautifulSoup) -> str:
+        """
+        Strip the elements which are not to be displayed and serialize the soup.
+        Modifies `soup` param!
+        """
+        for label in self._blind_labels:
             label.decompose()
-        return str(soup)
-
-    @property
-    def _cur_out(self) -> t.TextIO:
-        if len(self._outs) > 0:
-            return self._outs[-1]
-        raise RuntimeError("No out files -- seems like a bug")
-
-    def _finalize(self) -> None:
-        for idx, out_ren in enumerate(self._outs):
-            out = self._outs[idx]
-            out.write("<br>")
-            if idx > 0:
-                out.write(f'<a href="rendered{idx}.html">&lt;&lt; Prev&nbsp;</a>')
-            if idx < len(self._outs) - 1:
-                out.write(f'<a href="rendered{idx + 2}.html">&nbsp;Next &gt;&gt;</a>')
-            out.write("</body></html>")
-            out.close()
+        self._blind_labels.clear()
+        return self._ctx.parser.serialize(soup)
+
+    def _start_page(self) -> None:
+        if self._out:
+            self._finish_page(has_next=True)
+        elif self._first_page_num > 1 and not self._page_num:
+            self._link_previous_page()
+        self._page_num = self._page_num + 1 if self._page_num else self._first_page_num
+        self._out = open(self._get_page_path(self._page_num), "wt")
+        self._out.write(self.HTML_HEAD)
+
+    def _finish_page(self, has_next: bool) -> None:
+        self._out.write("<br>")
+        if self._page_num > 1:
+            self._out.write(f'<a href="rendered{self._page_num - 1}.html">&lt;&lt; Prev&nbsp;</a>')
+        if has_next:
+            self._out.write(self._get_next_link(self._page_num))
+        self._out.write(self.HTML_TAIL)
+        self._out.close()
+        self._out = None
+
+    def _link_previous_page(self) -> None:
+        """
+        Add a link to the first new page to the last page of previous export.
+        """
+        tail = self.HTML_TAIL.encode()
+        with open(self._get_page_path(self._first_page_num - 1), "r+b") as out:
+            out.seek(-len(tail), os.SEEK_END)
+            if out.read() != tail:
+                return
+            out.seek(-len(tail), os.SEEK_END)
+            out.write(self._get_next_link(self._first_page_num - 1).encode() + tail)
+
+    def _get_next_link(self, page_num: int) -> str:
+        return f'<a href="rendered{page_num + 1}.html">&nbsp;Next &gt;&gt;</a>'
+
+
+def unescape_text(text: str) -> str:
+    """
+    Convert message text from HTML as it comes from the server into plain text.
+    """
+    text = html.unescape(text).replace("<br>", "\n")
+    return re.sub(R'<img class="emoji".+?alt="(.+?)".*?>\s*', r"\1", text)